@@ -0,0 +1,62 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Benchmark of the CPU execution profile of EFT (--eft_cpuProfile, see bodymocap/utils/cpuProfile.py) against fp32.
+EFT is run for maxExemplarIter iterations (no early stop) on the first samples of the training DB with both settings,
+and the time per iteration and the difference of the final 2D keypoint loss are reported.
+
+Usage:
+    python -m bodymocap.apps.benchmarkCPUProfile --numSamples 20 (TrainOptions, e.g., --bExemplarMode --db_set coco --pretrained_checkpoint ... --eft_cpuThreads 0)
+"""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from bodymocap.utils import TrainOptions
+from bodymocap.train import EFTFitter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--numSamples', default=20, type=int, help='Number of samples of the training DB to run EFT on')
+
+
+def runEFT(params, bCPUProfile, numSamples):
+    """output: time of each iteration (seconds), final 2D keypoint loss of each sample"""
+    options = TrainOptions().parse_args(params)
+    options.eft_cpuProfile = bCPUProfile
+    eftFitter = EFTFitter(options)
+
+    iterTimes, finalLoss = [], []
+    for batch in eftFitter.getExemplarDataLoader(batch_size=1, sampleRange=(0, numSamples)):
+        batch = {k: v.to(eftFitter.device) if isinstance(v, torch.Tensor) else v for k,v in batch.items()}
+        eftFitter.reloadModel()
+        for it in range(options.maxExemplarIter):
+            startTime = time.time()
+            output, losses = eftFitter.run_eft_step(batch, iterIdx=it)
+            iterTimes.append(time.time() - startTime)
+        finalLoss.append(losses['loss_keypoints'])
+    return np.array(iterTimes), np.array(finalLoss)
+
+
+def benchmarkCPUProfile(params):
+    args, params = parser.parse_known_args(params)
+
+    iterTimes_fp32, finalLoss_fp32 = runEFT(params, False, args.numSamples)
+    iterTimes_cpu, finalLoss_cpu = runEFT(params, True, args.numSamples)
+
+    lossDelta = finalLoss_cpu - finalLoss_fp32
+    print(">>> Threads: {}, samples: {}, iterations: {}".format(torch.get_num_threads(), len(finalLoss_fp32), len(iterTimes_fp32)))
+    print(">>> Time per iteration (median): fp32 {:.1f} ms | cpuProfile {:.1f} ms | speedup x{:.2f}".format(
+        np.median(iterTimes_fp32)*1000, np.median(iterTimes_cpu)*1000, np.median(iterTimes_fp32) / np.median(iterTimes_cpu)))
+    print(">>> Final keypoint loss: fp32 {:.6f} | cpuProfile {:.6f} | delta mean {:.6f}, max abs {:.6f}".format(
+        finalLoss_fp32.mean(), finalLoss_cpu.mean(), lossDelta.mean(), np.abs(lossDelta).max()))
+
+    return {'iterTimes_fp32': iterTimes_fp32, 'iterTimes_cpuProfile': iterTimes_cpu,
+            'finalLoss_fp32': finalLoss_fp32, 'finalLoss_cpuProfile': finalLoss_cpu}
+
+
+if __name__ == '__main__':
+    benchmarkCPUProfile(sys.argv[1:])
@@ -0,0 +1,67 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Benchmark of the EFT optimizers (--eft_optimizer adam / lbfgs) on the same samples, for the ablation modes with few
+trainable parameters. EFT is run for maxExemplarIter iterations (no early stop) on the first samples of the training DB,
+and the iterations to reach eft_thresh_keyptErr_2d, the wall time to reach it, and the final 2D keypoint loss are reported.
+
+Usage:
+    python -m bodymocap.apps.benchmarkOptimizer --numSamples 20 (TrainOptions, e.g., --bExemplarMode --ablation_layerteset_decOnly --db_set coco --pretrained_checkpoint ...)
+"""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from bodymocap.utils import TrainOptions
+from bodymocap.train import EFTFitter
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--numSamples', default=20, type=int, help='Number of samples of the training DB to run EFT on')
+
+
+def runEFT(params, optimizerName, numSamples):
+    """output: (numSamples,) arrays of iterations and seconds to reach the threshold (NaN if not reached), and final 2D keypoint loss"""
+    options = TrainOptions().parse_args(params)
+    options.eft_optimizer = optimizerName
+    eftFitter = EFTFitter(options)
+
+    itersToThresh, timeToThresh, finalLoss = [], [], []
+    for batch in eftFitter.getExemplarDataLoader(batch_size=1, sampleRange=(0, numSamples)):
+        batch = {k: v.to(eftFitter.device) if isinstance(v, torch.Tensor) else v for k,v in batch.items()}
+        eftFitter.reloadModel()
+        reachedIter, reachedTime = np.nan, np.nan
+        startTime = time.time()
+        for it in range(options.maxExemplarIter):
+            output, losses = eftFitter.run_eft_step(batch, iterIdx=it)       #Loss before the update of this iteration
+            if np.isnan(reachedIter) and losses['loss_keypoints'] < options.eft_thresh_keyptErr_2d:
+                reachedIter, reachedTime = it, time.time() - startTime
+        itersToThresh.append(reachedIter)
+        timeToThresh.append(reachedTime)
+        finalLoss.append(losses['loss_keypoints'])
+    return np.array(itersToThresh), np.array(timeToThresh), np.array(finalLoss)
+
+
+def benchmarkOptimizer(params):
+    args, params = parser.parse_known_args(params)
+
+    results = {}
+    for optimizerName in ['adam', 'lbfgs']:
+        itersToThresh, timeToThresh, finalLoss = runEFT(params, optimizerName, args.numSamples)
+        results[optimizerName] = {'itersToThresh': itersToThresh, 'timeToThresh': timeToThresh, 'finalLoss': finalLoss}
+
+        bReached = np.isnan(itersToThresh)==False
+        print(">>> {}: reached threshold {}/{} | iterations (median) {:.1f} | time (median) {:.3f} sec | final keypoint loss {:.6f}".format(
+            optimizerName, bReached.sum(), len(bReached),
+            np.median(itersToThresh[bReached]) if bReached.any() else np.nan,
+            np.median(timeToThresh[bReached]) if bReached.any() else np.nan,
+            finalLoss.mean()))
+
+    return results
+
+
+if __name__ == '__main__':
+    benchmarkOptimizer(sys.argv[1:])
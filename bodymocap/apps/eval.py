@@ -30,7 +30,7 @@ import torchgeometry as tgm
 
 from bodymocap.core import config 
 from bodymocap.core import constants 
-from bodymocap.models import hmr, SMPL, SMPLX
+from bodymocap.models import hmr, SMPL, SMPLX, load_checkpoint
 from bodymocap.datasets import BaseDataset
 from bodymocap.utils.imutils import uncrop
 from bodymocap.utils.pose_utils import reconstruction_error
@@ -40,6 +40,7 @@ from bodymocap.utils.pose_utils import reconstruction_error
 parser = argparse.ArgumentParser()
 parser.add_argument('--checkpoint', default=None, help='Path to network checkpoint')
 parser.add_argument('--dataset', default='h36m-p1', choices=['h36m-p1', 'h36m-p2', 'lsp', '3dpw', '3dpw-crop', 'mpi-inf-3dhp' ,'all'], help='Choose evaluation dataset')
+parser.add_argument('--backbone', default='resnet50', help='Backbone of HMR the checkpoint was trained with (see BACKBONES in bodymocap/models/hmr.py)')
 parser.add_argument('--log_freq', default=50, type=int, help='Frequency of printing intermediate results')
 parser.add_argument('--batch_size', default=32, help='Batch size for testing')
 parser.add_argument('--shuffle', default=False, action='store_true', help='Shuffle data')
@@ -413,7 +414,7 @@ def run_evaluation(model, dataset_name, dataset, result_file,
 def eval_main(params):
     args = parser.parse_args(params)
 
-    model = hmr(config.SMPL_MEAN_PARAMS)
+    model = hmr(config.SMPL_MEAN_PARAMS, backbone=args.backbone)
 
     if os.path.isdir(args.checkpoint):
         fileCands = os.listdir(args.checkpoint)
@@ -428,7 +429,7 @@ def eval_main(params):
 
     checkpoint = torch.load(args.checkpoint)
 
-    model.load_state_dict(checkpoint['model'], strict=False)
+    load_checkpoint(model, checkpoint)       #Also loads inference checkpoints with folded BatchNorm
     model.cuda()
     model.eval()
 
@@ -34,6 +34,7 @@ from bodymocap.models import hmr, SMPL
 from bodymocap.datasets import BaseDataset
 from bodymocap.utils.imutils import uncrop
 from bodymocap.utils.pose_utils import reconstruction_error
+from bodymocap.utils.iterLog import loadIterLogs, iterLogToMatrix
 # from utils.part_utils import PartRenderer
 
 import viewer2D
@@ -47,6 +48,7 @@ parser.add_argument('--batch_size', default=32, help='Batch size for testing')
 parser.add_argument('--shuffle', default=False, action='store_true', help='Shuffle data')
 parser.add_argument('--num_workers', default=4, type=int, help='Number of processes for data loading')
 parser.add_argument('--result_file', default=None, help='If set, save detections to a .npz file')
+parser.add_argument('--iterLogDir', default=None, help='If set, load the iteration logs (iterlog_*.npy) of eftAllInDB_3dpwtest in this folder, instead of the pkl files')
 
 
 g_smpl_neutral = None
@@ -56,8 +58,10 @@ g_smpl_female = None
 
 def run_evaluation(model, dataset_name, dataset, result_file,
                    batch_size=32, img_res=224, 
-                   num_workers=32, shuffle=False, log_freq=50, bVerbose= True):
-    """Run evaluation on the datasets and metrics we report in the paper. """
+                   num_workers=32, shuffle=False, log_freq=50, bVerbose= True, iterLogDir=None):
+    """Run evaluation on the datasets and metrics we report in the paper.
+        iterLogDir: if set, load the iteration logs (iterlog_*.npy) in this folder, instead of the pkl files
+    """
 
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
     # # Transfer model to the GPU
@@ -153,7 +157,11 @@ def run_evaluation(model, dataset_name, dataset, result_file,
 
     # outputPath='reconErrorData_05-24_3dpw_test_with1336_iterUpto20.pkl'
     outputPath='reconErrorData_05-25_3dpw_test_with1336_iterUpto50.pkl'
-    if os.path.exists(outputPath):
+    if iterLogDir is not None:
+        iterLog = loadIterLogs(iterLogDir)
+        reconErrorPerIter = iterLogToMatrix(iterLog, 'r_error')[0]         #(numIters, numSamples)
+        keyPtErrorPerIter = iterLogToMatrix(iterLog, 'loss_keypoints')[0]
+    elif os.path.exists(outputPath):
         import pickle
         
         with open(outputPath,'rb') as f:
@@ -220,23 +228,24 @@ def run_evaluation(model, dataset_name, dataset, result_file,
             with open(outputPath,'wb') as f:
                 pickle.dump(reconError,f)       #Bug fixed
                 f.close()
-    reconErrorPerIter=[]
-    for it in range(50):
-        print(it)
-        reconErrorPerIter.append([d[it][0] for d in reconError])
+    if iterLogDir is None:
+        reconErrorPerIter=[]
+        for it in range(50):
+            print(it)
+            reconErrorPerIter.append([d[it][0] for d in reconError])
 
-    keyPtErrorPerIter=[]
-    for it in range(50):
-        print(it)
-        keyPtErrorPerIter.append([d[it][1] for d in reconError])
+        keyPtErrorPerIter=[]
+        for it in range(50):
+            print(it)
+            keyPtErrorPerIter.append([d[it][1] for d in reconError])
 
 
-    # viewer2D.Plot(reconError)
-    reconErrorPerIter = np.array(reconErrorPerIter)
-    keyPtErrorPerIter = np.array(keyPtErrorPerIter)
+        # viewer2D.Plot(reconError)
+        reconErrorPerIter = np.array(reconErrorPerIter)
+        keyPtErrorPerIter = np.array(keyPtErrorPerIter)
 
     
-    for it in range(50):
+    for it in range(reconErrorPerIter.shape[0]):
         print("{}: reconError:{}, keyptError{}".format(it, np.mean(reconErrorPerIter[it,:]),np.mean(keyPtErrorPerIter[it,:])     ))
 
 
@@ -554,4 +563,5 @@ if __name__ == '__main__':
     run_evaluation(model, args.dataset, dataset, args.result_file,
                    batch_size=args.batch_size,
                    shuffle=args.shuffle,
-                   log_freq=args.log_freq, num_workers=args.num_workers)
+                   log_freq=args.log_freq, num_workers=args.num_workers,
+                   iterLogDir=args.iterLogDir)
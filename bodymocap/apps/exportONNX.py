@@ -0,0 +1,71 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Export an HMR checkpoint to ONNX for the onnxruntime backend of BodyMocap (see bodymocap/models/hmr_onnx.py),
+and compare the outputs and the batch-1 latency against PyTorch on CPU.
+Checkpoints with folded BatchNorm (apps/foldBatchNorm.py) can also be exported.
+
+Usage:
+    python -m bodymocap.apps.exportONNX --checkpoint data/model_checkpoint.pt --output data/model_checkpoint.onnx
+"""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from bodymocap.core import config
+from bodymocap.models import hmr, load_checkpoint
+from bodymocap.models.hmr_onnx import exportHMRToONNX, ORTRegressor
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint', required=True, help='Path to the network checkpoint')
+parser.add_argument('--backbone', default='resnet50', help='Backbone of HMR the checkpoint was trained with (see BACKBONES in bodymocap/models/hmr.py)')
+parser.add_argument('--output', required=True, help='Path of the onnx file')
+parser.add_argument('--opset', default=17, type=int, help='ONNX opset version')
+parser.add_argument('--num_threads', default=0, type=int, help='Number of CPU threads for the latency test. 0: default of each runtime')
+parser.add_argument('--latency_iters', default=20, type=int, help='Number of batch-1 calls to compare the latency. 0 to skip')
+
+
+def measureLatency(model, numIters, img_res=224):
+    """output: median seconds of a batch-1 call"""
+    x = torch.randn(1, 3, img_res, img_res)
+    times = []
+    with torch.no_grad():
+        for it in range(numIters + 3):
+            startTime = time.time()
+            model(x)
+            if it>=3:       #Warm-up
+                times.append(time.time() - startTime)
+    return float(np.median(times))
+
+
+def export_main(params):
+    args = parser.parse_args(params)
+    if args.num_threads>0:
+        torch.set_num_threads(args.num_threads)
+
+    model = hmr(config.SMPL_MEAN_PARAMS, pretrained=False, backbone=args.backbone)
+    load_checkpoint(model, torch.load(args.checkpoint, map_location='cpu'))
+    model.eval()
+
+    exportHMRToONNX(model, args.output, opset_version=args.opset)
+    print(">> Saved: {}".format(args.output))
+
+    regressor = ORTRegressor(args.output, args.num_threads)
+    x = torch.randn(4, 3, 224, 224)       #Also checks the dynamic batch dimension
+    with torch.no_grad():
+        maxDiff = [ (a - b).abs().max().item() for a, b in zip(model(x), regressor(x)) ]
+    print(">> Max abs difference (rotmat, betas, camera): {}".format(maxDiff))
+
+    if args.latency_iters>0:
+        latency_torch = measureLatency(model, args.latency_iters)
+        latency_ort = measureLatency(regressor, args.latency_iters)
+        print(">> Latency (batch 1, CPU): PyTorch {:.1f} ms | onnxruntime {:.1f} ms | speedup x{:.2f}".format(latency_torch*1000, latency_ort*1000, latency_torch/latency_ort))
+    return maxDiff
+
+
+if __name__ == '__main__':
+    export_main(sys.argv[1:])
@@ -0,0 +1,73 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Export an inference-only HMR checkpoint, with each BatchNorm of the ResNet backbone folded into the preceding conv
+(see fold_batchnorm in bodymocap/models/hmr.py). The outputs are the same as the original checkpoint in eval mode.
+The checkpoint has checkpoint['foldedBN']=True, and is loaded by BodyMocap and apps/eval.py (load_checkpoint).
+It cannot be used for training or EFT, which need the BatchNorm layers.
+
+Usage:
+    python -m bodymocap.apps.foldBatchNorm --checkpoint data/model_checkpoint.pt --output data/model_checkpoint_folded.pt
+"""
+
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from bodymocap.core import config
+from bodymocap.models import hmr, fold_batchnorm, load_checkpoint
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint', required=True, help='Path to the network checkpoint')
+parser.add_argument('--backbone', default='resnet50', help='Backbone of HMR the checkpoint was trained with (see BACKBONES in bodymocap/models/hmr.py)')
+parser.add_argument('--output', required=True, help='Path of the inference checkpoint')
+parser.add_argument('--latency_iters', default=20, type=int, help='Number of batch-1 calls to compare the latency. 0 to skip')
+
+
+def measureLatency(model, numIters, device, img_res=224):
+    """output: median seconds of a batch-1 call"""
+    x = torch.randn(1, 3, img_res, img_res, device=device)
+    times = []
+    with torch.no_grad():
+        for it in range(numIters + 3):
+            startTime = time.time()
+            model(x)
+            if device.type=='cuda':
+                torch.cuda.synchronize()
+            if it>=3:       #Warm-up
+                times.append(time.time() - startTime)
+    return float(np.median(times))
+
+
+def fold_main(params):
+    args = parser.parse_args(params)
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    assert checkpoint.get('foldedBN', False)==False, "Already folded"
+    model = load_checkpoint(hmr(config.SMPL_MEAN_PARAMS, pretrained=False, backbone=args.backbone), checkpoint).to(device).eval()
+    model_folded = load_checkpoint(hmr(config.SMPL_MEAN_PARAMS, pretrained=False, backbone=args.backbone), checkpoint).to(device).eval()
+    fold_batchnorm(model_folded)
+
+    torch.save({'model': model_folded.state_dict(), 'foldedBN': True, 'source_checkpoint': args.checkpoint}, args.output)
+    print(">> Saved: {}".format(args.output))
+
+    #Check the saved checkpoint gives the same outputs
+    model_loaded = load_checkpoint(hmr(config.SMPL_MEAN_PARAMS, pretrained=False, backbone=args.backbone), torch.load(args.output, map_location='cpu')).to(device).eval()
+    x = torch.randn(8, 3, 224, 224, device=device)
+    with torch.no_grad():
+        maxDiff = [ (a - b).abs().max().item() for a, b in zip(model(x), model_loaded(x)) ]
+    print(">> Max abs difference (rotmat, betas, camera): {}".format(maxDiff))
+
+    if args.latency_iters>0:
+        latency = measureLatency(model, args.latency_iters, device)
+        latency_folded = measureLatency(model_loaded, args.latency_iters, device)
+        print(">> Latency (batch 1, {}): {:.1f} ms -> {:.1f} ms | speedup x{:.2f}".format(device.type, latency*1000, latency_folded*1000, latency/latency_folded))
+    return maxDiff
+
+
+if __name__ == '__main__':
+    fold_main(sys.argv[1:])
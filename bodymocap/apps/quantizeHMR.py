@@ -0,0 +1,110 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Make an int8 quantized HMR checkpoint for CPU inference (see bodymocap/models/hmr_quant.py),
+and report the MPJPE/PA-MPJPE deltas (run_evaluation) and the latency speedup against the fp32 model.
+Run on a CPU machine (or with CUDA_VISIBLE_DEVICES=''), since the quantized model runs on CPU only.
+
+Usage:
+    python -m bodymocap.apps.quantizeHMR --checkpoint data/model_checkpoint.pt --output data/model_checkpoint_int8.pt --calib_dataset h36m-p1 --dataset 3dpw
+The quantized checkpoint can be given to BodyMocap instead of the fp32 checkpoint.
+The report is saved as (output)_report.json
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from bodymocap.core import config
+from bodymocap.models import hmr, load_checkpoint
+from bodymocap.models.hmr_quant import quantizeHMR, saveQuantizedHMR, loadQuantizedHMR
+from bodymocap.datasets import BaseDataset
+from bodymocap.apps.eval import run_evaluation
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoint', required=True, help='Path to the fp32 network checkpoint')
+parser.add_argument('--backbone', default='resnet50', help='Backbone of HMR the checkpoint was trained with (see BACKBONES in bodymocap/models/hmr.py)')
+parser.add_argument('--output', required=True, help='Path of the quantized checkpoint')
+parser.add_argument('--calib_dataset', default='h36m-p1', help='Dataset of the calibration crops')
+parser.add_argument('--num_calib', default=256, type=int, help='Number of calibration crops, evenly spaced over calib_dataset')
+parser.add_argument('--dataset', default='3dpw', choices=['h36m-p1', 'h36m-p2', '3dpw', '3dpw-crop', 'mpi-inf-3dhp', 'none'], help='Evaluation dataset. none to skip the evaluation')
+parser.add_argument('--backend', default='fbgemm', choices=['fbgemm', 'x86', 'qnnpack'], help='Quantization backend. qnnpack for ARM')
+parser.add_argument('--num_threads', default=0, type=int, help='Number of CPU threads for the latency test. 0: torch default')
+parser.add_argument('--latency_iters', default=50, type=int, help='Number of batch-1 calls for the latency test')
+parser.add_argument('--batch_size', default=32, type=int, help='Batch size for the evaluation')
+parser.add_argument('--num_workers', default=4, type=int, help='Number of processes for data loading')
+
+
+def loadCalibImages(datasetName, numCalib, num_workers):
+    dataset = BaseDataset(None, datasetName, is_train=False, bMiniTest=False, bEnforceUpperOnly=False)
+    if numCalib < len(dataset):
+        dataset = Subset(dataset, np.linspace(0, len(dataset)-1, numCalib).astype(np.int64).tolist())
+    return torch.cat([batch['img'] for batch in DataLoader(dataset, batch_size=32, shuffle=False, num_workers=num_workers)])
+
+
+def measureLatency(model, numIters, img_res=224):
+    """output: median seconds of a batch-1 call"""
+    x = torch.randn(1, 3, img_res, img_res)
+    times = []
+    with torch.no_grad():
+        for it in range(numIters + 5):
+            startTime = time.time()
+            model(x)
+            if it>=5:       #Warm-up
+                times.append(time.time() - startTime)
+    return float(np.median(times))
+
+
+def quantize_main(params):
+    args = parser.parse_args(params)
+    assert torch.cuda.is_available()==False, "The quantized model runs on CPU only. Run with CUDA_VISIBLE_DEVICES=''"
+    if args.num_threads>0:
+        torch.set_num_threads(args.num_threads)
+
+    model = hmr(config.SMPL_MEAN_PARAMS, pretrained=False, backbone=args.backbone)
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    load_checkpoint(model, checkpoint)
+    model.eval()
+
+    calibImages = loadCalibImages(args.calib_dataset, args.num_calib, args.num_workers)
+    print(">> Calibration: {} crops of {}".format(len(calibImages), args.calib_dataset))
+    qmodel = quantizeHMR(model, calibImages, args.backend)
+    saveQuantizedHMR(qmodel, args.output)
+    print(">> Saved: {}".format(args.output))
+    qmodel = loadQuantizedHMR(args.output)     #Evaluate what BodyMocap will load
+
+    report = {'checkpoint': args.checkpoint, 'output': args.output, 'backend': args.backend,
+              'calib_dataset': args.calib_dataset, 'num_calib': len(calibImages), 'num_threads': torch.get_num_threads(),
+              'size_fp32_mb': os.path.getsize(args.checkpoint) / 2**20, 'size_int8_mb': os.path.getsize(args.output) / 2**20}
+    report['latency_fp32_ms'] = measureLatency(model, args.latency_iters) * 1000
+    report['latency_int8_ms'] = measureLatency(qmodel, args.latency_iters) * 1000
+    report['speedup'] = report['latency_fp32_ms'] / report['latency_int8_ms']
+
+    if args.dataset != 'none':
+        dataset = BaseDataset(None, args.dataset, is_train=False, bMiniTest=False, bEnforceUpperOnly=False)
+        for name, m in [('fp32', model), ('int8', qmodel)]:
+            evalLog = run_evaluation(m, args.dataset, dataset, None, batch_size=args.batch_size, num_workers=args.num_workers, bVerbose=False)
+            report['mpjpe_{}'.format(name)] = evalLog['quant_mpjpe_avg_mm']
+            report['pa_mpjpe_{}'.format(name)] = evalLog['quant_recon_error_avg_mm']
+        report['mpjpe_delta'] = report['mpjpe_int8'] - report['mpjpe_fp32']
+        report['pa_mpjpe_delta'] = report['pa_mpjpe_int8'] - report['pa_mpjpe_fp32']
+        print(">> {}: MPJPE {:.2f} -> {:.2f} mm ({:+.2f}), PA-MPJPE {:.2f} -> {:.2f} mm ({:+.2f})".format(args.dataset,
+            report['mpjpe_fp32'], report['mpjpe_int8'], report['mpjpe_delta'], report['pa_mpjpe_fp32'], report['pa_mpjpe_int8'], report['pa_mpjpe_delta']))
+
+    print(">> Latency (batch 1, {} threads): fp32 {:.1f} ms | int8 {:.1f} ms | speedup x{:.2f}".format(
+        report['num_threads'], report['latency_fp32_ms'], report['latency_int8_ms'], report['speedup']))
+
+    reportPath = args.output[:-3] + '_report.json' if args.output.endswith('.pt') else args.output + '_report.json'
+    with open(reportPath, 'w') as f:
+        json.dump(report, f, indent=4)
+    return report
+
+
+if __name__ == '__main__':
+    quantize_main(sys.argv[1:])
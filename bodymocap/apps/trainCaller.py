@@ -5,6 +5,7 @@ import sys
 from bodymocap.utils import TrainOptions
 from bodymocap.train import Trainer
 from bodymocap.train import EFTFitter
+from bodymocap.train.shardRunner import runShardedEFT
 from bodymocap.datasets import BaseDataset
 
 """
@@ -45,6 +46,13 @@ def exemplarTrainerWrapper(params):
     eftFitter.eftAllInDB()
 
 
+#Run eftAllInDB with options.eft_numWorkers processes, sharing a work manifest in options.eft_outputDir
+def shardedExemplarTrainerWrapper(params):
+    
+    print("Sharded EFT is called")
+    runShardedEFT(params)
+
+
 def eft3DPWTestWrapper(params):
     
     print("Trainer function is called")
@@ -173,18 +173,61 @@ class BaseTrainer(object):
     #     self.optimizer.load_state_dict(self.optimizer_backup)
 
       #Code for exemplar tuning
+    #Keep a copy of trainable parameters, buffers, and optimizer state.
+    #reloadModel copies back in place only these tensors, instead of load_state_dict for the whole model
+    #Call this after setting requires_grad. Frozen parameters are not saved
     def backupModel(self):
         
         print(">>> Model status saved!")
-        self.model_backup = copy.deepcopy(self.model.state_dict())
-        self.optimizer_backup = copy.deepcopy(self.optimizer.state_dict())
+        with torch.no_grad():
+            self.model_backup = [ (par, par.detach().clone()) for par in self.model.parameters() if par.requires_grad ]
+            self.model_backup_buffers = [ (buf, buf.detach().clone()) for buf in self.model.buffers() ]      #BN running stats
+
+        self.optimizer_backup = {}
+        for group in self.optimizer.param_groups:
+            for par in group['params']:
+                if len(self.optimizer.state.get(par, {}))>0:
+                    self.optimizer_backup[par] = {k: v.clone() if torch.is_tensor(v) else copy.deepcopy(v) for k, v in self.optimizer.state[par].items()}
+        self.optimizer_backup_groups = [ {k: v for k, v in group.items() if k!='params'} for group in self.optimizer.param_groups ]
 
     def reloadModel(self):
-        print(">>> Model status has been reloaded to initial!")
-        # print(sum(sum(self.model.state_dict()['layer3.5.conv3.weight'])))
-        # print("checking: {}".format(sum(sum(self.model_backup['layer3.5.conv3.weight']))))
-        self.model.load_state_dict(self.model_backup)
-        self.optimizer.load_state_dict(self.optimizer_backup)
+        
+        startTime = time.time()
+        with torch.no_grad():
+            for par, par_backup in self.model_backup:
+                par.copy_(par_backup)
+            for buf, buf_backup in self.model_backup_buffers:
+                buf.copy_(buf_backup)
+
+        self.reloadOptimizer()
+
+        if self.device.type=='cuda':
+            torch.cuda.synchronize()
+        self.model_reset_time = time.time() - startTime
+        print(">>> Model status has been reloaded to initial! ({:.4f} sec)".format(self.model_reset_time))
+        return self.model_reset_time
+
+    #Restore only the optimizer state saved by backupModel, keeping the current weights
+    #Returns the time it took
+    def reloadOptimizer(self):
+        startTime = time.time()
+        with torch.no_grad():
+            for group, group_backup in zip(self.optimizer.param_groups, self.optimizer_backup_groups):
+                group.update(group_backup)
+                for par in group['params']:
+                    state = self.optimizer.state.get(par, {})
+                    state_backup = self.optimizer_backup.get(par, None)
+                    if state_backup is None:
+                        if len(state)>0:
+                            del self.optimizer.state[par]       #Adam moments start from scratch
+                        continue
+                    for k, v in state_backup.items():
+                        if torch.is_tensor(v) and torch.is_tensor(state.get(k, None)) and state[k].shape==v.shape:
+                            state[k].copy_(v)
+                        else:
+                            state[k] = v.clone() if torch.is_tensor(v) else copy.deepcopy(v)
+                    self.optimizer.state[par] = state
+        return time.time() - startTime
 
 
     def exemplerTrainingMode():
@@ -5,7 +5,10 @@ import numpy as np
 from bodymocap.core import constants
 from torchvision.transforms import Normalize
 
-from bodymocap.models import hmr, SMPL, SMPLX
+from bodymocap.models import hmr, SMPL, SMPLX, load_checkpoint
+from bodymocap.models.inference_graph import buildInferenceGraph, getGraphKey
+from bodymocap.models.hmr_quant import isQuantizedCheckpoint, loadQuantizedHMR
+from bodymocap.models.hmr_onnx import ORTRegressor
 from bodymocap.core import config
 from bodymocap.utils.imutils import crop,crop_bboxInfo, process_image_bbox, process_image_keypoints, bbox_from_keypoints
 from bodymocap.utils.imutils import convert_smpl_to_bbox, convert_bbox_to_oriIm
@@ -14,12 +17,23 @@ from renderer import viewer2D
 
 class BodyMocap:
 
-    def __init__(self, regressor_checkpoint, smpl_dir, device = torch.device('cuda') , bUseSMPLX = False):
+    #compileMode: None (eager), 'trace' or 'compile'. Run HMR and SMPL as one compiled graph (see models/inference_graph.py)
+    #compileCacheDir: folder to keep the compiled graph for the next runs
+    #backend: 'torch', or 'onnx' to run the regressor by onnxruntime on CPU. regressor_checkpoint should be an onnx file (see apps/exportONNX.py)
+    #ortThreads: number of onnxruntime threads. 0: onnxruntime default
+    def __init__(self, regressor_checkpoint, smpl_dir, device = torch.device('cuda') , bUseSMPLX = False, compileMode=None, compileCacheDir=None, backend='torch', ortThreads=0, backbone='resnet50'):
 
         self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
+        #Int8 quantized HMR (made by bodymocap/apps/quantizeHMR.py) runs on CPU only
+        bQuantized = isQuantizedCheckpoint(regressor_checkpoint)
+        if bQuantized and self.device.type!='cpu':
+            print("Warning: the quantized checkpoint runs on CPU. Using CPU")
+            self.device = torch.device('cpu')
+
         #Load parametric model (SMPLX or SMPL)
         if bUseSMPLX:
+            smplModelPath = smpl_dir
             self.smpl = SMPLX(smpl_dir,
                     batch_size=1,
                     create_transl=False).to(self.device)
@@ -28,11 +42,22 @@ class BodyMocap:
             self.smpl = SMPL(smplModelPath, batch_size=1, create_transl=False).to(self.device)
 
         #Load pre-trained neural network 
-        self.model_regressor = hmr(config.SMPL_MEAN_PARAMS).to(self.device)
-        checkpoint = torch.load(regressor_checkpoint, map_location=device)
-        self.model_regressor.load_state_dict(checkpoint['model'], strict=False)
+        if backend=='onnx':
+            assert compileMode is None      #The onnxruntime graph is already optimized
+            self.model_regressor = ORTRegressor(regressor_checkpoint, ortThreads, self.device)
+        elif bQuantized:
+            self.model_regressor = loadQuantizedHMR(regressor_checkpoint)
+        else:
+            self.model_regressor = hmr(config.SMPL_MEAN_PARAMS, backbone=backbone).to(self.device)     #backbone should be the one the checkpoint was trained with
+            checkpoint = torch.load(regressor_checkpoint, map_location=device)
+            load_checkpoint(self.model_regressor, checkpoint)      #Also loads inference checkpoints with folded BatchNorm
         self.model_regressor.eval()
 
+        self.inferenceGraph = None
+        if compileMode is not None:
+            graphKey = getGraphKey(regressor_checkpoint, smplModelPath, self.device, batch_size=1) if bUseSMPLX==False else None     #SMPL-X models are loaded by folder
+            self.inferenceGraph = buildInferenceGraph(self.model_regressor, self.smpl, self.device, compileMode, compileCacheDir, graphKey)
+
 
         self.normalize_img = Normalize(mean=constants.IMG_NORM_MEAN, std=constants.IMG_NORM_STD)
         self.de_normalize_img =  Normalize(mean=[ -constants.IMG_NORM_MEAN[0]/constants.IMG_NORM_STD[0],
@@ -61,10 +86,13 @@ class BodyMocap:
             return None
 
         with torch.no_grad():
-            pred_rotmat, pred_betas, pred_camera = self.model_regressor(norm_img.to(self.device))
-            pred_output = self.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False)
-            pred_vertices = pred_output.vertices
-            pred_joints_3d = pred_output.joints
+            if self.inferenceGraph is not None:
+                pred_rotmat, pred_betas, pred_camera, pred_vertices, pred_joints_3d = self.inferenceGraph(norm_img.to(self.device))
+            else:
+                pred_rotmat, pred_betas, pred_camera = self.model_regressor(norm_img.to(self.device))
+                pred_output = self.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False)
+                pred_vertices = pred_output.vertices
+                pred_joints_3d = pred_output.joints
 
             # img_original = img
             if False:
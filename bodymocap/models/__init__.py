@@ -1,2 +1,2 @@
-from .hmr import hmr
+from .hmr import hmr, eval_mode_modules, fold_batchnorm, load_checkpoint
 from .smpl import SMPL, SMPLX
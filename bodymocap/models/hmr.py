@@ -2,7 +2,9 @@
 
 import torch
 import torch.nn as nn
+import torchvision
 import torchvision.models.resnet as resnet
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import numpy as np
 import math
 
@@ -50,25 +52,42 @@ class Bottleneck(nn.Module):
 
         return out
 
+#Backbones of hmr(): (residual block, number of blocks per layer) for ResNets,
+#or the width of the pooled feature for the torchvision networks whose 'features' module is used as is
+BACKBONES = {'resnet50': (Bottleneck, [3, 4, 6, 3]),
+             'resnet18': (resnet.BasicBlock, [2, 2, 2, 2]),
+             'resnet34': (resnet.BasicBlock, [3, 4, 6, 3]),
+             'mobilenet_v3_large': 960,
+             'mobilenet_v3_small': 576,
+             'efficientnet_b0': 1280 }
+
 class HMR(nn.Module):
     """ SMPL Iterative Regressor with ResNet50 backbone
+        features: (module, feature width). If given, the module replaces the ResNet (conv1 ~ layer4),
+        e.g., the 'features' of a torchvision MobileNetV3. block and layers are ignored
     """
 
-    def __init__(self, block, layers, smpl_mean_params):
+    def __init__(self, block, layers, smpl_mean_params, features=None):
         self.inplanes = 64
         super(HMR, self).__init__()
         npose = 24 * 6
-        self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
-                               bias=False)
-        self.bn1 = nn.BatchNorm2d(64)
-        self.relu = nn.ReLU(inplace=True)
-        self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
-        self.layer1 = self._make_layer(block, 64, layers[0])
-        self.layer2 = self._make_layer(block, 128, layers[1], stride=2)
-        self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
-        self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
-        self.avgpool = nn.AvgPool2d(7, stride=1)
-        self.fc1 = nn.Linear(512 * block.expansion + npose + 13, 1024)
+        if features is None:
+            self.features = None
+            self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
+                                   bias=False)
+            self.bn1 = nn.BatchNorm2d(64)
+            self.relu = nn.ReLU(inplace=True)
+            self.maxpool = nn.MaxPool2d(kernel_size=3, stride=2, padding=1)
+            self.layer1 = self._make_layer(block, 64, layers[0])
+            self.layer2 = self._make_layer(block, 128, layers[1], stride=2)
+            self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
+            self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
+            self.avgpool = nn.AvgPool2d(7, stride=1)
+            feat_dim = 512 * block.expansion
+        else:
+            self.features, feat_dim = features
+            self.avgpool = nn.AdaptiveAvgPool2d(1)
+        self.fc1 = nn.Linear(feat_dim + npose + 13, 1024)
         self.drop1 = nn.Dropout()
         self.fc2 = nn.Linear(1024, 1024)
         self.drop2 = nn.Dropout()
@@ -114,16 +133,15 @@ class HMR(nn.Module):
         return nn.Sequential(*layers)
 
 
-    def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3):
-
-        batch_size = x.shape[0]
-
-        if init_pose is None:
-            init_pose = self.init_pose.expand(batch_size, -1)
-        if init_shape is None:
-            init_shape = self.init_shape.expand(batch_size, -1)
-        if init_cam is None:
-            init_cam = self.init_cam.expand(batch_size, -1)
+    def forward_prefix(self, x, stage='xf'):
+        """ Run the network until the given stage
+            stage: 'x3' (output of layer3) or 'xf' (pooled feature of layer4)
+            Only 'xf' with a non-ResNet backbone
+        """
+        if self.features is not None:
+            assert stage=='xf'
+            xf = self.avgpool(self.features(x))
+            return xf.view(xf.size(0), -1)
 
         x = self.conv1(x)
         x = self.bn1(x)
@@ -133,10 +151,36 @@ class HMR(nn.Module):
         x1 = self.layer1(x)
         x2 = self.layer2(x1)
         x3 = self.layer3(x2)
+        if stage=='x3':
+            return x3
         x4 = self.layer4(x3)
 
         xf = self.avgpool(x4)
         xf = xf.view(xf.size(0), -1)
+        return xf
+
+    def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3, stage=None):
+        """ 
+            stage: If None, x is an image. Otherwise x is the output of forward_prefix(image, stage)
+        """
+
+        batch_size = x.shape[0]
+
+        if init_pose is None:
+            init_pose = self.init_pose.expand(batch_size, -1)
+        if init_shape is None:
+            init_shape = self.init_shape.expand(batch_size, -1)
+        if init_cam is None:
+            init_cam = self.init_cam.expand(batch_size, -1)
+
+        if stage is None:
+            xf = self.forward_prefix(x, 'xf')
+        elif stage=='x3':
+            x4 = self.layer4(x)
+            xf = self.avgpool(x4)
+            xf = xf.view(xf.size(0), -1)
+        else:
+            xf = x
 
         pred_pose = init_pose
         pred_shape = init_shape
@@ -155,14 +199,63 @@ class HMR(nn.Module):
 
         return pred_rotmat, pred_shape, pred_cam
 
-def hmr(smpl_mean_params, pretrained=True, **kwargs):
+def hmr(smpl_mean_params, pretrained=True, backbone='resnet50', **kwargs):
     """ Constructs an HMR model with ResNet50 backbone.
     Args:
         pretrained (bool): If True, returns a model pre-trained on ImageNet
+        backbone (str): one of BACKBONES. The IEF regressor (fc1) takes the feature width of the backbone,
+            so a checkpoint can only be loaded with the backbone it was trained with
     """
-    model = HMR(Bottleneck, [3, 4, 6, 3],  smpl_mean_params, **kwargs)
-    if pretrained:
-        resnet_imagenet = resnet.resnet50(pretrained=True)
-        model.load_state_dict(resnet_imagenet.state_dict(),strict=False)
+    assert backbone in BACKBONES, "Unknown backbone: {}".format(backbone)
+    if isinstance(BACKBONES[backbone], int):
+        net = torchvision.models.get_model(backbone, weights='IMAGENET1K_V1' if pretrained else None)
+        model = HMR(None, None, smpl_mean_params, features=(net.features, BACKBONES[backbone]), **kwargs)
+        if pretrained:      #Weights of HMR.__init__ are overwritten by the ImageNet weights
+            model.features.load_state_dict(net.features.state_dict())
+    else:
+        block, layers = BACKBONES[backbone]
+        model = HMR(block, layers,  smpl_mean_params, **kwargs)
+        if pretrained:
+            resnet_imagenet = torchvision.models.get_model(backbone, weights='IMAGENET1K_V1')
+            model.load_state_dict(resnet_imagenet.state_dict(),strict=False)
     return model
 
+
+def eval_mode_modules(model):
+    """ Modules which should be in eval mode during EFT, so that the output of a sample is deterministic:
+    BatchNorm, Dropout, and StochasticDepth (EfficientNet)
+    """
+    return [ module for module in model.modules() if isinstance(module, (nn.modules.batchnorm._BatchNorm, nn.Dropout, torchvision.ops.StochasticDepth)) ]
+
+def fold_batchnorm(model):
+    """ Fold each BatchNorm of the backbone into the preceding conv, for inference only.
+    The BatchNorms are replaced by Identity, and the convs get a bias. The model should be in eval mode
+    """
+    assert model.training==False
+    if model.features is not None:      #torchvision backbones: conv and BatchNorm are consecutive in a Sequential (Conv2dNormActivation)
+        for module in [m for m in model.features.modules() if isinstance(m, nn.Sequential)]:
+            for i in range(len(module)-1):
+                if isinstance(module[i], nn.Conv2d) and isinstance(module[i+1], nn.BatchNorm2d):
+                    module[i] = fuse_conv_bn_eval(module[i], module[i+1])
+                    module[i+1] = nn.Identity()
+        return model
+
+    for module in [model] + [m for m in model.modules() if isinstance(m, (Bottleneck, resnet.BasicBlock))]:
+        for convName, bnName in [('conv1', 'bn1'), ('conv2', 'bn2'), ('conv3', 'bn3')]:
+            if isinstance(getattr(module, bnName, None), nn.BatchNorm2d):
+                setattr(module, convName, fuse_conv_bn_eval(getattr(module, convName), getattr(module, bnName)))
+                setattr(module, bnName, nn.Identity())
+        if isinstance(getattr(module, 'downsample', None), nn.Sequential) and isinstance(module.downsample[1], nn.BatchNorm2d):
+            module.downsample[0] = fuse_conv_bn_eval(module.downsample[0], module.downsample[1])
+            module.downsample[1] = nn.Identity()
+    return model
+
+def load_checkpoint(model, checkpoint):
+    """ Load checkpoint['model'] to HMR. If the checkpoint is an inference checkpoint with folded BatchNorm
+    (checkpoint['foldedBN'], made by apps/foldBatchNorm.py), the BatchNorms of the model are folded first
+    """
+    if checkpoint.get('foldedBN', False):
+        model.eval()
+        fold_batchnorm(model)
+    model.load_state_dict(checkpoint['model'], strict=False)
+    return model
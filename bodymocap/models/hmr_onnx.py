@@ -0,0 +1,55 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+ONNX export of HMR (the 3 IEF iterations unrolled, with rot6d_to_rotmat), and an onnxruntime CPU backend for BodyMocap.
+    input: image (N,3,224,224). output: pred_rotmat (N,24,3,3), pred_betas (N,10), pred_camera (N,3)
+The batch dimension is dynamic.
+
+onnx and onnxruntime are optional dependencies (pip install onnx onnxruntime), only needed for this backend.
+See bodymocap/apps/exportONNX.py to export a checkpoint.
+"""
+
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+ONNX_INPUT_NAMES = ['image']
+ONNX_OUTPUT_NAMES = ['pred_rotmat', 'pred_betas', 'pred_camera']
+
+
+def exportHMRToONNX(model, outputPath, img_res=224, opset_version=17):
+    """model: HMR in fp32 (BatchNorm may be folded)"""
+    model = model.cpu().eval()
+    dummyInput = torch.zeros(1, 3, img_res, img_res)
+    with torch.no_grad():
+        torch.onnx.export(model, (dummyInput,), outputPath,
+                          input_names=ONNX_INPUT_NAMES, output_names=ONNX_OUTPUT_NAMES,
+                          dynamic_axes={name: {0: 'batch'} for name in ONNX_INPUT_NAMES + ONNX_OUTPUT_NAMES},
+                          opset_version=opset_version, dynamo=False)
+
+
+class ORTRegressor(object):
+    """Same inputs/outputs (torch tensors) as HMR.forward, run by onnxruntime on CPU
+        numThreads: intra-op threads of onnxruntime. 0: onnxruntime default (number of physical cores)
+        device: device of the output tensors
+    """
+
+    def __init__(self, onnxPath, numThreads=0, device=torch.device('cpu')):
+        if onnxruntime is None:
+            raise ImportError("onnxruntime is required for the onnx backend: pip install onnxruntime")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = numThreads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(onnxPath, options, providers=['CPUExecutionProvider'])
+        self.device = device
+
+    def eval(self):
+        return self
+
+    def __call__(self, images):
+        outputs = self.session.run(ONNX_OUTPUT_NAMES, {ONNX_INPUT_NAMES[0]: images.detach().cpu().contiguous().numpy()})
+        return tuple(torch.from_numpy(out).to(self.device) for out in outputs)
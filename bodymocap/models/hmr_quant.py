@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Int8 post-training quantization of HMR for CPU inference.
+    - ResNet50 backbone (HMR.forward_prefix): static int8 (FX graph mode), calibrated on a few crops
+    - fc1, fc2 of the iterative regressor: dynamic int8
+    - decpose, decshape, deccam and rot6d_to_rotmat stay in fp32, since their outputs are accumulated over the IEF iterations
+
+The quantized model is saved as TorchScript, and has the same inputs/outputs as HMR.forward.
+It runs on CPU only. See bodymocap/apps/quantizeHMR.py to make one, and BodyMocap to load it.
+"""
+
+import copy
+import zipfile
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, default_dynamic_qconfig, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+#Modules of HMR used only by forward_prefix. Removed from the regressor of QuantizedHMR, which starts from the pooled feature
+BACKBONE_MODULES = ['conv1', 'bn1', 'relu', 'maxpool', 'layer1', 'layer2', 'layer3', 'layer4', 'avgpool', 'features']
+
+
+class HMRBackbone(nn.Module):
+    """Image -> pooled feature of layer4 (xf)"""
+
+    def __init__(self, model):
+        super(HMRBackbone, self).__init__()
+        self.model = model
+
+    def forward(self, x):
+        return self.model.forward_prefix(x, 'xf')
+
+
+class QuantizedHMR(nn.Module):
+
+    def __init__(self, backbone, regressor):
+        super(QuantizedHMR, self).__init__()
+        self.backbone = backbone
+        self.regressor = regressor      #HMR without the backbone modules, with dynamic int8 fc1, fc2
+
+    def forward(self, x):
+        return self.regressor(self.backbone(x), stage='xf')
+
+
+def quantizeHMR(model, calibImages, backend='fbgemm', batch_size=16):
+    """model: HMR in fp32. Not modified
+        calibImages: (N,3,224,224) normalized crops for calibration
+        output: QuantizedHMR (CPU)
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+
+    backbone = prepare_fx(HMRBackbone(model), get_default_qconfig_mapping(backend), example_inputs=(calibImages[:1],))
+    with torch.no_grad():
+        for start in range(0, len(calibImages), batch_size):
+            backbone(calibImages[start:start+batch_size])
+    backbone = convert_fx(backbone)
+
+    regressor = copy.deepcopy(model)
+    for name in BACKBONE_MODULES:       #Otherwise the fp32 backbone is saved again in the checkpoint
+        if getattr(regressor, name, None) is not None:
+            setattr(regressor, name, None)
+    regressor = quantize_dynamic(regressor, {'fc1': default_dynamic_qconfig, 'fc2': default_dynamic_qconfig})
+    return QuantizedHMR(backbone, regressor).eval()
+
+
+def saveQuantizedHMR(qmodel, outputPath, img_res=224):
+    with torch.no_grad():
+        traced = torch.jit.trace(qmodel, torch.zeros(1, 3, img_res, img_res), check_trace=False)
+    torch.jit.save(traced, outputPath)
+
+
+def loadQuantizedHMR(checkpointPath):
+    return torch.jit.load(checkpointPath, map_location='cpu').eval()
+
+
+def isQuantizedCheckpoint(checkpointPath):
+    """True if the file is a TorchScript archive (saved by saveQuantizedHMR), not a torch.save checkpoint"""
+    if zipfile.is_zipfile(checkpointPath)==False:
+        return False
+    with zipfile.ZipFile(checkpointPath) as f:
+        return any('/code/' in name for name in f.namelist())
@@ -0,0 +1,80 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Compiled inference graph of HMR + rot6d_to_rotmat + SMPL, for BodyMocap.regress.
+
+    trace: TorchScript (torch.jit.trace) of the whole graph, frozen and saved in cacheDir.
+           The next runs load the saved graph instead of tracing again
+    compile: torch.compile. The compiled kernels are cached by inductor in cacheDir
+
+The graph is built for a fixed batch size (BodyMocap regresses one bbox at a time), and warmed up
+with a few calls, so that the first call of the demo does not pay for the optimization passes.
+"""
+
+import os
+import hashlib
+
+import torch
+import torch.nn as nn
+
+from bodymocap.core import constants
+
+
+class HMRSMPLGraph(nn.Module):
+    """image (N,3,224,224) -> pred_rotmat, pred_betas, pred_camera, vertices, joints"""
+
+    def __init__(self, model_regressor, smpl):
+        super(HMRSMPLGraph, self).__init__()
+        self.model_regressor = model_regressor
+        self.smpl = smpl
+
+    def forward(self, norm_img):
+        pred_rotmat, pred_betas, pred_camera = self.model_regressor(norm_img)
+        pred_output = self.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False)
+        return pred_rotmat, pred_betas, pred_camera, pred_output.vertices, pred_output.joints
+
+
+def getGraphKey(regressor_checkpoint, smplModelPath, device, batch_size):
+    """Key of the cached graph. The checkpoint and SMPL files are identified by path, size and mtime"""
+    fileKeys = []
+    for filePath in [regressor_checkpoint, smplModelPath]:
+        stat = os.stat(filePath)
+        fileKeys.append('{}:{}:{}'.format(os.path.abspath(filePath), stat.st_size, int(stat.st_mtime)))
+    key = ';'.join(fileKeys + [torch.__version__, str(device), str(batch_size)])
+    return hashlib.md5(key.encode('utf-8')).hexdigest()[:16]
+
+
+def buildInferenceGraph(model_regressor, smpl, device, compileMode='trace', cacheDir=None, graphKey=None, batch_size=1, numWarmup=3):
+    """model_regressor and smpl should be in eval mode
+        output: a callable with the same outputs as HMRSMPLGraph
+    """
+    graph = HMRSMPLGraph(model_regressor, smpl).eval()
+    dummyInput = torch.zeros(batch_size, 3, constants.IMG_RES, constants.IMG_RES, device=device)
+
+    if compileMode=='trace':
+        graphPath = os.path.join(cacheDir, 'hmr_smpl_{}.pt'.format(graphKey)) if cacheDir is not None and graphKey is not None else None
+        if graphPath is not None and os.path.exists(graphPath):
+            print(">> Loading compiled graph: {}".format(graphPath))
+            graph = torch.jit.load(graphPath, map_location=device)
+        else:
+            with torch.no_grad():
+                graph = torch.jit.freeze(torch.jit.trace(graph, dummyInput, check_trace=False))
+            if graphPath is not None:
+                os.makedirs(cacheDir, exist_ok=True)
+                tempPath = '{}.{}.tmp'.format(graphPath, os.getpid())
+                torch.jit.save(graph, tempPath)
+                os.replace(tempPath, graphPath)
+                print(">> Saved compiled graph: {}".format(graphPath))
+
+    elif compileMode=='compile':
+        if cacheDir is not None:
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', cacheDir)      #Read when inductor is first used
+        graph = torch.compile(graph)
+
+    else:
+        raise ValueError("Unknown compileMode: {}".format(compileMode))
+
+    with torch.no_grad():
+        for _ in range(numWarmup):
+            graph(dummyInput)
+    return graph
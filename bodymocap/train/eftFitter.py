@@ -7,7 +7,7 @@ from torchgeometry import angle_axis_to_rotation_matrix, rotation_matrix_to_angl
 import cv2
 
 from bodymocap.datasets import MixedDataset, BaseDataset
-from bodymocap.models import hmr, SMPL, SMPLX
+from bodymocap.models import hmr, eval_mode_modules, SMPL, SMPLX
 
 
 from bodymocap.smplify import SMPLify
@@ -17,6 +17,17 @@ from bodymocap.core import BaseTrainer
 from bodymocap.core import config
 from bodymocap.core import constants
 from .fits_dict import FitsDict
+from .multiExemplar import MultiExemplarModel, selectBatchRows
+from .eftStopping import buildStopper
+from .testLossTracker import TestLossTracker, TestLossLog
+from bodymocap.utils.resultStore import ResultStoreWriter, ResultStoreReader
+from bodymocap.utils.asyncWriter import AsyncWriter, writePickle
+from bodymocap.utils.iterLog import IterLogWriter
+from bodymocap.utils.cpuProfile import setupCPUThreads, autocastContext, toChannelsLast
+from bodymocap.utils.completionIndex import CompletionIndex, getConfigKey, getIndexPath, writePickleAndMark
+from bodymocap.utils.fitCache import FitCache
+from bodymocap.utils.stageTimer import StageTimer
+from bodymocap.utils.streamWriter import StreamWriter, StreamReader, getStreamChunkPaths
 
 from renderer import viewer2D
 from renderer import glViewer
@@ -39,16 +50,28 @@ import bodymocap.utils.smpl_utils as smpl_utils#import visSMPLoutput, getSMPLout
 from tqdm import tqdm
 
 import os
+import glob
+import time
 import datetime
 import pickle
 
-from bodymocap.utils.pose_utils import reconstruction_error, reconstruction_error_fromMesh
+from bodymocap.utils.pose_utils import reconstruction_error, reconstruction_error_fromMesh, mpjpe_fromMesh
 
 class EFTFitter(Trainer):
     def init_fn(self):
+        if self.options.eft_cpuThreads>=0:
+            setupCPUThreads(self.options.eft_cpuThreads, self.options.eft_cpuInteropThreads)
+
         self.train_ds = MixedDataset(self.options, ignore_3d=self.options.ignore_3d, is_train=True)
 
-        self.model = hmr(config.SMPL_MEAN_PARAMS, pretrained=True).to(self.device)
+        self.model = hmr(config.SMPL_MEAN_PARAMS, pretrained=True, backbone=self.options.backbone).to(self.device)
+
+        #CPU execution profile: bf16 autocast and channels_last (see cpuProfile.py)
+        self.bCPUProfile = self.options.eft_cpuProfile and self.device.type=='cpu'
+        if self.options.eft_cpuProfile and self.bCPUProfile==False:
+            print("Warning: eft_cpuProfile is ignored on GPU")
+        if self.bCPUProfile:
+            self.model = self.model.to(memory_format=torch.channels_last)
 
         if self.options.bExemplarMode:
             # lr = 1e-5   #5e-5 * 0.2       #original
@@ -56,10 +79,34 @@ class EFTFitter(Trainer):
         else:
             lr = self.options.lr
             
-        self.optimizer = torch.optim.Adam(params=self.model.parameters(),
-                                        #   lr=self.options.lr,
-                                            lr =lr,
-                                          weight_decay=0)
+        #Modules which are always in eval mode during EFT (batch norm, dropout, stochastic depth)
+        self.evalModeModules = eval_mode_modules(self.model)
+
+        if self.options.bExemplarMode:
+            #Freeze layers once here (ablation_layerteset_* options and batch norm), and optimize only the trainable parameters
+            self.setAblationLayers()
+            for module in self.evalModeModules:
+                for par in module.parameters():
+                    par.requires_grad = False
+            trainableParams = [par for par in self.model.parameters() if par.requires_grad]
+            print(">>> Trainable parameters: {} tensors, {} values".format(len(trainableParams), sum(par.numel() for par in trainableParams)))
+        else:
+            trainableParams = self.model.parameters()
+
+        #L-BFGS for the ablation modes with few trainable parameters. Each EFT iteration is one L-BFGS update with line search
+        self.bLBFGS = self.options.bExemplarMode and self.options.eft_optimizer=='lbfgs'
+        if self.bLBFGS:
+            assert self.options.bUseHand3D==False       #Only run_eft_step has the closure
+            if sum(par.numel() for par in trainableParams) > 1e7:
+                print("Warning: L-BFGS keeps {} copies of the trainable parameters. Use an ablation_layerteset_* option".format(2*self.options.eft_lbfgsHistory))
+            self.optimizer = torch.optim.LBFGS(params=trainableParams, lr=self.options.lr_lbfgs, max_iter=1,
+                                            history_size=self.options.eft_lbfgsHistory, line_search_fn='strong_wolfe')
+        else:
+            self.optimizer = torch.optim.Adam(params=trainableParams,
+                                            #   lr=self.options.lr,
+                                                lr =lr,
+                                              weight_decay=0)
+        self.prefixStage = self.getFrozenPrefixStage()      #For runModel
 
         if self.options.bUseSMPLX:      #SMPL-X model           #No change is required for HMR training. SMPL-X ignores hand and other parts.
                                                                 #SMPL uses 23 joints, while SMPL-X uses 21 joints, automatically ignoring the last two joints of SMPL 
@@ -93,6 +140,10 @@ class EFTFitter(Trainer):
 
         # Initialize SMPLify fitting module
         self.smplify = SMPLify(step_size=1e-2, batch_size=self.options.batch_size, num_iters=self.options.num_smplify_iters, focal_length=self.focal_length)
+        if self.options.smplify_batch_size>1:      #For smplifyAllInDB_batch
+            self.smplifyBatch = SMPLify(step_size=1e-2, batch_size=self.options.smplify_batch_size, num_iters=self.options.num_smplify_iters, focal_length=self.focal_length)
+        else:
+            self.smplifyBatch = None
         
         if self.options.pretrained_checkpoint is not None:
             print(">>> Load Pretrained mode: {}".format(self.options.pretrained_checkpoint))
@@ -109,6 +160,17 @@ class EFTFitter(Trainer):
         self.fits_dict = FitsDict(self.options, self.train_ds)
 
         # Create renderer
+        self.prefixCache = None     #(images, feature) for runModel
+        self.resultWriter = None     #Used if eft_outputFormat=='store'
+        self.asyncWriter = None     #Used if eft_asyncWriterQueue>0
+        self.testLossTrackers = None      #For bExemplar_analysis_testloss
+        self.resultReader = None
+        self.completionIndex = None     #Used if eft_completionIndex
+        self.completionIndexDir = None      #Output folder of self.completionIndex. The index is None if not usable for the folder
+        self.streamWriter = None        #Panoptic outputs, unless eft_panopticPklDict
+        self.bShardedRun = False        #eftAllInDB with sampleRange (shardRunner)
+        self.streamSampleIndices = None     #(outputDir, set of sampleIdx) saved in the stream files
+        self.stageTimer = StageTimer(self.options.eft_noStageTiming==False, self.options.eft_stageTimingSync)       #Per-stage time of eftAllInDB
         self.renderer = None# Renderer(focal_length=self.focal_length, img_res=self.options.img_res, faces=self.smpl.faces)
 
         #debug
@@ -120,12 +182,11 @@ class EFTFitter(Trainer):
     def keypoint_3d_loss_panopticDB(self, pred_keypoints_3d_49, gt_keypoints_3d, has_pose_3d):
         """Compute 3D keypoint loss for the examples that 3D keypoint annotations are available.
         The loss is weighted by the confidence.
+        Returns a loss per sample (N,). Zero for samples without 3D keypoints
         """
         pred_keypoints_3d = pred_keypoints_3d_49[:, 25:, :]
-        conf = gt_keypoints_3d[:, :, -1].unsqueeze(-1).clone()
+        conf = gt_keypoints_3d[:, :, -1].unsqueeze(-1).clone()          #N, 24, 1
         gt_keypoints_3d = gt_keypoints_3d[:, :, :-1].clone()
-        gt_keypoints_3d = gt_keypoints_3d[has_pose_3d == 1]
-        conf = conf[has_pose_3d == 1]           #N, 24, 1
 
         #disable hips
         conf[:,2,:] = 0
@@ -133,18 +194,14 @@ class EFTFitter(Trainer):
         # conf[:,:6,:] = 0
         # conf[:,:6,:] = 0
 
-        
-        pred_keypoints_3d = pred_keypoints_3d[has_pose_3d == 1]         #N,24, 1
-        if len(gt_keypoints_3d) > 0:
-            # gt_pelvis = (gt_keypoints_3d[:, 2,:] + gt_keypoints_3d[:, 3,:]) / 2
-            gt_nose = gt_keypoints_3d[:, 19,:]
-            gt_keypoints_3d = gt_keypoints_3d - gt_nose[:, None, :]
-            # pred_pelvis = (pred_keypoints_3d[:, 2,:] + pred_keypoints_3d[:, 3,:]) / 2
-            pred_nose = pred_keypoints_3d[:, 19,:]# + pred_keypoints_3d[:, 3,:]) / 2
-            pred_keypoints_3d = pred_keypoints_3d - pred_nose[:, None, :]
-            return (conf * self.criterion_keypoints(pred_keypoints_3d, gt_keypoints_3d)).mean()
-        else:
-            return torch.FloatTensor(1).fill_(0.).to(self.device)
+        # gt_pelvis = (gt_keypoints_3d[:, 2,:] + gt_keypoints_3d[:, 3,:]) / 2
+        gt_nose = gt_keypoints_3d[:, 19,:]
+        gt_keypoints_3d = gt_keypoints_3d - gt_nose[:, None, :]
+        # pred_pelvis = (pred_keypoints_3d[:, 2,:] + pred_keypoints_3d[:, 3,:]) / 2
+        pred_nose = pred_keypoints_3d[:, 19,:]# + pred_keypoints_3d[:, 3,:]) / 2
+        pred_keypoints_3d = pred_keypoints_3d - pred_nose[:, None, :]
+        loss = (conf * self.criterion_keypoints(pred_keypoints_3d, gt_keypoints_3d)).mean(dim=(1,2))
+        return loss * (has_pose_3d == 1).float()
     
 
 
@@ -152,9 +209,10 @@ class EFTFitter(Trainer):
     def keypoint_3d_hand_loss_panopticDB(self, pred_right_hand_joints_3d, pred_left_hand_joints_3d, gt_lhand_3d, gt_rhand_3d):
         """Compute 3D keypoint loss for the examples that 3D keypoint annotations are available.
         The loss is weighted by the confidence.
+        Returns a loss per sample (N,)
         """
 
-        loss = torch.tensor(0).to(self.device)
+        loss = torch.zeros(pred_right_hand_joints_3d.shape[0], device=self.device)
         for lr_pred, lr_gt in [ [pred_right_hand_joints_3d, gt_rhand_3d] , [pred_left_hand_joints_3d, gt_lhand_3d]  ]:
             conf = lr_gt[:, :, -1].unsqueeze(-1).clone()
 
@@ -170,35 +228,184 @@ class EFTFitter(Trainer):
             # pred_pelvis = (pred_keypoints_3d[:, 2,:] + pred_keypoints_3d[:, 3,:]) / 2
             pred_origin = lr_pred[:, [0],:]# + pred_keypoints_3d[:, 3,:]) / 2
             lr_pred = lr_pred - pred_origin
-            loss  = loss + (conf * self.criterion_keypoints(lr_pred, lr_gt)).mean()
+            loss  = loss + (conf * self.criterion_keypoints(lr_pred, lr_gt)).mean(dim=(1,2))
     
         return loss * 5.0     
 
 
 
+    #SPIN fits of the samples in a batch, saved as opt_pose and opt_beta by run_eft_step
+    def getSpinFits(self, input_batch):
+        index_cpu = input_batch['sample_index'].cpu()
+        if self.options.bExemplar_dataLoaderStart>=0:
+            index_cpu = index_cpu + self.options.bExemplar_dataLoaderStart
+        opt_pose, opt_betas, _ = self.fits_dict[(input_batch['dataset_name'], index_cpu, input_batch['rot_angle'].cpu(), input_batch['is_flipped'].cpu())]
+        return opt_pose.detach().cpu().numpy(), opt_betas.detach().cpu().numpy()
+
+    #Batch norm, dropout, and stochastic depth in eval mode. Their parameters are frozen in init_fn
     def exemplerTrainingMode(self):
 
-        for module in self.model.modules():
-            if type(module)==False:
-                continue
+        for module in self.evalModeModules:
+            module.eval()
+
+
+    #Deepest stage of HMR (see HMR.forward_prefix) such that all layers before it are frozen. None if not possible
+    def getFrozenPrefixStage(self):
+        if self.options.eft_noPrefixCache or self.options.bExemplarMode==False:        #BN should be in eval mode to reuse features
+            return None
+
+        model = self.model.module if isinstance(self.model, torch.nn.DataParallel) else self.model
+        if model.features is not None:      #Non-ResNet backbone: only the whole backbone can be cached
+            prefixLayers = {'xf': ['features']}
+        else:
+            prefixLayers = {'x3': ['conv1', 'bn1', 'layer1', 'layer2', 'layer3'],
+                            'xf': ['conv1', 'bn1', 'layer1', 'layer2', 'layer3', 'layer4'] }
+        stage = None
+        for s in prefixLayers:
+            bFrozen = all(par.requires_grad==False for layerName in prefixLayers[s] for par in getattr(model, layerName).parameters())
+            if bFrozen:
+                stage = s
+        return stage
+
+    #Same as self.model(images), but the frozen prefix of the network is computed only once for the same images tensor
+    #(i.e., once per sample in eftAllInDB), and only the trainable suffix is run in the following iterations
+    #With the CPU profile, the network runs in bf16 autocast with channels_last inputs. Outputs are always fp32
+    def runModel(self, images):
+        with autocastContext(self.bCPUProfile):
+            if self.prefixStage is None:
+                outputs = self.model(toChannelsLast(images) if self.bCPUProfile else images)
+            else:
+                if self.prefixCache is None or self.prefixCache[0] is not images:
+                    model = self.model.module if isinstance(self.model, torch.nn.DataParallel) else self.model
+                    with torch.no_grad():
+                        feature = model.forward_prefix(toChannelsLast(images) if self.bCPUProfile else images, self.prefixStage)
+                    self.prefixCache = (images, feature)
+
+                outputs = self.model(self.prefixCache[1], stage=self.prefixStage)
+
+        return tuple(out.float() for out in outputs)
+
+
+    def keypoint_loss_perSample(self, pred_keypoints_2d, gt_keypoints_2d, openpose_weight, gt_weight):
+        """ Same as keypoint_loss, but returns a loss per sample (N,)
+        """
+        conf = gt_keypoints_2d[:, :, -1].unsqueeze(-1).clone()
+        conf[:, :25] *= openpose_weight
+        conf[:, 25:] *= gt_weight
+        loss = (conf * self.criterion_keypoints(pred_keypoints_2d, gt_keypoints_2d[:, :, :-1])).mean(dim=(1,2))
+        return loss
+
+    def legOrientation_loss(self, pred_keypoints_2d, gt_keypoints_2d):
+        """ 1 - cos(angle) between GT and predicted 2D lower leg (knee to ankle) orientations, for each leg
+        Legs shorter than LENGTH_THRESHOLD in GT are ignored
+        Returns a loss per sample (N,)
+        """
+        LENGTH_THRESHOLD = 0.0089 #1/112.0     #at least it should be 5 pixel
+
+        loss_legOri = torch.zeros(pred_keypoints_2d.shape[0], device=self.device)
+        for ankle, knee in [ [5+25, 4+25], [0+25, 1+25] ]:        #Left lower leg, right lower leg
+            gt_boneOri = gt_keypoints_2d[:,ankle,:2]  -  gt_keypoints_2d[:,knee,:2]        #(N,2)
+            gt_boneLeng = torch.norm(gt_boneOri, dim=1)      #(N)
+            gt_boneOri = gt_boneOri / gt_boneLeng.clamp(min=1e-12).unsqueeze(1)
+
+            pred_boneOri = pred_keypoints_2d[:,ankle,:2]  -  pred_keypoints_2d[:,knee,:2]
+            pred_boneOri = pred_boneOri / torch.norm(pred_boneOri, dim=1).clamp(min=1e-12).unsqueeze(1)
+
+            legValidity = gt_keypoints_2d[:,ankle, 2]  * gt_keypoints_2d[:,knee, 2] * (gt_boneLeng>LENGTH_THRESHOLD).float()
+            loss_legOri = loss_legOri + legValidity * (1 - (gt_boneOri * pred_boneOri).sum(dim=1))
+
+        return loss_legOri
+
+    #Rows with valid 3D hand joints. keypoint_3d_hand_loss_panopticDB only uses the knuckles, and is zero for the other rows
+    def getHandRows(self, gt_lhand_3d, gt_rhand_3d):
+        knuckles = [1, 5, 9, 13, 17]
+        bValid = (gt_lhand_3d[:, knuckles, -1]>0).any(dim=1) | (gt_rhand_3d[:, knuckles, -1]>0).any(dim=1)
+        return torch.nonzero(bValid, as_tuple=False).view(-1)
+
+    #EFT loss, computed for each sample separately. All outputs are per-sample vectors (N,)
+    #So the loss of a batch is the same as running each sample alone
+    #run_eft_step_wHand uses bDisableHip=True, bDisableFoot=False, and the hand joints (pred_rhand_3d, pred_lhand_3d, gt_rhand_3d, gt_lhand_3d)
+    def computeEFTLoss(self, pred_keypoints_2d, gt_keypoints_2d, pred_joints_3d, gt_joints, has_pose_3d, pred_betas, pred_camera,
+                        bDisableHip=None, bDisableFoot=True, pred_rhand_3d=None, pred_lhand_3d=None, gt_rhand_3d=None, gt_lhand_3d=None, handRows=None):
+
+        if bDisableHip is None:
+            bDisableHip = self.options.eft_withHip2D==False
+
+        #Hips and feet are disabled on a copy. The L-BFGS closure evaluates the loss again with the same gt_keypoints_2d
+        gt_keypoints_2d = gt_keypoints_2d.clone()
+
+        if True:    #Ignore hips and hip centers, foot
+
+            #Disable Hips by default
+            if bDisableHip:
+                gt_keypoints_2d[:,2+25,2]=0
+                gt_keypoints_2d[:,3+25,2]=0
+                gt_keypoints_2d[:,14+25,2]=0
+
+            # #Compute angle knee to ankle orientation
+            loss_legOri = self.legOrientation_loss(pred_keypoints_2d, gt_keypoints_2d)
+
+            #Disable Foots
+            if bDisableFoot:
+                gt_keypoints_2d[:,5+25,2]=0     #Left foot
+                gt_keypoints_2d[:,0+25,2]=0     #Right foot
+
+        # Compute 2D reprojection loss for the keypoints
+        loss_keypoints_2d = self.keypoint_loss_perSample(pred_keypoints_2d, gt_keypoints_2d,
+                                            self.options.openpose_train_weight,
+                                            self.options.gt_train_weight)
+
+        # # Compute 3D keypoint loss
+        if self.options.bExemplarWith3DSkel:
+            # loss_keypoints_3d = self.keypoint_3d_loss(pred_joints_3d, gt_joints, has_pose_3d)
+            loss_keypoints_3d = self.keypoint_3d_loss_panopticDB(pred_joints_3d, gt_joints, has_pose_3d)
+        else:
+            loss_keypoints_3d = torch.zeros_like(loss_keypoints_2d)
+       
+        # loss_keypoints_3d = self.keypoint_3d_loss_modelSkel(pred_joints_3d, gt_model_joints[:,25:,:], has_pose_3d)
+
+        loss_regr_betas_noReject = torch.mean(pred_betas**2, dim=1)
+
+        #Prevent bending knee?
+        # red_rotmat[0,6,:,:] - 
+
+        loss = self.options.keypoint_loss_weight * loss_keypoints_2d  + \
+                self.options.beta_loss_weight * loss_regr_betas_noReject  + \
+                (torch.exp(-pred_camera[:,0]*10)) ** 2
+        
+        if self.options.bExemplarWith3DSkel:
+            loss = loss + self.options.keypoint_loss_weight * loss_keypoints_3d
+            # loss = loss_keypoints_3d        #TODO: DEBUGGIN
+
+        ##### Compute 3D hand joint loss especially for panoptic stuido
+        #If handRows is given (see getHandRows), only for those rows. The hand loss of the other rows is zero
+        if pred_rhand_3d is not None and handRows is None:
+            loss_keypoints_3d_hand = self.keypoint_3d_hand_loss_panopticDB(pred_rhand_3d, pred_lhand_3d, gt_lhand_3d, gt_rhand_3d)
+            loss = loss + self.options.keypoint_loss_weight * loss_keypoints_3d_hand
+        elif pred_rhand_3d is not None and len(handRows)>0:
+            loss_keypoints_3d_hand = self.keypoint_3d_hand_loss_panopticDB(pred_rhand_3d[handRows], pred_lhand_3d[handRows], gt_lhand_3d[handRows], gt_rhand_3d[handRows])
+            loss = loss.index_add(0, handRows, self.options.keypoint_loss_weight * loss_keypoints_3d_hand)
+
+        if True:        #Leg orientation loss
+            loss = loss + 0.005*loss_legOri
+        #Put zeor preference on knees
+        #Disabled. Not working
+        # if self.options.bUseKneePrior:
+        #     eyemat = torch.eye(3,3).repeat(pred_rotmat.shape[0],1).view((-1,3,3)).to(self.device)
+        #     kneePrior = ((pred_rotmat[:,5,:,:]  - eyemat)**2).mean() + ((pred_rotmat[:,4,:,:]  - eyemat)**2).mean()
+        #     loss = loss + kneePrior*0.001
 
-            if isinstance(module, torch.nn.modules.batchnorm._BatchNorm):
-                # print(module)
-                module.eval()
-                for m in module.parameters():
-                    m.requires_grad =False
-            if isinstance(module, nn.Dropout):
-                # print(module)
-                module.eval()
-                for m in module.parameters():
-                    m.requires_grad =False
+        # print(loss_regr_betas)
+        loss = loss * 60
 
+        return loss, loss_keypoints_2d, loss_keypoints_3d, loss_regr_betas_noReject
 
 
     #Given a batch, run HMR training
     #Assumes a single sample in the batch, requiring batch norm disabled
     #Loss is a bit different from original HMR training
-    def run_eft_step(self, input_batch, iterIdx=0):
+    #If bUpdate==False, only compute the outputs and losses without updating the network
+    def run_eft_step(self, input_batch, iterIdx=0, bUpdate=True):
 
         self.model.train()
 
@@ -270,7 +477,9 @@ class EFTFitter(Trainer):
         #     print(gt_keypoints_2d_orig[0,19:25])
 
         # Feed images in the network to predict camera and SMPL parameters
-        pred_rotmat, pred_betas, pred_camera = self.model(images)
+        self.stageTimer.lap('loop')
+        pred_rotmat, pred_betas, pred_camera = self.runModel(images)
+        self.stageTimer.lap('forward')
 
         pred_output = self.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False)
         pred_vertices = pred_output.vertices
@@ -286,101 +495,24 @@ class EFTFitter(Trainer):
       
         # weakProjection_gpu################
         pred_keypoints_2d = weakProjection_gpu(pred_joints_3d, pred_camera[:,0], pred_camera[:,1:] )           #N, 49, 2
+        self.stageTimer.lap('smpl')
 
-        if True:    #Ignore hips and hip centers, foot
-            LENGTH_THRESHOLD = 0.0089 #1/112.0     #at least it should be 5 pixel
-
-            #Disable Hips by default
-            if self.options.eft_withHip2D==False:     
-                gt_keypoints_2d[:,2+25,2]=0
-                gt_keypoints_2d[:,3+25,2]=0
-                gt_keypoints_2d[:,14+25,2]=0
-
-            # #Compute angle knee to ankle orientation
-            gt_boneOri_leftLeg = gt_keypoints_2d[:,5+25,:2]  -  gt_keypoints_2d[:,4+25,:2]             #Left lower leg orientation     #(N,2)
-            gt_boneOri_leftLeg, leftLegLeng = normalize_2dvector(gt_boneOri_leftLeg)
-
-            if leftLegLeng>LENGTH_THRESHOLD:
-                leftLegValidity = gt_keypoints_2d[:,5+25, 2]  * gt_keypoints_2d[:,4+25, 2]
-                pred_boneOri_leftLeg = pred_keypoints_2d[:,5+25,:2]  -  pred_keypoints_2d[:,4+25,:2]
-                pred_boneOri_leftLeg, _ = normalize_2dvector(pred_boneOri_leftLeg)
-                loss_legOri_left  = torch.ones(1).to(self.device) - torch.dot(gt_boneOri_leftLeg.view(-1),pred_boneOri_leftLeg.view(-1))
-            else:
-                loss_legOri_left = torch.zeros(1).to(self.device)
-                leftLegValidity  = torch.zeros(1).to(self.device)
-
-            gt_boneOri_rightLeg = gt_keypoints_2d[:,0+25,:2] -  gt_keypoints_2d[:,1+25,:2]            #Right lower leg orientation
-            gt_boneOri_rightLeg, rightLegLeng = normalize_2dvector(gt_boneOri_rightLeg)
-            if rightLegLeng>LENGTH_THRESHOLD:
-
-                rightLegValidity = gt_keypoints_2d[:,0+25, 2]  * gt_keypoints_2d[:,1+25, 2]
-                pred_boneOri_rightLeg = pred_keypoints_2d[:,0+25,:2]  -  pred_keypoints_2d[:,1+25,:2]
-                pred_boneOri_rightLeg, _ = normalize_2dvector(pred_boneOri_rightLeg)
-                loss_legOri_right  = torch.ones(1).to(self.device) - torch.dot(gt_boneOri_rightLeg.view(-1),pred_boneOri_rightLeg.view(-1))
-            else:
-                loss_legOri_right = torch.zeros(1).to(self.device)
-                rightLegValidity = torch.zeros(1).to(self.device)
-            # print("leftLegLeng: {}, rightLegLeng{}".format(leftLegLeng,rightLegLeng ))
-            loss_legOri = leftLegValidity* loss_legOri_left + rightLegValidity* loss_legOri_right
-
-            # loss_legOri = torch.zeros(1).to(self.device)
-            # if leftLegValidity.item():
-            #     loss_legOri = loss_legOri + (pred_boneOri_leftLeg).mean()
-            # if rightLegValidity.item():
-            #     loss_legOri = loss_legOri + self.criterion_regr(gt_boneOri_rightLeg, pred_boneOri_rightLeg)
-            # print(loss_legOri)
-
-            #Disable Foots
-            gt_keypoints_2d[:,5+25,2]=0     #Left foot
-            gt_keypoints_2d[:,0+25,2]=0     #Right foot
-
-        # Compute 2D reprojection loss for the keypoints
-        loss_keypoints_2d = self.keypoint_loss(pred_keypoints_2d, gt_keypoints_2d,
-                                            self.options.openpose_train_weight,
-                                            self.options.gt_train_weight)
-
-        # # Compute 3D keypoint loss
-        if self.options.bExemplarWith3DSkel:
-            # loss_keypoints_3d = self.keypoint_3d_loss(pred_joints_3d, gt_joints, has_pose_3d)
-            loss_keypoints_3d = self.keypoint_3d_loss_panopticDB(pred_joints_3d, gt_joints, has_pose_3d)
-        else:
-            loss_keypoints_3d = torch.tensor(0)
-       
-        # loss_keypoints_3d = self.keypoint_3d_loss_modelSkel(pred_joints_3d, gt_model_joints[:,25:,:], has_pose_3d)
-
-        loss_regr_betas_noReject = torch.mean(pred_betas**2)
-
-        #Prevent bending knee?
-        # red_rotmat[0,6,:,:] - 
-
-        loss = self.options.keypoint_loss_weight * loss_keypoints_2d  + \
-                self.options.beta_loss_weight * loss_regr_betas_noReject  + \
-                ((torch.exp(-pred_camera[:,0]*10)) ** 2 ).mean() 
-        
-        if self.options.bExemplarWith3DSkel:
-            loss = loss + self.options.keypoint_loss_weight * loss_keypoints_3d
-            # loss = loss_keypoints_3d        #TODO: DEBUGGIN
-
-        if True:        #Leg orientation loss
-            loss = loss + 0.005*loss_legOri
-        #Put zeor preference on knees
-        #Disabled. Not working
-        # if self.options.bUseKneePrior:
-        #     eyemat = torch.eye(3,3).repeat(pred_rotmat.shape[0],1).view((-1,3,3)).to(self.device)
-        #     kneePrior = ((pred_rotmat[:,5,:,:]  - eyemat)**2).mean() + ((pred_rotmat[:,4,:,:]  - eyemat)**2).mean()
-        #     loss = loss + kneePrior*0.001
-
-        # print(loss_regr_betas)
-        loss *= 60
+        loss, loss_keypoints_2d, loss_keypoints_3d, loss_regr_betas_noReject = self.computeEFTLoss(pred_keypoints_2d, gt_keypoints_2d, pred_joints_3d, gt_joints, has_pose_3d, pred_betas, pred_camera)
+        self.stageTimer.lap('loss')
         # print("loss2D: {}, loss3D: {}".format( self.options.keypoint_loss_weight * loss_keypoints_2d,self.options.keypoint_loss_weight * loss_keypoints_3d  )  )
 
         # Do backprop
-        self.optimizer.zero_grad()
-        loss.backward()
+        if bUpdate and self.bLBFGS:     #L-BFGS evaluates the loss again in the line search. The first evaluation is the loss above
+            lossAtStart = [loss.sum()]
+            self.optimizer.step(lambda: self.eftClosure(images, gt_keypoints_2d, gt_joints, has_pose_3d, lossAtStart))
+        elif bUpdate:
+            self.optimizer.zero_grad()
+            loss.sum().backward()       #Per-sample losses. Samples are independent
 
-        # g_timer.tic()
-        self.optimizer.step()
-        # g_timer.toc(bPrint =True)
+            # g_timer.tic()
+            self.optimizer.step()
+            # g_timer.toc(bPrint =True)
+        self.stageTimer.lap('backward')
 
         # Pack output arguments for tensorboard logging
         output = {'pred_vertices': 0, #pred_vertices.detach(),
@@ -416,11 +548,11 @@ class EFTFitter(Trainer):
         output['keypoint2d_cropped'] = input_batch['keypoints'].detach().cpu().numpy()
 
 
-        losses = {'loss': loss.detach().item(),
-                  'loss_keypoints': loss_keypoints_2d.detach().item(),
-                  'loss_keypoints_3d': loss_keypoints_3d.detach().item(),
+        losses = {'loss': loss.detach().mean().item(),
+                  'loss_keypoints': loss_keypoints_2d.detach().mean().item(),
+                  'loss_keypoints_3d': loss_keypoints_3d.detach().mean().item(),
                 #   'loss_regr_pose': loss_regr_pose.detach().item(),
-                  'loss_regr_betas': loss_regr_betas_noReject.detach().item()}
+                  'loss_regr_betas': loss_regr_betas_noReject.detach().mean().item()}
                 #   'loss_shape': loss_shape.detach().item()}
 
 
@@ -522,21 +654,153 @@ class EFTFitter(Trainer):
             joint_mapper_h36m = constants.H36M_TO_J17 if dataset_name == 'mpi-inf-3dhp' else constants.H36M_TO_J14
 
             r_error = reconstruction_error_fromMesh(J_regressor_batch, joint_mapper_h36m, pred_vertices, gt_vertices)
+            mpjpe = mpjpe_fromMesh(J_regressor_batch, joint_mapper_h36m, pred_vertices, gt_vertices)
 
             # print("r_error:{}".format(r_error[0]*1000) )
 
             losses['r_error'] = r_error[0]*1000
+            losses['mpjpe'] = mpjpe[0]*1000
         else:
             losses['r_error'] = 0
+            losses['mpjpe'] = 0
 
+        self.stageTimer.lap('output')
         return output, losses
 
        # #For all sample in the current trainingDB
   
+    #Closure of L-BFGS for run_eft_step: loss and gradients at the current weights
+    #lossAtStart: list with the loss already computed at the current weights, used for the first call
+    def eftClosure(self, images, gt_keypoints_2d, gt_joints, has_pose_3d, lossAtStart):
+        self.optimizer.zero_grad()
+        if len(lossAtStart)>0:
+            loss = lossAtStart.pop()
+        else:
+            pred_rotmat, pred_betas, pred_camera = self.runModel(images)
+            pred_joints_3d = self.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False).joints
+            pred_keypoints_2d = weakProjection_gpu(pred_joints_3d, pred_camera[:,0], pred_camera[:,1:] )
+            loss = self.computeEFTLoss(pred_keypoints_2d, gt_keypoints_2d, pred_joints_3d, gt_joints, has_pose_3d, pred_betas, pred_camera)[0].sum()
+        loss.backward()
+        return loss
+
+    #Batch version of run_eft_step. Each sample is fine-tuned by its own weights in multiModel (MultiExemplarModel)
+    #Output and losses are lists, where each element has the same format as the output of run_eft_step for a single sample
+    #With bUseHand3D, same as run_eft_step_wHand instead. The hand loss is computed only for the rows with valid hands (see getHandRows)
+    def run_eft_step_batch(self, input_batch, multiModel):
+
+        self.model.train()
+        self.exemplerTrainingMode()
+
+        # Get data from the batch
+        images = input_batch['img'] # input image
+        gt_keypoints_2d = input_batch['keypoints'].clone()# 2D keypoints           #[N,49,3]
+        gt_joints = input_batch['pose_3d'] # 3D pose                        #[N,24,4]
+        has_pose_3d = input_batch['has_pose_3d'].byte()==1 # flag that indicates whether 3D pose is valid
+        indices = input_batch['sample_index'] # index of example inside its dataset
+        batch_size = images.shape[0]
+
+        is_flipped = input_batch['is_flipped'] # flag that indicates whether image was flipped during data augmentation
+        rot_angle = input_batch['rot_angle'] # rotation angle used for data augmentation
+        dataset_name = input_batch['dataset_name'] # name of the dataset the image comes from
+
+        index_cpu = indices.cpu()
+        if self.options.bExemplar_dataLoaderStart>=0:
+            index_cpu +=self.options.bExemplar_dataLoaderStart      #Bug fixed.
+
+        #Check existing SPIN fits
+        opt_pose, opt_betas, opt_validity = self.fits_dict[(dataset_name, index_cpu, rot_angle.cpu(), is_flipped.cpu())]
+
+        # Feed images in the network to predict camera and SMPL parameters. Each sample uses its own weights
+        if 'img_feature' in input_batch:     #Frozen prefix has been computed already
+            pred_rotmat, pred_betas, pred_camera = multiModel(input_batch['img_feature'], stage=input_batch['img_feature_stage'])
+        else:
+            pred_rotmat, pred_betas, pred_camera = multiModel(images)
+
+        pred_output = self.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False)
+        pred_joints_3d = pred_output.joints
+        pred_keypoints_2d = weakProjection_gpu(pred_joints_3d, pred_camera[:,0], pred_camera[:,1:] )           #N, 49, 2
+
+        #Loss is computed for each sample separately, exactly as run_eft_step (or run_eft_step_wHand) does
+        if self.options.bUseHand3D:     #Hips are always ignored, and feet are used
+            gt_lhand_3d = input_batch['lhand_3d']
+            gt_rhand_3d = input_batch['rhand_3d']
+            loss, loss_keypoints_2d, loss_keypoints_3d, loss_regr_betas_noReject = self.computeEFTLoss(pred_keypoints_2d, gt_keypoints_2d, pred_joints_3d, gt_joints, has_pose_3d, pred_betas, pred_camera,
+                                                                                        bDisableHip=True, bDisableFoot=False,
+                                                                                        pred_rhand_3d=pred_output.right_hand_joints, pred_lhand_3d=pred_output.left_hand_joints, gt_rhand_3d=gt_rhand_3d, gt_lhand_3d=gt_lhand_3d,
+                                                                                        handRows=self.getHandRows(gt_lhand_3d, gt_rhand_3d))
+        else:
+            loss, loss_keypoints_2d, loss_keypoints_3d, loss_regr_betas_noReject = self.computeEFTLoss(pred_keypoints_2d, gt_keypoints_2d, pred_joints_3d, gt_joints, has_pose_3d, pred_betas, pred_camera)
+
+        # Do backprop. Each sample only depends on its own weights, so this gives per-sample gradients
+        multiModel.optimizer.zero_grad()
+        loss.sum().backward()
+        multiModel.optimizer.step()
+
+        losses_cpu = [ l.detach().cpu().numpy() for l in [loss, loss_keypoints_2d, loss_keypoints_3d, loss_regr_betas_noReject] ]
+        lossesList = []
+        for b in range(batch_size):
+            lossesList.append({'loss': losses_cpu[0][b].item(),
+                            'loss_keypoints': losses_cpu[1][b].item(),
+                            'loss_keypoints_3d': losses_cpu[2][b].item(),
+                            'loss_regr_betas': losses_cpu[3][b].item()})
+
+        pred_rotmat = pred_rotmat.detach().cpu().numpy()
+        pred_betas = pred_betas.detach().cpu().numpy()
+        pred_camera = pred_camera.detach().cpu().numpy()
+        opt_pose = opt_pose.detach().cpu().numpy()
+        opt_betas = opt_betas.detach().cpu().numpy()
+        sampleIdx = input_batch['sample_index'].detach().cpu().numpy()
+        scale = input_batch['scale'].detach().cpu().numpy()
+        center = input_batch['center'].detach().cpu().numpy()
+        keypoint2d = input_batch['keypoints_original'].detach().cpu().numpy()
+        keypoint2d_cropped = input_batch['keypoints'].detach().cpu().numpy()
+        if 'annotId' in input_batch.keys():
+            annotId = input_batch['annotId'].detach().cpu().numpy()
+        if self.options.bUseHand3D:
+            gt_lhand_3d = gt_lhand_3d.detach().cpu().numpy()
+            gt_rhand_3d = gt_rhand_3d.detach().cpu().numpy()
+
+        #Save result
+        outputList = []
+        for b in range(batch_size):
+            output={}
+            output['pred_pose_rotmat'] = pred_rotmat[b:b+1]
+            output['pred_shape'] = pred_betas[b:b+1]
+            output['pred_camera'] = pred_camera[b:b+1]
+
+            #If there exists SPIN fits, save that for comparison later
+            output['opt_pose'] = opt_pose[b:b+1]
+            output['opt_beta'] = opt_betas[b:b+1]
+
+            output['sampleIdx'] = sampleIdx[b:b+1]     #To use loader directly
+            output['imageName'] = input_batch['imgname'][b:b+1]
+            output['scale'] = scale[b:b+1]
+            output['center'] = center[b:b+1]
+
+            if 'annotId' in input_batch.keys():
+                output['annotId'] = annotId[b:b+1]
+
+            if 'subjectId' in input_batch.keys():
+                if input_batch['subjectId'][b]!="":
+                    output['subjectId'] = input_batch['subjectId'][b].item()
+
+            #To save new db file
+            output['keypoint2d'] = keypoint2d[b:b+1]
+            output['keypoint2d_cropped'] = keypoint2d_cropped[b:b+1]
+
+            #Save GT gt_lhand_3d, gt_rhand_3d
+            if self.options.bUseHand3D:
+                output['gt_lhand_3d'] = gt_lhand_3d[b:b+1]
+                output['gt_rhand_3d'] = gt_rhand_3d[b:b+1]
+            outputList.append(output)
+
+        return outputList, lossesList
+
+
     #Given a batch, run HMR training
     #Assumes a single sample in the batch, requiring batch norm disabled
     #Loss is a bit different from original HMR training
-    def run_eft_step_wHand(self, input_batch):
+    def run_eft_step_wHand(self, input_batch, bUpdate=True):
 
         self.model.train()
 
@@ -594,7 +858,7 @@ class EFTFitter(Trainer):
         #     print(gt_keypoints_2d_orig[0,19:25])
 
         # Feed images in the network to predict camera and SMPL parameters
-        pred_rotmat, pred_betas, pred_camera = self.model(images)
+        pred_rotmat, pred_betas, pred_camera = self.runModel(images)
 
         pred_output = self.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False)
         pred_vertices = pred_output.vertices
@@ -615,105 +879,24 @@ class EFTFitter(Trainer):
         # weakProjection_gpu################
         pred_keypoints_2d = weakProjection_gpu(pred_joints_3d, pred_camera[:,0], pred_camera[:,1:] )           #N, 49, 2
 
-        if True:    #Ignore hips and hip centers, foot
-            LENGTH_THRESHOLD = 0.0089 #1/112.0     #at least it should be 5 pixel
-
-            #Disable parts
-            if True:
-                gt_keypoints_2d[:,2+25,2]=0
-                gt_keypoints_2d[:,3+25,2]=0
-                gt_keypoints_2d[:,14+25,2]=0
-
-            # #Compute angle knee to ankle orientation
-            gt_boneOri_leftLeg = gt_keypoints_2d[:,5+25,:2]  -  gt_keypoints_2d[:,4+25,:2]             #Left lower leg orientation     #(N,2)
-            gt_boneOri_leftLeg, leftLegLeng = normalize_2dvector(gt_boneOri_leftLeg)
-
-            if leftLegLeng>LENGTH_THRESHOLD:
-                leftLegValidity = gt_keypoints_2d[:,5+25, 2]  * gt_keypoints_2d[:,4+25, 2]
-                pred_boneOri_leftLeg = pred_keypoints_2d[:,5+25,:2]  -  pred_keypoints_2d[:,4+25,:2]
-                pred_boneOri_leftLeg, _ = normalize_2dvector(pred_boneOri_leftLeg)
-                loss_legOri_left  = torch.ones(1).to(self.device) - torch.dot(gt_boneOri_leftLeg.view(-1),pred_boneOri_leftLeg.view(-1))
-            else:
-                loss_legOri_left = torch.zeros(1).to(self.device)
-                leftLegValidity  = torch.zeros(1).to(self.device)
-
-            gt_boneOri_rightLeg = gt_keypoints_2d[:,0+25,:2] -  gt_keypoints_2d[:,1+25,:2]            #Right lower leg orientation
-            gt_boneOri_rightLeg, rightLegLeng = normalize_2dvector(gt_boneOri_rightLeg)
-            if rightLegLeng>LENGTH_THRESHOLD:
-
-                rightLegValidity = gt_keypoints_2d[:,0+25, 2]  * gt_keypoints_2d[:,1+25, 2]
-                pred_boneOri_rightLeg = pred_keypoints_2d[:,0+25,:2]  -  pred_keypoints_2d[:,1+25,:2]
-                pred_boneOri_rightLeg, _ = normalize_2dvector(pred_boneOri_rightLeg)
-                loss_legOri_right  = torch.ones(1).to(self.device) - torch.dot(gt_boneOri_rightLeg.view(-1),pred_boneOri_rightLeg.view(-1))
-            else:
-                loss_legOri_right = torch.zeros(1).to(self.device)
-                rightLegValidity = torch.zeros(1).to(self.device)
-            # print("leftLegLeng: {}, rightLegLeng{}".format(leftLegLeng,rightLegLeng ))
-            loss_legOri = leftLegValidity* loss_legOri_left + rightLegValidity* loss_legOri_right
-
-            # loss_legOri = torch.zeros(1).to(self.device)
-            # if leftLegValidity.item():
-            #     loss_legOri = loss_legOri + (pred_boneOri_leftLeg).mean()
-            # if rightLegValidity.item():
-            #     loss_legOri = loss_legOri + self.criterion_regr(gt_boneOri_rightLeg, pred_boneOri_rightLeg)
-            # print(loss_legOri)
-
-            #Disable Foots
-            # gt_keypoints_2d[:,5+25,2]=0     #Left foot
-            # gt_keypoints_2d[:,0+25,2]=0     #Right foot
-
-       
-        # Compute 2D reprojection loss for the keypoints
-        loss_keypoints_2d = self.keypoint_loss(pred_keypoints_2d, gt_keypoints_2d,
-                                            self.options.openpose_train_weight,
-                                            self.options.gt_train_weight)
-
-        # # Compute 3D keypoint loss
-        # loss_keypoints_3d = self.keypoint_3d_loss(pred_joints_3d, gt_joints, has_pose_3d)
-        loss_keypoints_3d = self.keypoint_3d_loss_panopticDB(pred_joints_3d, gt_joints, has_pose_3d)
-        
-        # # loss_keypoints_3d = self.keypoint_3d_loss_modelSkel(pred_joints_3d, gt_model_joints[:,25:,:], has_pose_3d)
-
-        loss_regr_betas_noReject = torch.mean(pred_betas**2)
-
-        #Prevent bending knee?
-        # red_rotmat[0,6,:,:] - 
-
-        loss = self.options.keypoint_loss_weight * loss_keypoints_2d  + \
-                self.options.beta_loss_weight * loss_regr_betas_noReject  + \
-                ((torch.exp(-pred_camera[:,0]*10)) ** 2 ).mean() 
-        
-        if self.options.bExemplarWith3DSkel:
-            loss = loss + self.options.keypoint_loss_weight * loss_keypoints_3d
-            # loss = loss_keypoints_3d        #TODO: DEBUGGIN
-
-
-        ##### Compute 3D hand joint loss especially for panoptic stuido
+        #Hips are always ignored, and feet are used
         if self.options.bUseHand3D:
-            
-            loss_keypoints_3d_hand = self.keypoint_3d_hand_loss_panopticDB(pred_right_hand_joints_3d, pred_left_hand_joints_3d, gt_lhand_3d, gt_rhand_3d)
-            loss = loss + self.options.keypoint_loss_weight * loss_keypoints_3d_hand
-
-        if True:        #Leg orientation loss
-            loss = loss + 0.005*loss_legOri
-        #Put zeor preference on knees
-        #Disabled. Not working
-        # if self.options.bUseKneePrior:
-        #     eyemat = torch.eye(3,3).repeat(pred_rotmat.shape[0],1).view((-1,3,3)).to(self.device)
-        #     kneePrior = ((pred_rotmat[:,5,:,:]  - eyemat)**2).mean() + ((pred_rotmat[:,4,:,:]  - eyemat)**2).mean()
-        #     loss = loss + kneePrior*0.001
-
-        # print(loss_regr_betas)
-        loss *= 60
+            handJoints = {'pred_rhand_3d': pred_right_hand_joints_3d, 'pred_lhand_3d': pred_left_hand_joints_3d, 'gt_rhand_3d': gt_rhand_3d, 'gt_lhand_3d': gt_lhand_3d,
+                          'handRows': self.getHandRows(gt_lhand_3d, gt_rhand_3d)}
+        else:
+            handJoints = {}
+        loss, loss_keypoints_2d, loss_keypoints_3d, loss_regr_betas_noReject = self.computeEFTLoss(pred_keypoints_2d, gt_keypoints_2d, pred_joints_3d, gt_joints, has_pose_3d, pred_betas, pred_camera,
+                                                                                    bDisableHip=True, bDisableFoot=False, **handJoints)
         # print("loss2D: {}, loss3D: {}".format( self.options.keypoint_loss_weight * loss_keypoints_2d,self.options.keypoint_loss_weight * loss_keypoints_3d  )  )
 
         # Do backprop
-        self.optimizer.zero_grad()
-        loss.backward()
+        if bUpdate:
+            self.optimizer.zero_grad()
+            loss.sum().backward()       #Per-sample losses. Samples are independent
 
-        # g_timer.tic()
-        self.optimizer.step()
-        # g_timer.toc(bPrint =True)
+            # g_timer.tic()
+            self.optimizer.step()
+            # g_timer.toc(bPrint =True)
 
         # Pack output arguments for tensorboard logging
         output = {'pred_vertices': 0, #pred_vertices.detach(),
@@ -753,11 +936,11 @@ class EFTFitter(Trainer):
             output['gt_lhand_3d'] = gt_lhand_3d.detach().cpu().numpy()
             output['gt_rhand_3d'] = gt_rhand_3d.detach().cpu().numpy()
 
-        losses = {'loss': loss.detach().item(),
-                  'loss_keypoints': loss_keypoints_2d.detach().item(),
-                  'loss_keypoints_3d': loss_keypoints_3d.detach().item(),
+        losses = {'loss': loss.detach().mean().item(),
+                  'loss_keypoints': loss_keypoints_2d.detach().mean().item(),
+                  'loss_keypoints_3d': loss_keypoints_3d.detach().mean().item(),
                 #   'loss_regr_pose': loss_regr_pose.detach().item(),
-                  'loss_regr_betas': loss_regr_betas_noReject.detach().item()}
+                  'loss_regr_betas': loss_regr_betas_noReject.detach().mean().item()}
                 #   'loss_shape': loss_shape.detach().item()}
 
 
@@ -1009,249 +1192,685 @@ class EFTFitter(Trainer):
         
         return output
 
-       # #For all sample in the current trainingDB
-  
-
-    #Run EFT
-    #Save output as seperate pkl files
-    def eftAllInDB(self, test_dataset_3dpw = None, test_dataset_h36m= None, bExportPKL = True):
+    #Batched version of run_smplify. Fit all samples of the batch at once with self.smplifyBatch
+    #Pose, shape, and camera are separate per sample and the SMPLify losses are summed over samples, so each sample is fitted as if it were alone
+    #If smplify_numSegments>1, the iterations are run in segments, and samples converged in a segment are dropped from the next ones (per-sample early-out)
+    #SMPLify does not keep its optimizer states between calls, so each segment fits the remaining samples again from the initial estimate,
+    #with the iterations of all segments so far. Each output is the same as run_smplify with numOfIteration iterations
+    #output: list of outputs per sample, in the same format as run_smplify
+    def run_smplify_batch(self, input_batch):
 
-        if config.bIsDevfair:
-            now = datetime.datetime.now()
-            # newName = '{:02d}-{:02d}-{}'.format(now.month, now.day, now.hour*3600 + now.minute*60 + now.second)
-            newName = '{:02d}-{:02d}'.format(now.month, now.day)
-            outputDir = newName + '_' + self.options.db_set + '_' + self.options.name
-        else:
-            now = datetime.datetime.now()
-            # outputDir = self.options.db_set
-            newName = 'test_{:02d}-{:02d}-{}'.format(now.month, now.day, now.hour*3600 + now.minute*60 + now.second)
-            outputDir = newName + '_' + self.options.db_set + '_' + self.options.name
+        self.model.eval()
 
-        exemplarOutputPath = os.path.join(config.EXEMPLAR_OUTPUT_ROOT , outputDir)
-        if not os.path.exists(exemplarOutputPath):
-            os.mkdir(exemplarOutputPath)
+        images = input_batch['img'] # input image
+        gt_keypoints_2d_orig = input_batch['keypoints'].clone()     #[N,49,3]. Weak perspective projection version
+        indices = input_batch['sample_index'] # index of example inside its dataset
+        batch_size = images.shape[0]
 
-        """Training process."""
-        # Run training for num_epochs epochs
-        # Create new DataLoader every epoch and (possibly) resume from an arbitrary step inside an epoch
-        train_data_loader = CheckpointDataLoader(self.train_ds,checkpoint=self.checkpoint,
-                                                    batch_size=1,       #Always o1
-                                                    num_workers=self.options.num_workers,
-                                                    pin_memory=self.options.pin_memory,
-                                                    shuffle=False)      #No Shuffle      
+        is_flipped = input_batch['is_flipped'] # flag that indicates whether image was flipped during data augmentation
+        rot_angle = input_batch['rot_angle'] # rotation angle used for data augmentation
+        dataset_name = input_batch['dataset_name'] # name of the dataset the image comes from
+
+        index_cpu = indices.cpu()
+        if self.options.bExemplar_dataLoaderStart>=0:
+            index_cpu +=self.options.bExemplar_dataLoaderStart
+
+        #Check existing SPIN fits
+        opt_pose, opt_betas, opt_validity = self.fits_dict[(dataset_name, index_cpu, rot_angle.cpu(), is_flipped.cpu())]
+
+        # Predict Initial Estimation via original model
+        with torch.no_grad():
+            init_pred_rotmat, init_pred_betas, init_pred_camera = self.model(images)
+
+        # Convert predicted rotation matrices to axis-angle
+        pred_rotmat_hom = torch.cat([init_pred_rotmat.detach().view(-1, 3, 3), torch.tensor([0,0,1], dtype=torch.float32,
+            device=self.device).view(1, 3, 1).expand(batch_size * 24, -1, -1)], dim=-1)
+        init_pred_pose = rotation_matrix_to_angle_axis(pred_rotmat_hom).contiguous().view(batch_size, -1)
+        # tgm.rotation_matrix_to_angle_axis returns NaN for 0 rotation, so manually hack it
+        init_pred_pose[torch.isnan(init_pred_pose)] = 0.0
+
+        cur_pose = init_pred_pose.detach().clone()
+        cur_betas = init_pred_betas.detach().clone()
+        cur_cam = init_pred_camera.detach().clone()
+        camera_center = 0.5 * self.options.img_res * torch.ones(batch_size, 2, device=self.device)
+        reprjec_loss = torch.zeros(batch_size, device=self.device)
+        numOfIteration = [0] * batch_size
+
+        totalIters = self.smplifyBatch.num_iters
+        numSegments = max(min(self.options.smplify_numSegments, totalIters), 1)
+        segmentEnds = [ totalIters*(s+1)//numSegments for s in range(numSegments)]       #Number of iterations at the end of each segment
+
+        g_timer.tic()
+        activeRows = list(range(batch_size))        #Samples not converged yet
+        for segIdx, numIters in enumerate(segmentEnds):
+            rows = torch.tensor(activeRows, dtype=torch.long, device=self.device)
+            self.smplifyBatch.num_iters = numIters
+            try:
+                _, _, new_opt_pose, new_opt_betas, new_opt_cam_t, new_reprjec_loss = self.smplifyBatch.run_withWeakProj(
+                                            init_pred_pose[rows], init_pred_betas[rows], init_pred_camera[rows],
+                                            camera_center[rows],
+                                            gt_keypoints_2d_orig[rows],
+                                            bDebugVis = False,
+                                            bboxInfo = None,
+                                            imagevis = None,
+                                            ablation_smplify_noCamOptFirst= self.options.ablation_smplify_noCamOptFirst,
+                                            ablation_smplify_noPrior = self.options.ablation_smplify_noPrior
+                                            )
+            finally:
+                self.smplifyBatch.num_iters = totalIters
+            new_reprjec_loss = new_reprjec_loss.detach().mean(dim=-1)
+
+            prev_loss = reprjec_loss[rows].tolist()
+            cur_pose[rows] = new_opt_pose.detach()
+            cur_betas[rows] = new_opt_betas.detach()
+            cur_cam[rows] = new_opt_cam_t.detach()
+            reprjec_loss[rows] = new_reprjec_loss
+
+            keep = []
+            for i, b in enumerate(activeRows):
+                numOfIteration[b] = numIters
+                curLoss = new_reprjec_loss[i].item()
+                if segIdx==0 or (prev_loss[i]>0 and prev_loss[i] - curLoss >= self.options.smplify_minRelImprovement * prev_loss[i]):
+                    keep.append(b)
+            activeRows = keep
+            if len(activeRows)==0:
+                break
+        g_timer.toc(average =True, bPrint=True,title="SMPLify whole process (batch)")
+
+        #Convert pose to rotmat
+        new_opt_rot_mats = batch_rodrigues(cur_pose.view(-1, 3)).view([batch_size, -1, 3, 3])
+
+        init_pred_rotmat = init_pred_rotmat.detach().cpu().numpy()
+        init_pred_betas = init_pred_betas.detach().cpu().numpy()
+        init_pred_camera = init_pred_camera.detach().cpu().numpy()
+        new_opt_rot_mats = new_opt_rot_mats.cpu().numpy()
+        cur_betas = cur_betas.cpu().numpy()
+        cur_cam = cur_cam.cpu().numpy()
+        reprjec_loss = reprjec_loss.cpu().numpy()
+        opt_pose = opt_pose.detach().cpu().numpy()
+        opt_betas = opt_betas.detach().cpu().numpy()
+        sampleIdx = input_batch['sample_index'].detach().cpu().numpy()
+        scale = input_batch['scale'].detach().cpu().numpy()
+        center = input_batch['center'].detach().cpu().numpy()
+        keypoint2d = input_batch['keypoints_original'].detach().cpu().numpy()
+        keypoint2d_cropped = input_batch['keypoints'].detach().cpu().numpy()
+        if 'annotId' in input_batch.keys():
+            annotId = input_batch['annotId'].detach().cpu().numpy()
+
+        #Save result
+        outputList = []
+        for b in range(batch_size):
+            output={}
+            output['pred_pose_rotmat_init'] = init_pred_rotmat[b:b+1]
+            output['pred_shape_init'] = init_pred_betas[b:b+1]
+            output['pred_camera_init'] = init_pred_camera[b:b+1]
+
+            output['pred_pose_rotmat'] = new_opt_rot_mats[b:b+1]
+            output['pred_shape'] = cur_betas[b:b+1]
+            output['pred_camera'] = cur_cam[b:b+1]
+
+            #If there exists SPIN fits, save that for comparison later
+            output['spin_pose'] = opt_pose[b:b+1]
+            output['spin_beta'] = opt_betas[b:b+1]
+
+            output['sampleIdx'] = sampleIdx[b:b+1]     #To use loader directly
+            output['imageName'] = input_batch['imgname'][b:b+1]
+            output['scale'] = scale[b:b+1]
+            output['center'] = center[b:b+1]
+
+            if 'annotId' in input_batch.keys():
+                output['annotId'] = annotId[b:b+1]
+
+            if 'subjectId' in input_batch.keys():
+                if input_batch['subjectId'][b]!="":
+                    output['subjectId'] = input_batch['subjectId'][b].item()
+
+            #To save new db file
+            output['keypoint2d'] = keypoint2d[b:b+1]
+            output['keypoint2d_cropped'] = keypoint2d_cropped[b:b+1]
+            output['loss_keypoints_2d'] = reprjec_loss[b:b+1]
+            output['numOfIteration'] = numOfIteration[b]
+            outputList.append(output)
+
+        return outputList
+
+       # #For all sample in the current trainingDB
+  
+
+    #Output folder for eftAllInDB. Created if not exists
+    def getExemplarOutputPath(self):
+
+        if self.options.eft_outputDir is not None:      #Fixed folder (e.g., shared by sharded workers)
+            os.makedirs(self.options.eft_outputDir, exist_ok=True)
+            return self.options.eft_outputDir
+
+        if config.bIsDevfair:
+            now = datetime.datetime.now()
+            # newName = '{:02d}-{:02d}-{}'.format(now.month, now.day, now.hour*3600 + now.minute*60 + now.second)
+            newName = '{:02d}-{:02d}'.format(now.month, now.day)
+            outputDir = newName + '_' + self.options.db_set + '_' + self.options.name
+        else:
+            now = datetime.datetime.now()
+            # outputDir = self.options.db_set
+            newName = 'test_{:02d}-{:02d}-{}'.format(now.month, now.day, now.hour*3600 + now.minute*60 + now.second)
+            outputDir = newName + '_' + self.options.db_set + '_' + self.options.name
+
+        exemplarOutputPath = os.path.join(config.EXEMPLAR_OUTPUT_ROOT , outputDir)
+        if not os.path.exists(exemplarOutputPath):
+            os.mkdir(exemplarOutputPath)
+
+        return exemplarOutputPath
+
+
+    #Outputs and losses of the original network (before EFT) for a sample, without changing the current weights
+    #Used with eft_sequenceWarmStart, where the current weights are fine-tuned on the previous frame
+    def runOriginalModel(self, batch):
+        with torch.no_grad():
+            currentWeights = [par.detach().clone() for par, _ in self.model_backup]
+        self.reloadModel()
+        if self.options.bUseHand3D:
+            output, losses = self.run_eft_step_wHand(batch, bUpdate=False)
+        else:
+            output, losses = self.run_eft_step(batch, bUpdate=False)
+        with torch.no_grad():
+            for (par, _), weight in zip(self.model_backup, currentWeights):
+                par.copy_(weight)
+        return output, losses
+
+    #Video DBs, where the folder of an image is a video. eft_sequenceWarmStart is only used for these DBs
+    def isVideoDB(self):
+        return '3dpw' in self.options.db_set or self.options.db_set =='panoptic' or "haggling" in self.options.db_set
+
+    #Sequence (video and person) of a sample for eft_sequenceWarmStart. None if unknown or not a video DB
+    #Frames of a sequence should be consecutive in the DB
+    def getSequenceKey(self, batch):
+        if self.isVideoDB()==False:     #e.g., a COCO or MPII image folder is not a sequence
+            return None
+        seqName = os.path.dirname(batch['imgname'][0])
+        if seqName == '':
+            return None
+        if 'subjectId' in batch.keys() and batch['subjectId'][0]!="":
+            return (seqName, int(batch['subjectId'][0]))
+        return (seqName,)
+
+    #Sequential data loader for eftAllInDB
+    #If sampleRange=(start,end) is given, only the samples in [start,end) of the training DB are loaded
+    def getExemplarDataLoader(self, batch_size=1, sampleRange=None):
+        dataset = self.train_ds
+        if sampleRange is not None:
+            dataset = torch.utils.data.Subset(self.train_ds, range(sampleRange[0], min(sampleRange[1], len(self.train_ds))))
+
+        return CheckpointDataLoader(dataset,checkpoint=self.checkpoint if sampleRange is None else None,
+                                        batch_size=batch_size,
+                                        num_workers=self.options.num_workers,
+                                        pin_memory=self.options.pin_memory,
+                                        shuffle=False,      #No Shuffle
+                                        drop_last=False)
+
+
+    #Panoptic outputs are saved per 100 samples. File name (sampleIdxSaveFrame) of a sample
+    @staticmethod
+    def getPanopticSaveFrame(sampleIdx):
+        return 100* (int(sampleIdx/100.0) + 1)
+
+    #Output pkl path of a sample. Panoptic outputs are saved per 100 samples
+    def getExemplarOutputFileName(self, sampleIdx, imgname):
+        if self.options.bExemplar_dataLoaderStart>=0:
+            sampleIdx +=self.options.bExemplar_dataLoaderStart
+
+        if self.options.db_set =='panoptic':
+            sampleIdxSaveFrame = self.getPanopticSaveFrame(sampleIdx)
+            fileName = '{:08d}.pkl'.format(sampleIdxSaveFrame)
+        elif '3dpw' in self.options.db_set:
+            fileNameOnly = os.path.basename(imgname)[:-4]
+            seqName = os.path.basename(os.path.dirname(imgname))
+            fileNameOnly = f"{seqName}_{fileNameOnly}"
+            fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
+        else:
+            fileNameOnly = os.path.basename(imgname)[:-4]
+            fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
+        return fileName
+
+    #Index of the samples already saved in the output folder (see completionIndex.py)
+    #None if the folder has outputs but no index for the current config, since the outputs may be from another config.
+    #Then the existence of each file is checked instead. Build the index by 'python -m bodymocap.utils.completionIndex'
+    def getCompletionIndex(self, exemplarOutputPath):
+        if self.completionIndexDir != exemplarOutputPath:
+            configKey = getConfigKey(self.options)
+            self.completionIndexDir = exemplarOutputPath
+            if os.path.exists(getIndexPath(exemplarOutputPath, configKey)[0])==False and len(glob.glob(os.path.join(exemplarOutputPath, '*.pkl')) + getStreamChunkPaths(exemplarOutputPath))>0:
+                print("Warning: {} has outputs but no completion index for the current config. Checking each output file instead".format(exemplarOutputPath))
+                print("    To build the index: python -m bodymocap.utils.completionIndex (the same options)")
+                self.completionIndex = None
+            else:
+                self.completionIndex = CompletionIndex(exemplarOutputPath, configKey)
+        return self.completionIndex
+
+    #Check whether the output of the sample already exists
+    def isExistingOutput(self, sampleIdx, imgname, exemplarOutputPath):
+        if self.options.eft_completionIndex and self.options.eft_outputFormat=='pkl' and self.getCompletionIndex(exemplarOutputPath) is not None:     #Look up the index loaded once, instead of the file system
+            if self.options.bExemplar_dataLoaderStart>=0:
+                sampleIdx +=self.options.bExemplar_dataLoaderStart
+            if self.getCompletionIndex(exemplarOutputPath).isDone(sampleIdx):
+                print("Skipped: {}".format(sampleIdx))
+                return True
+            return False
+
+        if self.options.eft_outputFormat=='store':      #Look up the samples in the store, instead of a file per sample
+            if self.resultReader is None or self.resultReader.storeDir != exemplarOutputPath:
+                self.resultReader = ResultStoreReader(exemplarOutputPath)
+            if self.options.bExemplar_dataLoaderStart>=0:
+                sampleIdx +=self.options.bExemplar_dataLoaderStart
+            if sampleIdx in self.resultReader:
+                print("Skipped: {}".format(sampleIdx))
+                return True
+            return False
+
+        if self.isPanopticStream():        #Look up the record headers of the stream files, read once
+            if self.streamSampleIndices is None or self.streamSampleIndices[0] != exemplarOutputPath:
+                self.streamSampleIndices = (exemplarOutputPath, StreamReader(exemplarOutputPath).sampleIndices())
+            if self.options.bExemplar_dataLoaderStart>=0:
+                sampleIdx +=self.options.bExemplar_dataLoaderStart
+            if sampleIdx in self.streamSampleIndices[1]:
+                print("Skipped: {}".format(sampleIdx))
+                return True
+            return False
+
+        outputPath = os.path.join(exemplarOutputPath, self.getExemplarOutputFileName(sampleIdx, imgname))
+        if os.path.exists(outputPath):
+            print("Skipped: {}".format(outputPath))
+            return True
+        return False
+
+
+    #Set requires_grad by the ablation_layerteset_* options. Called once in init_fn
+    def setAblationLayers(self):
+
+        #Freeze non resnet part model
+        if self.options.ablation_layerteset_onlyLayer4:
+            # self.model.conv1.requires_grad = False
+            # self.model.bn1.requires_grad = False
+            # self.model.relu.requires_grad = False
+            # self.model.maxpool.requires_grad = False
+            # self.model.layer1.requires_grad = False
+            # self.model.layer2.requires_grad = False
+            # self.model.layer3.requires_grad = False
+            # self.model.layer4.requires_grad = False
+            # self.model.fc1.requires_grad = False
+            # self.model.drop1.requires_grad = False
+            # self.model.fc2.requires_grad = False
+            # self.model.drop2.requires_grad = False
+            # self.model.decpose.requires_grad = False
+            # self.model.decshape.requires_grad = False
+            # self.model.deccam.requires_grad = False
+            for par in self.model.parameters():
+                par.requires_grad = False
+
+            for name, par in self.model.named_parameters():      #Optimize Layer 4 of resnet
+                # print(name)
+                # if 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                #     print(f"activate {name}")
+                #     par.requires_grad = True
+                if 'layer4' in name:
+                    # print(f">>  Activate {name}")
+                    par.requires_grad = True
+
+        if self.options.ablation_layerteset_onlyAfterRes:   #Optimize  HMR FC part
+            for par in self.model.parameters():
+                par.requires_grad = False
+
+            for name, par in self.model.named_parameters():
+                if 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
         
-        maxExemplarIter = self.options.maxExemplarIter
-       
-        # Iterate over all batches in an epoch
-        outputList ={}
-        for step, batch in enumerate(tqdm(train_data_loader)):#, desc='Epoch '+str(epoch),
-                                        #     total=len(self.train_ds) // self.options.batch_size,
-                                        #     initial=train_data_loader.checkpoint_batch_idx),
-                                        # train_data_loader.checkpoint_batch_idx):
-            
-            #3DPW test
-            # if 'downtown_bus_00' not in batch['imgname']:
-            #     continue
+        if self.options.ablation_layerteset_Layer4Later:        #Optimize Layer 4 of resent +  HMR FC part
+            for par in self.model.parameters():
+                par.requires_grad = False
+
+            for name, par in self.model.named_parameters():
+                if 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
+        
+        if self.options.ablation_layerteset_onlyRes:
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-            #Only performed for 1/100 data (roughly hundred level)
-            if self.options.bExemplar_analysis_testloss:
-                sampleIdx = batch['sample_index'][0].item()
-                if sampleIdx%100 !=0:
-                    continue
-            
-            if self.options.bExemplar_badsample_finder:
-                sampleIdx = batch['sample_index'][0].item()
-                # if sampleIdx%100 !=0:
-                #     continue
+            for name, par in self.model.named_parameters():
+                if 'layer' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
-            bSkipExisting  =  self.options.bNotSkipExemplar==False     #bNotSkipExemplar ===True --> bSkipExisting==False
-            if bSkipExisting:
-                if self.options.db_set =='panoptic':
-                    # fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
-                    # fileNameOnly = (batch['pkl_save_name'][0])[:-4].replace("/","-")
+        
+        if self.options.ablation_layerteset_Layer3Later:
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-                    sampleIdx = batch['sample_index'][0].item()
-                    if self.options.bExemplar_dataLoaderStart>=0:
-                        sampleIdx +=self.options.bExemplar_dataLoaderStart
+            for name, par in self.model.named_parameters():
+                if 'layer3' in name or 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
-                    sampleIdxSaveFrame = 100* (int(sampleIdx/100.0) + 1)
-                    
-                    fileName = '{:08d}.pkl'.format(sampleIdxSaveFrame)
+        if self.options.ablation_layerteset_Layer2Later:
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-                    outputPath = os.path.join(exemplarOutputPath,fileName)
-                    # print(">> checking: {}".format(outputPath))
-                    if os.path.exists(outputPath):
-                        print("Skipped: {}".format(outputPath))
-                        continue
-                elif '3dpw' in self.options.db_set:
+            for name, par in self.model.named_parameters():
+                if 'layer2' in name or 'layer3' in name or 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
-                    fileNameOnly = os.path.basename(batch['imgname'][0])[:-4]
-                    seqName = os.path.basename(os.path.dirname(batch['imgname'][0]))
-                    fileNameOnly = f"{seqName}_{fileNameOnly}"
+        if self.options.ablation_layerteset_Layer1Later:
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-                    sampleIdx = batch['sample_index'][0].item()
-                    if self.options.bExemplar_dataLoaderStart>=0:
-                        sampleIdx +=self.options.bExemplar_dataLoaderStart
-                    fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
-                    outputPath = os.path.join(exemplarOutputPath,fileName)
-                    if os.path.exists(outputPath):
-                        print("Skipped: {}".format(outputPath))
-                        continue
-                else:
-                    fileNameOnly = os.path.basename(batch['imgname'][0])[:-4]
-                    sampleIdx = batch['sample_index'][0].item()
-                    if self.options.bExemplar_dataLoaderStart>=0:
-                        sampleIdx +=self.options.bExemplar_dataLoaderStart
-                    fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
-                    outputPath = os.path.join(exemplarOutputPath,fileName)
-                    if os.path.exists(outputPath):
-                        print("Skipped: {}".format(outputPath))
-                        continue
-                    
-            g_timer.tic()
-            self.reloadModel()  #For each sample
+            for name, par in self.model.named_parameters():
+                if 'layer1' in name or 'layer2' in name or 'layer3' in name or 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
+        if self.options.ablation_layerteset_all:    #No Freeze. debugging purpose
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-            #Freeze non resnet part model
-            if self.options.ablation_layerteset_onlyLayer4:
-                # self.model.conv1.requires_grad = False
-                # self.model.bn1.requires_grad = False
-                # self.model.relu.requires_grad = False
-                # self.model.maxpool.requires_grad = False
-                # self.model.layer1.requires_grad = False
-                # self.model.layer2.requires_grad = False
-                # self.model.layer3.requires_grad = False
-                # self.model.layer4.requires_grad = False
-                # self.model.fc1.requires_grad = False
-                # self.model.drop1.requires_grad = False
-                # self.model.fc2.requires_grad = False
-                # self.model.drop2.requires_grad = False
-                # self.model.decpose.requires_grad = False
-                # self.model.decshape.requires_grad = False
-                # self.model.deccam.requires_grad = False
-                for par in self.model.parameters():
-                    par.requires_grad = False
+            for name, par in self.model.named_parameters():
+                if 'conv1' in name or 'layer' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
-                for name, par in self.model.named_parameters():      #Optimize Layer 4 of resnet
-                    # print(name)
-                    # if 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                    #     print(f"activate {name}")
-                    #     par.requires_grad = True
-                    if 'layer4' in name:
-                        # print(f">>  Activate {name}")
-                        par.requires_grad = True
-
-            if self.options.ablation_layerteset_onlyAfterRes:   #Optimize  HMR FC part
-                for par in self.model.parameters():
-                    par.requires_grad = False
+        if self.options.ablation_layerteset_onlyRes_withconv1:      #Only use ResNet. Freeze HMR part all
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-                for name, par in self.model.named_parameters():
-                    if 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
-            
-            if self.options.ablation_layerteset_Layer4Later:        #Optimize Layer 4 of resent +  HMR FC part
-                for par in self.model.parameters():
-                    par.requires_grad = False
+            for name, par in self.model.named_parameters():
+                if 'conv1' in name or 'layer' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
-                for name, par in self.model.named_parameters():
-                    if 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
-            
-            if self.options.ablation_layerteset_onlyRes:
-                for par in self.model.parameters():
-                    par.requires_grad = False
 
-                for name, par in self.model.named_parameters():
-                    if 'layer' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
+        if self.options.ablation_layerteset_decOnly:
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-            
-            if self.options.ablation_layerteset_Layer3Later:
-                for par in self.model.parameters():
-                    par.requires_grad = False
+            for name, par in self.model.named_parameters():
+                if 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
-                for name, par in self.model.named_parameters():
-                    if 'layer3' in name or 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
 
-            if self.options.ablation_layerteset_Layer2Later:
-                for par in self.model.parameters():
-                    par.requires_grad = False
+        if self.options.ablation_layerteset_fc2Later:
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-                for name, par in self.model.named_parameters():
-                    if 'layer2' in name or 'layer3' in name or 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
+            for name, par in self.model.named_parameters():
+                if 'fc2' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
 
-            if self.options.ablation_layerteset_Layer1Later:
-                for par in self.model.parameters():
-                    par.requires_grad = False
 
-                for name, par in self.model.named_parameters():
-                    if 'layer1' in name or 'layer2' in name or 'layer3' in name or 'layer4' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
+        #Freeze all except the last layer of Resnet
+        if self.options.ablation_layerteset_onlyRes50LastConv:
+            for par in self.model.parameters():
+                par.requires_grad = False
 
-            if self.options.ablation_layerteset_all:    #No Freeze. debugging purpose
-                for par in self.model.parameters():
-                    par.requires_grad = False
+            for name, par in self.model.named_parameters():
+                if 'layer4.2.conv3' in name:
+                    # print(f"activate {name}")
+                    par.requires_grad = True
+        
 
-                for name, par in self.model.named_parameters():
-                    if 'conv1' in name or 'layer' in name or 'fc' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
 
-            if self.options.ablation_layerteset_onlyRes_withconv1:      #Only use ResNet. Freeze HMR part all
-                for par in self.model.parameters():
-                    par.requires_grad = False
+    #Panoptic outputs are appended to stream files (see streamWriter.py), unless eft_panopticPklDict
+    def isPanopticStream(self):
+        return (self.options.db_set =='panoptic' or "haggling" in self.options.db_set) and self.options.eft_panopticPklDict==False
+
+    #Export Output to PKL files
+    #For panoptic, outputs are appended to the stream writer. With eft_panopticPklDict, accumulated in outputList and saved per 100 samples
+    #In sharded runs, a panoptic file has the samples of the same getPanopticSaveFrame, so that chunks (multiples of 100 samples) never write the same file
+    def exportOutput(self, output, exemplarOutputPath, outputList):
+        if self.options.eft_outputFormat=='store':      #Chunked columnar store (see resultStore.py)
+            if self.resultWriter is None or self.resultWriter.storeDir != exemplarOutputPath:
+                self.resultWriter = ResultStoreWriter(exemplarOutputPath, self.options.eft_storeChunkSize, self.options.eft_storeFlushSec)
+            output = dict(output)
+            if self.options.bExemplar_dataLoaderStart>=0:
+                output['sampleIdx'] = output['sampleIdx'] + self.options.bExemplar_dataLoaderStart
+            self.resultWriter.append(output)
+
+        elif self.options.db_set =='panoptic' or "haggling" in self.options.db_set:
+            # fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
+            fileNameOnly = (output['imageName'][0])[:-4].replace("/","-")
+
+            sampleIdx = output['sampleIdx'][0]
+            if self.options.bExemplar_dataLoaderStart>=0:
+                sampleIdx +=self.options.bExemplar_dataLoaderStart
+
+            if self.isPanopticStream():
+                if self.streamWriter is None or self.streamWriter.outputDir != exemplarOutputPath:
+                    if self.streamWriter is not None:
+                        self.streamWriter.close()
+                    completionIndex = self.getCompletionIndex(exemplarOutputPath) if self.options.eft_completionIndex else None
+                    self.streamWriter = StreamWriter(exemplarOutputPath, self.options.eft_streamChunkMB<<20, self.options.eft_streamSyncEvery, completionIndex)
+                self.streamWriter.append(int(sampleIdx), output)
+
+            elif self.bShardedRun:
+                if len(outputList)>0 and self.getPanopticSaveFrame(max(outputList.keys())) != self.getPanopticSaveFrame(sampleIdx):
+                    self.savePanopticFrame(outputList, exemplarOutputPath)
+                    outputList ={}      #reset
+                outputList[sampleIdx] = output
+
+            elif sampleIdx%100==0:
+                outputList[sampleIdx] = output
+
+                # fileName = '{:80d}.pkl'.format(fileNameOnly,sampleIdx)
+                fileName = '{:08d}.pkl'.format(sampleIdx)
+                outputPath = os.path.join(exemplarOutputPath,fileName)
+                print("Saved:{}".format(outputPath))
+                self.savePickle(outputPath, outputList, list(outputList.keys()))
+                
+                outputList ={}      #reset
+            else:
+                outputList[sampleIdx] = output
 
-                for name, par in self.model.named_parameters():
-                    if 'conv1' in name or 'layer' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
+        elif "3dpw" in self.options.db_set:
+            fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
+            seqName = os.path.basename(os.path.dirname(output['imageName'][0]))
+            fileNameOnly = f"{seqName}_{fileNameOnly}"
+            # fileNameOnly = (output['imageName'][0])[:-4].replace("/","-")
 
+            sampleIdx = output['sampleIdx'][0].item()
+            if self.options.bExemplar_dataLoaderStart>=0:
+                sampleIdx +=self.options.bExemplar_dataLoaderStart
 
-            if self.options.ablation_layerteset_decOnly:
-                for par in self.model.parameters():
-                    par.requires_grad = False
+            fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
+            outputPath = os.path.join(exemplarOutputPath,fileName)
+
+            print("Saved:{}".format(outputPath))
+            self.savePickle(outputPath, output, [sampleIdx])
 
-                for name, par in self.model.named_parameters():
-                    if 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
+        else:
+            fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
+            # fileNameOnly = (output['imageName'][0])[:-4].replace("/","-")
 
+            sampleIdx = output['sampleIdx'][0].item()
+            if self.options.bExemplar_dataLoaderStart>=0:
+                sampleIdx +=self.options.bExemplar_dataLoaderStart
 
-            if self.options.ablation_layerteset_fc2Later:
-                for par in self.model.parameters():
-                    par.requires_grad = False
+            fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
+            outputPath = os.path.join(exemplarOutputPath,fileName)
 
-                for name, par in self.model.named_parameters():
-                    if 'fc2' in name or 'decpose' in name or 'decshape' in name or 'deccam' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
+            print("Saved:{}".format(outputPath))
+            self.savePickle(outputPath, output, [sampleIdx])
 
+        return outputList
 
-            #Freeze all except the last layer of Resnet
-            if self.options.ablation_layerteset_onlyRes50LastConv:
-                for par in self.model.parameters():
-                    par.requires_grad = False
+    #Save a pkl file. Done by the background writer thread if eft_asyncWriterQueue>0
+    #doneSamples: sampleIdx of the outputs in the file. Marked in the completion index after the file is written
+    def savePickle(self, outputPath, data, doneSamples=None):
+        if self.options.eft_completionIndex and doneSamples is not None and self.getCompletionIndex(os.path.dirname(outputPath)) is not None:
+            func, args = writePickleAndMark, (outputPath, data, self.getCompletionIndex(os.path.dirname(outputPath)), doneSamples)
+        else:
+            func, args = writePickle, (outputPath, data)
+
+        if self.options.eft_asyncWriterQueue<=0:
+            func(*args)
+            return
+
+        if self.asyncWriter is None:
+            self.asyncWriter = AsyncWriter(self.options.eft_asyncWriterQueue)
+        self.asyncWriter.submit(func, *args)
+
+    #Wait until all the outputs are written
+    def flushOutputWriter(self):
+        if self.resultWriter is not None:
+            self.resultWriter.flush()
+        if self.streamWriter is not None:
+            self.streamWriter.close()       #The next output starts a new chunk
+        if self.asyncWriter is not None:
+            self.asyncWriter.flush()
+
+    #Save panoptic outputs of a sharded run, named by their getPanopticSaveFrame as getExemplarOutputFileName
+    def savePanopticFrame(self, outputList, exemplarOutputPath):
+        fileName = '{:08d}.pkl'.format(self.getPanopticSaveFrame(max(outputList.keys())))
+        outputPath = os.path.join(exemplarOutputPath,fileName)
+        print("Saved:{}".format(outputPath))
+        self.savePickle(outputPath, outputList, list(outputList.keys()))
+
+    #Called at the end of eftAllInDB. Write outputs still in the buffer of the result store and the writer thread
+    #Panoptic outputs not saved yet by exportOutput (the last frame of a sharded run) are saved if bSaveRemainingList
+    def finishExport(self, outputList, exemplarOutputPath, bSaveRemainingList):
+        if bSaveRemainingList and len(outputList)>0:
+            self.savePanopticFrame(outputList, exemplarOutputPath)
+
+        self.flushOutputWriter()
+
+
+    #Trackers of the test error for bExemplar_analysis_testloss with eft_testLossSubset>0. Built once and reused
+    def getTestLossTrackers(self, test_dataset_3dpw, test_dataset_h36m):
+        if self.testLossTrackers is None:
+            self.testLossTrackers = [TestLossTracker(test_dataset_3dpw, '3dpw', self.device, self.options.eft_testLossSubset, self.options.batch_size, self.options.num_workers)]
+            if test_dataset_h36m is not None:
+                self.testLossTrackers.append(TestLossTracker(test_dataset_h36m, 'h36m-p1', self.device, self.options.eft_testLossSubset, self.options.batch_size, self.options.num_workers))
+        return self.testLossTrackers
+
+
+    #Run EFT
+    #Save output as seperate pkl files
+    #If sampleRange=(start,end) is given, only process samples in [start,end). Used by shardRunner, which tracks finished samples itself
+    #heartbeat: LeaseHeartbeat of the chunk (shardRunner). If the lease is lost, the chunk is abandoned without finishing the export
+    def eftAllInDB(self, test_dataset_3dpw = None, test_dataset_h36m= None, bExportPKL = True, sampleRange=None, heartbeat=None):
+
+        if self.options.eft_batch_size>1:       #Fine-tune multiple samples at once
+            return self.eftAllInDB_batch(bExportPKL, sampleRange, heartbeat)
+
+        exemplarOutputPath = self.getExemplarOutputPath()
+        self.bShardedRun = sampleRange is not None
+
+        """Training process."""
+        # Run training for num_epochs epochs
+        # Create new DataLoader every epoch and (possibly) resume from an arbitrary step inside an epoch
+        train_data_loader = self.getExemplarDataLoader(batch_size=1, sampleRange=sampleRange)      #Always o1
+        
+        maxExemplarIter = self.options.maxExemplarIter
+        stopper = buildStopper(self.options)
+        prevSeqKey, prevFinalLoss = None, None      #For eft_sequenceWarmStart
+        if self.options.eft_sequenceWarmStart and self.isVideoDB()==False:
+            print("Warning: eft_sequenceWarmStart is ignored for {}, which is not a video DB".format(self.options.db_set))
+
+        #Reuse the fits of previous runs on the same samples (see fitCache.py)
+        fitCache = None
+        if self.options.eft_fitCacheDir is not None:
+            if self.options.eft_sequenceWarmStart:      #The fit depends on the previous frame
+                print("Warning: eft_fitCacheDir is ignored with eft_sequenceWarmStart")
+            else:
+                fitCache = FitCache(self.options.eft_fitCacheDir, self.options)
+
+        #Test error on a cached subset of the test DBs, instead of the full test() after each exemplar
+        bTrackTestLoss = self.options.bExemplar_analysis_testloss and test_dataset_3dpw is not None and self.options.eft_testLossSubset>0
+        if bTrackTestLoss:
+            testLossTrackers = self.getTestLossTrackers(test_dataset_3dpw, test_dataset_h36m)
+            testLossLog = TestLossLog(os.path.join(exemplarOutputPath, 'testloss.npy'), [t.datasetName for t in testLossTrackers])
+            numTestedExemplars = 0
+       
+        # Iterate over all batches in an epoch
+        outputList ={}
+        self.stageTimer.mark()
+        for step, batch in enumerate(tqdm(train_data_loader)):#, desc='Epoch '+str(epoch),
+                                        #     total=len(self.train_ds) // self.options.batch_size,
+                                        #     initial=train_data_loader.checkpoint_batch_idx),
+                                        # train_data_loader.checkpoint_batch_idx):
 
-                for name, par in self.model.named_parameters():
-                    if 'layer4.2.conv3' in name:
-                        # print(f"activate {name}")
-                        par.requires_grad = True
+            if heartbeat is not None and heartbeat.isLost():        #Another worker runs this chunk now
+                return
             
+            #3DPW test
+            # if 'downtown_bus_00' not in batch['imgname']:
+            #     continue
+
+            #Only performed for 1/100 data (roughly hundred level)
+            if self.options.bExemplar_analysis_testloss:
+                sampleIdx = batch['sample_index'][0].item()
+                if sampleIdx%100 !=0:
+                    continue
+            
+            if self.options.bExemplar_badsample_finder:
+                sampleIdx = batch['sample_index'][0].item()
+                # if sampleIdx%100 !=0:
+                #     continue
+
+            bSkipExisting  =  self.options.bNotSkipExemplar==False and sampleRange is None    #bNotSkipExemplar ===True --> bSkipExisting==False
+            if bSkipExisting:
+                if self.isExistingOutput(batch['sample_index'][0].item(), batch['imgname'][0], exemplarOutputPath):
+                    prevSeqKey = None
+                    continue
+
+            if fitCache is not None:
+                fitKey = fitCache.getKey(batch)
+                output = fitCache.get(fitKey, batch, self.getSpinFits(batch))
+                if output is not None:      #Copy the stored fit without running EFT
+                    print(">> Fit cache hit ({} hits, {} misses)".format(fitCache.numHits, fitCache.numMisses))
+                    self.stageTimer.lap('data')
+                    if bExportPKL:
+                        outputList = self.exportOutput(output, exemplarOutputPath, outputList)
+                    self.stageTimer.lap('export')
+                    self.stageTimer.endSample(batch['sample_index'][0].item())
+                    continue
+                    
+            g_timer.tic()
+            stopper.startSample(len(train_data_loader) - step)
+            self.stageTimer.lap('data')
+
+            #Sequence mode: start from the fine-tuned weights of the previous frame of the same sequence
+            seqKey = self.getSequenceKey(batch)
+            bWarmStart = self.options.eft_sequenceWarmStart and seqKey is not None and seqKey==prevSeqKey
+            bWarmStartFailed = False
+            if bWarmStart:
+                time_reset = self.reloadOptimizer()      #Keep the weights. Adam starts again
+            else:
+                time_reset = self.reloadModel()  #For each sample
+            self.stageTimer.lap('reload')
 
             # g_timer.toc(average =False, bPrint=True,title="reload")
             # self.exemplerTrainingMode()
 
             batch = {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k,v in batch.items()}
+            self.stageTimer.lap('data')
+
+            if bWarmStart:      #Fall back to the original weights if the loss jumps (e.g., a cut or a fast motion)
+                output_orig, losses_orig = self.runOriginalModel(batch)     #For the *_init outputs
+                if self.options.bUseHand3D:
+                    _, losses = self.run_eft_step_wHand(batch, bUpdate=False)
+                else:
+                    _, losses = self.run_eft_step(batch, bUpdate=False)
+                if losses['loss_keypoints'] > max(prevFinalLoss * self.options.eft_warmStartLossRatio, self.options.eft_thresh_keyptErr_2d):
+                    print(">>> Warm start failed (loss {:.6f}, previous frame {:.6f}). Reset the model".format(losses['loss_keypoints'], prevFinalLoss))
+                    time_reset += self.reloadModel()
+                    bWarmStart = False
+                    bWarmStartFailed = True
 
             output_backup={}
+            lossHistory = []
+            stopReason = 'maxIter'
             for it in range(maxExemplarIter):
                 
 
@@ -1293,13 +1912,22 @@ class EFTFitter(Trainer):
                 
                 # print("keypoint loss: {}".format(output['loss_keypoints_2d']))
                 
-                # Thresholding by 2D keypoint error
-                if True:
-                    if output['loss_keypoints_2d']< self.options.eft_thresh_keyptErr_2d: # 1e-4:
-                        # glViewer.show(0)
-                        break
+                # Stop by 2D keypoint error threshold, plateau, time budget, etc. (see eftStopping.py)
+                lossHistory.append(output['loss_keypoints_2d'])
+                reason = stopper.check(lossHistory)
+                if reason is not None:
+                    stopReason = reason
+                    break
 
             g_timer.toc(average =True, bPrint=True,title="wholeEFT")
+            output['time_reset'] = time_reset
+            if self.options.eft_sequenceWarmStart:
+                output['warmStart'] = bWarmStart
+                output['warmStartFailed'] = bWarmStartFailed
+            prevSeqKey = seqKey
+            prevFinalLoss = output['loss_keypoints_2d']
+            output['stopPolicy'] = stopper.description
+            output['stopReason'] = stopReason
             
             if self.options.bDebug_visEFT:
                 # glViewer.show(0)
@@ -1312,6 +1940,16 @@ class EFTFitter(Trainer):
 
                 glViewer.show(0)
 
+            if bWarmStart:      #The first iteration started from the previous frame. *_init are from the original network
+                output['pred_shape_warmStart'] = output_backup['pred_shape']
+                output['pred_pose_rotmat_warmStart']  = output_backup['pred_pose_rotmat']
+                output['pred_camera_warmStart'] = output_backup['pred_camera']
+                output['loss_warmStart'] = output_backup['loss']
+                output['loss_keypoints_2d_warmStart']  = output_backup['loss_keypoints_2d']
+
+                output_backup = {'pred_shape': output_orig['pred_shape'], 'pred_pose_rotmat': output_orig['pred_pose_rotmat'], 'pred_camera': output_orig['pred_camera'],
+                                 'loss': losses_orig['loss'], 'loss_keypoints_2d': losses_orig['loss_keypoints']}
+
             output['pred_shape_init'] = output_backup['pred_shape'] 
             output['pred_pose_rotmat_init']  = output_backup['pred_pose_rotmat']
             output['pred_camera_init'] = output_backup['pred_camera']
@@ -1325,8 +1963,23 @@ class EFTFitter(Trainer):
             else:
                 output['smpltype'] = 'smpl'
 
+            if fitCache is not None:
+                fitCache.put(fitKey, output)
+
             #Exemplar Tuning Analysis
-            if self.options.bExemplar_analysis_testloss and test_dataset_3dpw is not None:
+            if bTrackTestLoss:
+                if numTestedExemplars % self.options.eft_testLossEvery==0:
+                    errors = [t.evaluate(self.model) for t in testLossTrackers]      #(mpjpe_mm, recon_error_mm)
+                    output['test_error_3dpw'] = errors[0][1]
+                    if len(errors)>1:
+                        output['test_error_h36m'] = errors[1][1]
+                    sampleIdx = output['sampleIdx'][0].item()
+                    if self.options.bExemplar_dataLoaderStart>=0:
+                        sampleIdx +=self.options.bExemplar_dataLoaderStart
+                    testLossLog.append(sampleIdx, errors)
+                    testLossLog.save()
+                numTestedExemplars +=1
+            elif self.options.bExemplar_analysis_testloss and test_dataset_3dpw is not None:
                 print(">> Testing : test set size:{}".format(len(test_dataset_3dpw)))
                 error_3dpw = self.test(test_dataset_3dpw, '3dpw')
                 output['test_error_3dpw'] = error_3dpw
@@ -1338,69 +1991,164 @@ class EFTFitter(Trainer):
                 error_3dpw = self.test(test_dataset_3dpw, '3dpw')
                 output['test_error_3dpw'] = error_3dpw
 
+            self.stageTimer.lap('loop')
             if bExportPKL:    #Export Output to PKL files
-                if self.options.db_set =='panoptic' or "haggling" in self.options.db_set:
-                    # fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
-                    fileNameOnly = (output['imageName'][0])[:-4].replace("/","-")
+                outputList = self.exportOutput(output, exemplarOutputPath, outputList)
+            self.stageTimer.lap('export')
+            self.stageTimer.endSample(batch['sample_index'][0].item())
+                        
+            # # # Tensorboard logging every summary_steps steps
+            # if self.step_count % self.options.summary_steps == 0:
+            #     self.train_summaries(batch, *out)
 
-                    sampleIdx = output['sampleIdx'][0]
-                    if self.options.bExemplar_dataLoaderStart>=0:
-                        sampleIdx +=self.options.bExemplar_dataLoaderStart
+        if heartbeat is not None and heartbeat.isLost():
+            return
+        if bExportPKL:
+            self.finishExport(outputList, exemplarOutputPath, sampleRange is not None)
 
-                    if sampleIdx%100==0:
-                        outputList[sampleIdx] = output
+        print(self.stageTimer.summaryTable())
+        self.stageTimer.saveReport(exemplarOutputPath)
 
-                        # fileName = '{:80d}.pkl'.format(fileNameOnly,sampleIdx)
-                        fileName = '{:08d}.pkl'.format(sampleIdx)
-                        outputPath = os.path.join(exemplarOutputPath,fileName)
-                        print("Saved:{}".format(outputPath))
-                        with open(outputPath,'wb') as f:
-                            pickle.dump(outputList,f)       #Bug fixed
-                            f.close()
-                        
-                        outputList ={}      #reset
+    
+
+    #Run EFT for eft_batch_size samples at once
+    #Each sample has its own copy of the network weights, so the outputs are the same as eftAllInDB
+    #Save output as seperate pkl files
+    def eftAllInDB_batch(self, bExportPKL = True, sampleRange=None, heartbeat=None):
+
+        assert self.options.bExemplarMode       #Batch norm and dropout should be disabled to make samples independent
+        assert self.options.eft_sequenceWarmStart==False        #Frames of a sequence are not independent
+        assert self.options.eft_optimizer=='adam'       #multiModel has its own Adam
+        assert self.options.bExemplar_analysis_testloss==False and self.options.bExemplar_badsample_finder==False      #Not supported yet
+
+        exemplarOutputPath = self.getExemplarOutputPath()
+        self.bShardedRun = sampleRange is not None
+
+        train_data_loader = self.getExemplarDataLoader(batch_size=self.options.eft_batch_size, sampleRange=sampleRange)
+
+        maxExemplarIter = self.options.maxExemplarIter
+
+        #Network weights are not changed in this mode (each sample has its own copy). Trainable layers are set in init_fn
+        prefixStage = self.prefixStage
+        stopper = buildStopper(self.options)
+
+        #Reuse the fits of previous runs on the same samples (see fitCache.py). Hits are removed from the batch
+        fitCache = None
+        if self.options.eft_fitCacheDir is not None:
+            fitCache = FitCache(self.options.eft_fitCacheDir, self.options)
+        if self.stageTimer.bEnabled:
+            print("Warning: per-stage timing is not recorded with eft_batch_size>1, since the stages of a batch are shared by its samples")
+
+        outputList ={}
+        for step, batch in enumerate(tqdm(train_data_loader)):
+
+            if heartbeat is not None and heartbeat.isLost():        #Another worker runs this chunk now
+                return
+
+            bSkipExisting  =  self.options.bNotSkipExemplar==False and sampleRange is None    #bNotSkipExemplar ===True --> bSkipExisting==False
+            if bSkipExisting:
+                validRows = [b for b in range(len(batch['imgname'])) if not self.isExistingOutput(batch['sample_index'][b].item(), batch['imgname'][b], exemplarOutputPath) ]
+                if len(validRows)==0:
+                    continue
+                batch = selectBatchRows(batch, validRows)
+
+            if fitCache is not None:
+                fitKeys, missRows = [], []
+                for b in range(len(batch['imgname'])):
+                    sampleBatch = selectBatchRows(batch, [b])
+                    fitKey = fitCache.getKey(sampleBatch)
+                    output = fitCache.get(fitKey, sampleBatch, self.getSpinFits(sampleBatch))
+                    if output is None:
+                        fitKeys.append(fitKey)
+                        missRows.append(b)
+                    elif bExportPKL:      #Copy the stored fit without running EFT
+                        outputList = self.exportOutput(output, exemplarOutputPath, outputList)
+                print(">> Fit cache: {} hits, {} misses".format(fitCache.numHits, fitCache.numMisses))
+                if len(missRows)==0:
+                    continue
+                batch = selectBatchRows(batch, missRows)
+
+            g_timer.tic()
+            batch = {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k,v in batch.items()}
+            batch_size = batch['img'].shape[0]
+            if prefixStage is not None:     #Run the frozen prefix once for all iterations
+                self.model.train()
+                self.exemplerTrainingMode()
+                with torch.no_grad(), autocastContext(self.bCPUProfile):       #Autocast does not apply inside vmap, so only the shared prefix uses the CPU profile
+                    model = self.model.module if isinstance(self.model, torch.nn.DataParallel) else self.model
+                    batch['img_feature'] = model.forward_prefix(toChannelsLast(batch['img']) if self.bCPUProfile else batch['img'], prefixStage).float()
+                    batch['img_feature_stage'] = prefixStage
+            multiModel = MultiExemplarModel(self.model, batch_size, self.options.lr_eft)
+
+            stopper.startSample(len(train_data_loader) - step)      #Time budget is spread over batches
+            outputs = [None] * batch_size
+            outputs_backup = [None] * batch_size
+            lossHistory = [ [] for _ in range(batch_size) ]
+            stopReason = ['maxIter'] * batch_size
+            activeRows = list(range(batch_size))       #Samples not converged yet
+            for it in range(maxExemplarIter):
+
+                activeBatch = selectBatchRows(batch, activeRows) if len(activeRows)<batch_size else batch
+                outputList_step, lossesList_step = self.run_eft_step_batch(activeBatch, multiModel)
+
+                keep = []
+                for i, b in enumerate(activeRows):
+                    output, losses = outputList_step[i], lossesList_step[i]
+                    output['loss_keypoints_2d'] = losses['loss_keypoints']
+                    output['loss'] = losses['loss']
+                    output['numOfIteration'] = it
+
+                    if it==0:
+                        outputs_backup[b] = {'pred_shape': output['pred_shape'].copy(),
+                                            'pred_pose_rotmat': output['pred_pose_rotmat'].copy(),
+                                            'pred_camera': output['pred_camera'].copy(),
+                                            'loss_keypoints_2d': output['loss_keypoints_2d'],
+                                            'loss': output['loss'] }
+                    outputs[b] = output
+
+                    # Stop by 2D keypoint error threshold, plateau, time budget, etc. (see eftStopping.py)
+                    lossHistory[b].append(output['loss_keypoints_2d'])
+                    reason = stopper.check(lossHistory[b])
+                    if reason is None:
+                        keep.append(i)
                     else:
-                        outputList[sampleIdx] = output
+                        stopReason[b] = reason
 
-                elif "3dpw" in self.options.db_set:
-                    fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
-                    seqName = os.path.basename(os.path.dirname(output['imageName'][0]))
-                    fileNameOnly = f"{seqName}_{fileNameOnly}"
-                    # fileNameOnly = (output['imageName'][0])[:-4].replace("/","-")
+                if len(keep)==0:
+                    break
+                if len(keep)<len(activeRows):       #Drop converged samples
+                    multiModel.selectExemplars(keep)
+                    activeRows = [activeRows[i] for i in keep]
 
-                    sampleIdx = output['sampleIdx'][0].item()
-                    if self.options.bExemplar_dataLoaderStart>=0:
-                        sampleIdx +=self.options.bExemplar_dataLoaderStart
+            g_timer.toc(average =True, bPrint=True,title="wholeEFT (batch)")
 
-                    fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
-                    outputPath = os.path.join(exemplarOutputPath,fileName)
+            for b in range(batch_size):
+                output = outputs[b]
+                output['pred_shape_init'] = outputs_backup[b]['pred_shape']
+                output['pred_pose_rotmat_init']  = outputs_backup[b]['pred_pose_rotmat']
+                output['pred_camera_init'] = outputs_backup[b]['pred_camera']
 
-                    print("Saved:{}".format(outputPath))
-                    with open(outputPath,'wb') as f:
-                        pickle.dump(output,f)       
-                        f.close()
+                output['loss_init'] = outputs_backup[b]['loss']
+                output['loss_keypoints_2d_init']  = outputs_backup[b]['loss_keypoints_2d']
+                output['stopPolicy'] = stopper.description
+                output['stopReason'] = stopReason[b]
 
+                if self.options.bUseSMPLX:
+                    output['smpltype'] = 'smplx'
                 else:
-                    fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
-                    # fileNameOnly = (output['imageName'][0])[:-4].replace("/","-")
+                    output['smpltype'] = 'smpl'
 
-                    sampleIdx = output['sampleIdx'][0].item()
-                    if self.options.bExemplar_dataLoaderStart>=0:
-                        sampleIdx +=self.options.bExemplar_dataLoaderStart
+                if fitCache is not None:
+                    fitCache.put(fitKeys[b], output)
 
-                    fileName = '{}_{}.pkl'.format(fileNameOnly,sampleIdx)
-                    outputPath = os.path.join(exemplarOutputPath,fileName)
+                if bExportPKL:    #Export Output to PKL files
+                    outputList = self.exportOutput(output, exemplarOutputPath, outputList)
 
-                    print("Saved:{}".format(outputPath))
-                    with open(outputPath,'wb') as f:
-                        pickle.dump(output,f)       
-                        f.close()
-                        
-            # # # Tensorboard logging every summary_steps steps
-            # if self.step_count % self.options.summary_steps == 0:
-            #     self.train_summaries(batch, *out)
+        if heartbeat is not None and heartbeat.isLost():
+            return
+        if bExportPKL:
+            self.finishExport(outputList, exemplarOutputPath, sampleRange is not None)
 
-    
 
     #Run EFT
     #Save output as seperate pkl files
@@ -1431,6 +2179,9 @@ class EFTFitter(Trainer):
                                                     shuffle=False)      #No Shuffle      
         
         maxExemplarIter = self.options.maxExemplarIter
+
+        #Metrics of each iteration, one row per (sample, iteration). See iterLog.py
+        iterLog = IterLogWriter(exemplarOutputPath, len(train_data_loader)*maxExemplarIter)
        
         # Iterate over all batches in an epoch
         outputList ={}
@@ -1508,9 +2259,13 @@ class EFTFitter(Trainer):
 
             output_backup={}
             reconErrorInfo ={}
+            sampleIdx = batch['sample_index'][0].item()
+            if self.options.bExemplar_dataLoaderStart>=0:
+                sampleIdx +=self.options.bExemplar_dataLoaderStart
             for it in range(maxExemplarIter):
                 
                 g_timer.tic()
+                iterStartTime = time.time()
                 if self.options.bUseHand3D:
                     output, losses = self.run_eft_step_wHand(batch)
                 else:
@@ -1520,6 +2275,7 @@ class EFTFitter(Trainer):
 
                 
                 reconErrorInfo[it] = (losses['r_error'], losses['loss_keypoints'])
+                iterLog.append(sampleIdx, it, losses['loss_keypoints'], losses['mpjpe'], losses['r_error'], time.time() - iterStartTime)
 
 
                 # g_timer.toc(average =False, bPrint=True,title="eachStep"
@@ -1585,9 +2341,7 @@ class EFTFitter(Trainer):
                         fileName = '{:08d}.pkl'.format(sampleIdx)
                         outputPath = os.path.join(exemplarOutputPath,fileName)
                         print("Saved:{}".format(outputPath))
-                        with open(outputPath,'wb') as f:
-                            pickle.dump(outputList,f)       #Bug fixed
-                            f.close()
+                        self.savePickle(outputPath, outputList)
                         
                         outputList ={}      #reset
                     else:
@@ -1607,9 +2361,7 @@ class EFTFitter(Trainer):
                     outputPath = os.path.join(exemplarOutputPath,fileName)
 
                     print("Saved:{}".format(outputPath))
-                    with open(outputPath,'wb') as f:
-                        pickle.dump(output,f)       
-                        f.close()
+                    self.savePickle(outputPath, output)
 
                 else:
                     fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
@@ -1623,14 +2375,15 @@ class EFTFitter(Trainer):
                     outputPath = os.path.join(exemplarOutputPath,fileName)
 
                     print("Saved:{}".format(outputPath))
-                    with open(outputPath,'wb') as f:
-                        pickle.dump(output,f)       
-                        f.close()
+                    self.savePickle(outputPath, output)
                         
             # # # Tensorboard logging every summary_steps steps
             # if self.step_count % self.options.summary_steps == 0:
             #     self.train_summaries(batch, *out)
 
+        self.flushOutputWriter()
+        iterLog.close()
+
         if False:       #Display the best iteration
             reconErrorPerIter=[]
             for it in range(maxExemplarIter):
@@ -1649,6 +2402,9 @@ class EFTFitter(Trainer):
     #Save output as seperate pkl files
     def smplifyAllInDB(self, test_dataset_3dpw = None, test_dataset_h36m= None, bExportPKL = True):
 
+        if self.options.smplify_batch_size>1:
+            return self.smplifyAllInDB_batch(bExportPKL)
+
         if config.bIsDevfair:
             now = datetime.datetime.now()
             # newName = '{:02d}-{:02d}-{}'.format(now.month, now.day, now.hour*3600 + now.minute*60 + now.second)
@@ -1813,9 +2569,7 @@ class EFTFitter(Trainer):
                         fileName = '{:08d}.pkl'.format(sampleIdx)
                         outputPath = os.path.join(exemplarOutputPath,fileName)
                         print("Saved:{}".format(outputPath))
-                        with open(outputPath,'wb') as f:
-                            pickle.dump(outputList,f)       #Bug fixed
-                            f.close()
+                        self.savePickle(outputPath, outputList)
                         
                         outputList ={}      #reset
                     else:
@@ -1835,9 +2589,7 @@ class EFTFitter(Trainer):
                     outputPath = os.path.join(exemplarOutputPath,fileName)
 
                     print("Saved:{}".format(outputPath))
-                    with open(outputPath,'wb') as f:
-                        pickle.dump(output,f)       
-                        f.close()
+                    self.savePickle(outputPath, output)
 
                 else:
                     fileNameOnly = os.path.basename(output['imageName'][0])[:-4]
@@ -1851,11 +2603,50 @@ class EFTFitter(Trainer):
                     outputPath = os.path.join(exemplarOutputPath,fileName)
 
                     print("Saved:{}".format(outputPath))
-                    with open(outputPath,'wb') as f:
-                        pickle.dump(output,f)       
-                        f.close()
+                    self.savePickle(outputPath, output)
                         
             # # # Tensorboard logging every summary_steps steps
             # if self.step_count % self.options.summary_steps == 0:
             #     self.train_summaries(batch, *out)
 
+        self.flushOutputWriter()
+
+
+    #Batched version of smplifyAllInDB. Run SMPLify for smplify_batch_size samples at once (see run_smplify_batch)
+    def smplifyAllInDB_batch(self, bExportPKL = True):
+
+        assert self.options.bDebug_visEFT==False        #Visualization is per sample
+        assert self.options.bExemplar_analysis_testloss==False and self.options.bExemplar_badsample_finder==False      #Not supported yet
+
+        exemplarOutputPath = self.getExemplarOutputPath()
+
+        train_data_loader = self.getExemplarDataLoader(batch_size=self.options.smplify_batch_size)
+
+        outputList ={}
+        for step, batch in enumerate(tqdm(train_data_loader)):
+
+            bSkipExisting  =  self.options.bNotSkipExemplar==False     #bNotSkipExemplar ===True --> bSkipExisting==False
+            if bSkipExisting:
+                validRows = [b for b in range(len(batch['imgname'])) if not self.isExistingOutput(batch['sample_index'][b].item(), batch['imgname'][b], exemplarOutputPath) ]
+                if len(validRows)==0:
+                    continue
+                batch = selectBatchRows(batch, validRows)
+
+            #The network is not updated by SMPLify, so no need to reload the model
+            batch = {k: v.to(self.device) if isinstance(v, torch.Tensor) else v for k,v in batch.items()}
+            outputs = self.run_smplify_batch(batch)
+
+            for output in outputs:
+                #additional outputs
+                output['pretrained_checkpoint']= self.options.pretrained_checkpoint     #For initial model
+                output['method'] ='smplify'
+                if self.options.bUseSMPLX:
+                    output['smpltype'] = 'smplx'
+                else:
+                    output['smpltype'] = 'smpl'
+
+                if bExportPKL:    #Export Output to PKL files
+                    outputList = self.exportOutput(output, exemplarOutputPath, outputList)
+
+        if bExportPKL:
+            self.finishExport(outputList, exemplarOutputPath, False)
@@ -0,0 +1,122 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Stopping policies for the EFT iterations of each sample.
+
+Policies are chosen by --eft_stopPolicy (comma separated). The EFT loop stops when any of them fires,
+or after maxExemplarIter iterations.
+    threshold: 2D keypoint loss < eft_thresh_keyptErr_2d (original behavior)
+    plateau: the best loss of the last eft_plateauWindow iterations improved less than eft_plateauMinDelta
+    relImprove: relative loss improvement over the last eft_plateauWindow iterations < eft_minRelImprovement
+    timeBudget: eft_timeBudget seconds for the whole run, spread evenly over the remaining samples
+"""
+
+import time
+
+
+class ThresholdStop(object):
+    name = 'threshold'
+
+    def __init__(self, thresh):
+        self.thresh = thresh
+
+    def startSample(self, numRemaining):
+        pass
+
+    def check(self, lossHistory):
+        return lossHistory[-1] < self.thresh
+
+
+class PlateauStop(object):
+    name = 'plateau'
+
+    def __init__(self, window, minDelta):
+        self.window = window
+        self.minDelta = minDelta
+
+    def startSample(self, numRemaining):
+        pass
+
+    def check(self, lossHistory):
+        if len(lossHistory) <= self.window:
+            return False
+        return min(lossHistory[:-self.window]) - min(lossHistory[-self.window:]) < self.minDelta
+
+
+class RelImprovementStop(object):
+    name = 'relImprove'
+
+    def __init__(self, window, minRelImprovement):
+        self.window = window
+        self.minRelImprovement = minRelImprovement
+
+    def startSample(self, numRemaining):
+        pass
+
+    def check(self, lossHistory):
+        if len(lossHistory) <= self.window:
+            return False
+        prevLoss = lossHistory[-self.window-1]
+        if prevLoss <= 0:
+            return True
+        return (prevLoss - lossHistory[-1]) / prevLoss < self.minRelImprovement
+
+
+class TimeBudgetStop(object):
+    name = 'timeBudget'
+
+    def __init__(self, totalSeconds):
+        self.totalSeconds = totalSeconds
+        self.runStartTime = time.time()
+        self.sampleStartTime = self.runStartTime
+        self.allowance = totalSeconds
+
+    def startSample(self, numRemaining):
+        self.sampleStartTime = time.time()
+        remainingTime = self.totalSeconds - (self.sampleStartTime - self.runStartTime)
+        self.allowance = remainingTime / max(numRemaining, 1)
+
+    def check(self, lossHistory):
+        return time.time() - self.sampleStartTime > self.allowance
+
+
+class EFTStopper(object):
+    """Combination of stopping policies. Call startSample before each sample (or each batch in batch mode),
+    and check with the loss history of the sample after each iteration
+    """
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.description = ','.join([p.name for p in policies])
+
+    def startSample(self, numRemaining):
+        """numRemaining: number of samples (or batches) left including this one"""
+        for p in self.policies:
+            p.startSample(numRemaining)
+
+    def check(self, lossHistory):
+        """lossHistory: list of 2D keypoint losses of a sample so far
+            output: name of the policy which fired, or None to continue
+        """
+        for p in self.policies:
+            if p.check(lossHistory):
+                return p.name
+        return None
+
+
+def buildStopper(options):
+    policies = []
+    for name in options.eft_stopPolicy.split(','):
+        name = name.strip()
+        if name == 'threshold':
+            policies.append(ThresholdStop(options.eft_thresh_keyptErr_2d))
+        elif name == 'plateau':
+            policies.append(PlateauStop(options.eft_plateauWindow, options.eft_plateauMinDelta))
+        elif name == 'relImprove':
+            policies.append(RelImprovementStop(options.eft_plateauWindow, options.eft_minRelImprovement))
+        elif name == 'timeBudget':
+            assert options.eft_timeBudget > 0, "Set --eft_timeBudget"
+            policies.append(TimeBudgetStop(options.eft_timeBudget))
+        else:
+            raise ValueError("Unknown stopping policy: {}".format(name))
+    return EFTStopper(policies)
@@ -0,0 +1,94 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Fine-tune multiple exemplars at once, each with its own copy of the network weights.
+
+Trainable parameters are stacked along a new leading dimension (one slice per exemplar),
+and the network is evaluated with vmap + functional_call, so exemplar b only sees the b-th slice.
+Since the per-sample losses are summed, the gradient of the b-th slice is exactly the gradient of the b-th sample,
+and Adam (element-wise) behaves as if each sample were optimized alone.
+Frozen parameters and buffers are shared by all exemplars.
+"""
+
+import torch
+from torch.func import functional_call, vmap
+
+
+def selectBatchRows(batch, rows):
+    """Select samples from a collated batch (dict of tensors and lists).
+        rows: list of indices
+    """
+    newBatch = {}
+    for k, v in batch.items():
+        if isinstance(v, torch.Tensor):
+            newBatch[k] = v[rows]
+        elif isinstance(v, (list, tuple)):
+            newBatch[k] = [v[r] for r in rows]
+        else:
+            newBatch[k] = v
+    return newBatch
+
+
+class MultiExemplarModel(object):
+    """Independent copies of the trainable weights of a model, one per exemplar.
+    Only parameters with requires_grad==True are copied. Set them before creating this.
+    The model itself is not modified.
+    """
+
+    def __init__(self, model, numExemplars, lr):
+        if isinstance(model, torch.nn.DataParallel):
+            model = model.module
+        self.model = model
+        self.lr = lr
+
+        self.stackedParams = {}     #name -> (numExemplars, ...)
+        self.sharedTensors = {}     #name -> frozen params and buffers
+        for name, par in model.named_parameters():
+            if par.requires_grad:
+                par = par.detach()
+                self.stackedParams[name] = par.unsqueeze(0).expand(numExemplars, *par.shape).clone().requires_grad_(True)
+            else:
+                self.sharedTensors[name] = par.detach()
+        for name, buf in model.named_buffers():
+            self.sharedTensors[name] = buf
+
+        self.optimizer = torch.optim.Adam(params=list(self.stackedParams.values()), lr=lr, weight_decay=0)
+
+    def __call__(self, images, stage=None):
+        """
+            images: (numExemplars, 3, 224, 224). The b-th image goes to the b-th weights
+                    If stage is given, features from HMR.forward_prefix(images, stage) instead
+            output: same as HMR.forward
+        """
+        def forwardSingle(params, img):
+            return functional_call(self.model, (params, self.sharedTensors), (img.unsqueeze(0),), {'stage': stage})
+
+        pred_rotmat, pred_betas, pred_camera = vmap(forwardSingle)(self.stackedParams, images)
+        return pred_rotmat[:,0], pred_betas[:,0], pred_camera[:,0]
+
+    def selectExemplars(self, keep):
+        """Drop exemplars (e.g., converged ones), keeping the weights and the Adam states of the others
+            keep: list of exemplar indices to keep
+        """
+        keep = torch.tensor(keep, dtype=torch.long, device=next(iter(self.stackedParams.values())).device)
+
+        newParams = {}
+        for name, par in self.stackedParams.items():
+            newParams[name] = par.detach()[keep].requires_grad_(True)
+        newOptimizer = torch.optim.Adam(params=list(newParams.values()), lr=self.lr, weight_decay=0)
+
+        for name in self.stackedParams:
+            state = self.optimizer.state.get(self.stackedParams[name], None)
+            if not state:
+                continue
+            newState = {}
+            for k, v in state.items():
+                if isinstance(v, torch.Tensor) and v.dim()>0:      #exp_avg, exp_avg_sq
+                    newState[k] = v[keep]
+                else:       #step
+                    newState[k] = v.clone() if isinstance(v, torch.Tensor) else v
+            newOptimizer.state[newParams[name]] = newState
+
+        self.stackedParams = newParams
+        self.optimizer = newOptimizer
+
@@ -0,0 +1,294 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Run eftAllInDB with multiple worker processes, each with its own EFTFitter.
+
+The samples of the training DB are split into chunks of eft_chunkSize.
+Workers claim chunks from a shared manifest file with a lease, and mark them as done after exporting the outputs.
+While a worker runs a chunk, a heartbeat thread renews its lease every eft_leaseTime/4 seconds.
+If the lease is lost anyway (e.g., the worker was stalled for longer than eft_leaseTime), the worker abandons the chunk.
+A chunk whose lease expired (e.g., the worker crashed) is claimed again by another worker.
+Restarting the runner with the same manifest resumes from the unfinished chunks, without scanning the output folder.
+
+Manifest file layout (little endian):
+    header: magic(8s), numSamples(q), chunkSize(q), numChunks(q), firstOpenChunk(q)
+    chunk records (numChunks): state(b), pad(3x), workerId(i), leaseExpire(d)
+All accesses are done under an exclusive flock on the file.
+
+Usage:
+    python -m bodymocap.train.shardRunner --bExemplarMode --eft_outputDir (outputDir) --eft_numWorkers 4 (other TrainOptions)
+"""
+
+import os
+import sys
+import time
+import struct
+import fcntl
+import threading
+import multiprocessing
+
+import torch
+
+HEADER_FORMAT = '<8sqqqq'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+RECORD_FORMAT = '<bxxxid'
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+MANIFEST_MAGIC = b'EFTMANI1'
+
+CHUNK_TODO = 0
+CHUNK_LEASED = 1
+CHUNK_DONE = 2
+
+
+class WorkManifest(object):
+    """Shared list of sample chunks with their states (todo, leased, done)
+    The file is created by the first process opening it
+    """
+
+    def __init__(self, manifestPath, numSamples, chunkSize):
+        self.manifestPath = manifestPath
+        self.threadLock = threading.Lock()      #flock does not exclude threads sharing the fd (e.g., LeaseHeartbeat)
+        self.fd = os.open(manifestPath, os.O_RDWR | os.O_CREAT, 0o644)
+
+        with self._lock():
+            if os.fstat(self.fd).st_size==0:       #New manifest
+                numChunks = (numSamples + chunkSize -1) // chunkSize
+                data = struct.pack(HEADER_FORMAT, MANIFEST_MAGIC, numSamples, chunkSize, numChunks, 0)
+                data += struct.pack(RECORD_FORMAT, CHUNK_TODO, -1, 0.0) * numChunks
+                os.pwrite(self.fd, data, 0)
+                os.fsync(self.fd)
+
+            magic, self.numSamples, self.chunkSize, self.numChunks, _ = self._readHeader()
+            if magic != MANIFEST_MAGIC:
+                raise ValueError("Not a work manifest: {}".format(manifestPath))
+            if self.numSamples != numSamples or self.chunkSize != chunkSize:
+                raise ValueError("Manifest {} was made with numSamples={}, chunkSize={}, but current numSamples={}, chunkSize={}".format(
+                    manifestPath, self.numSamples, self.chunkSize, numSamples, chunkSize))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _lock(self):
+        manifest = self
+
+        class _Flock(object):
+            def __enter__(self):
+                manifest.threadLock.acquire()
+                fcntl.flock(manifest.fd, fcntl.LOCK_EX)
+
+            def __exit__(self, *args):
+                fcntl.flock(manifest.fd, fcntl.LOCK_UN)
+                manifest.threadLock.release()
+
+        return _Flock()
+
+    def _readHeader(self):
+        return struct.unpack(HEADER_FORMAT, os.pread(self.fd, HEADER_SIZE, 0))
+
+    def _writeFirstOpenChunk(self, chunkIdx):
+        os.pwrite(self.fd, struct.pack('<q', chunkIdx), HEADER_SIZE - 8)
+
+    def _readRecord(self, chunkIdx):
+        return struct.unpack(RECORD_FORMAT, os.pread(self.fd, RECORD_SIZE, HEADER_SIZE + chunkIdx*RECORD_SIZE))
+
+    def _writeRecord(self, chunkIdx, state, workerId, leaseExpire):
+        os.pwrite(self.fd, struct.pack(RECORD_FORMAT, state, workerId, leaseExpire), HEADER_SIZE + chunkIdx*RECORD_SIZE)
+
+    def chunkRange(self, chunkIdx):
+        start = chunkIdx * self.chunkSize
+        return start, min(start + self.chunkSize, self.numSamples)
+
+    def claim(self, workerId, leaseTime):
+        """Lease the first chunk which is not done and not leased by others (or its lease expired)
+            output: chunkIdx, or None if all chunks are done or leased
+        """
+        with self._lock():
+            firstOpenChunk = self._readHeader()[4]
+            now = time.time()
+            bAllDoneSoFar = True
+            for chunkIdx in range(firstOpenChunk, self.numChunks):
+                state, _, leaseExpire = self._readRecord(chunkIdx)
+                if state == CHUNK_DONE:
+                    if bAllDoneSoFar:       #Move the starting point of next search
+                        firstOpenChunk = chunkIdx+1
+                    continue
+                bAllDoneSoFar = False
+                if state == CHUNK_TODO or leaseExpire < now:
+                    self._writeRecord(chunkIdx, CHUNK_LEASED, workerId, now + leaseTime)
+                    self._writeFirstOpenChunk(firstOpenChunk)
+                    os.fsync(self.fd)
+                    return chunkIdx
+            self._writeFirstOpenChunk(firstOpenChunk)
+            return None
+
+    def renew(self, chunkIdx, workerId, leaseTime):
+        """Extend the lease of a chunk held by the worker
+            output: False if the chunk is no longer leased by the worker (e.g., the lease expired and another worker took it)
+        """
+        with self._lock():
+            state, leaseWorkerId, _ = self._readRecord(chunkIdx)
+            if state != CHUNK_LEASED or leaseWorkerId != workerId:
+                return False
+            self._writeRecord(chunkIdx, CHUNK_LEASED, workerId, time.time() + leaseTime)
+            os.fsync(self.fd)
+            return True
+
+    def complete(self, chunkIdx, workerId):
+        """Mark a chunk leased by the worker as done
+            output: False if the chunk is no longer leased by the worker. Then it is not marked
+        """
+        with self._lock():
+            state, leaseWorkerId, _ = self._readRecord(chunkIdx)
+            if state != CHUNK_LEASED or leaseWorkerId != workerId:
+                return False
+            self._writeRecord(chunkIdx, CHUNK_DONE, workerId, 0.0)
+            os.fsync(self.fd)
+            return True
+
+    def release(self, chunkIdx):
+        """Give up a leased chunk (e.g., after an error), so that other workers can take it"""
+        with self._lock():
+            state, _, _ = self._readRecord(chunkIdx)
+            if state == CHUNK_LEASED:
+                self._writeRecord(chunkIdx, CHUNK_TODO, -1, 0.0)
+                os.fsync(self.fd)
+
+    def resetLeases(self):
+        """Make all leased chunks claimable. Call when no worker is running (e.g., at restart after a crash)"""
+        with self._lock():
+            for chunkIdx in range(self._readHeader()[4], self.numChunks):
+                if self._readRecord(chunkIdx)[0] == CHUNK_LEASED:
+                    self._writeRecord(chunkIdx, CHUNK_TODO, -1, 0.0)
+            os.fsync(self.fd)
+
+    def isAllDone(self):
+        with self._lock():
+            for chunkIdx in range(self._readHeader()[4], self.numChunks):
+                if self._readRecord(chunkIdx)[0] != CHUNK_DONE:
+                    return False
+            return True
+
+    def summary(self):
+        """output: number of chunks in (todo, leased, done)"""
+        counts = [0, 0, 0]
+        with self._lock():
+            for chunkIdx in range(self.numChunks):
+                counts[self._readRecord(chunkIdx)[0]] += 1
+        return tuple(counts)
+
+
+class LeaseHeartbeat(object):
+    """Renew the lease of a chunk in a background thread, until stop() is called
+    isLost() becomes True if a renewal fails. The worker should then abandon the chunk
+    """
+
+    def __init__(self, manifest, chunkIdx, workerId, leaseTime):
+        self.stopEvent = threading.Event()
+        self.lostEvent = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(manifest, chunkIdx, workerId, leaseTime), daemon=True)
+        self.thread.start()
+
+    def _run(self, manifest, chunkIdx, workerId, leaseTime):
+        while self.stopEvent.wait(leaseTime / 4.0)==False:
+            if manifest.renew(chunkIdx, workerId, leaseTime)==False:
+                print("Warning: worker {} lost the lease of chunk {}".format(workerId, chunkIdx))
+                self.lostEvent.set()
+                return
+
+    def isLost(self):
+        return self.lostEvent.is_set()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join()
+
+
+def getManifestPath(options):
+    if options.eft_manifest is not None:
+        return options.eft_manifest
+    return os.path.join(options.eft_outputDir, 'manifest.bin')
+
+
+def eftShardWorker(workerId, numGPUs, params):
+    """A worker process. Claim chunks and run eftAllInDB on them until everything is done
+        numGPUs: counted by runShardedEFT, so that CUDA is not initialized here before CUDA_VISIBLE_DEVICES is set
+    """
+
+    #Assign a GPU before CUDA is initialized
+    if numGPUs>0:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(workerId % numGPUs)
+
+    from bodymocap.utils import TrainOptions
+    from bodymocap.train import EFTFitter
+    from bodymocap.utils.cpuProfile import setupCPUThreads
+
+    options = TrainOptions().parse_args(params)
+    if numGPUs==0 and options.eft_cpuThreads>=0:       #Pin each worker to its own cores
+        setupCPUThreads(options.eft_cpuThreads, options.eft_cpuInteropThreads, workerId, options.eft_numWorkers)
+    eftFitter = EFTFitter(options)
+    manifest = WorkManifest(getManifestPath(options), len(eftFitter.train_ds), options.eft_chunkSize)
+
+    while True:
+        chunkIdx = manifest.claim(workerId, options.eft_leaseTime)
+        if chunkIdx is None:
+            break
+        sampleRange = manifest.chunkRange(chunkIdx)
+        print(">> Worker {}: chunk {}/{}, samples {}-{}".format(workerId, chunkIdx, manifest.numChunks, sampleRange[0], sampleRange[1]))
+        heartbeat = LeaseHeartbeat(manifest, chunkIdx, workerId, options.eft_leaseTime)
+        try:
+            eftFitter.eftAllInDB(sampleRange=sampleRange, heartbeat=heartbeat)
+        except:
+            heartbeat.stop()
+            manifest.release(chunkIdx)
+            raise
+        heartbeat.stop()
+        if heartbeat.isLost() or manifest.complete(chunkIdx, workerId)==False:      #Another worker runs this chunk now
+            print(">> Worker {}: abandoned chunk {}".format(workerId, chunkIdx))
+
+    manifest.close()
+
+
+def runShardedEFT(params):
+    from bodymocap.utils import TrainOptions
+
+    options = TrainOptions().parse_args(params)
+    assert options.bExemplarMode
+    assert options.eft_outputDir is not None, "Set --eft_outputDir so that all workers write to the same folder"
+    assert options.bExemplar_dataLoaderStart<0 and options.bExemplar_dataLoaderEnd<0, "Samples are assigned by the manifest"
+    if (options.db_set =='panoptic' or "haggling" in options.db_set) and options.eft_panopticPklDict:
+        assert options.eft_chunkSize%100==0, "Panoptic pkl files have 100 samples each. eft_chunkSize should be a multiple of 100"
+    os.makedirs(options.eft_outputDir, exist_ok=True)
+
+    #Chunks leased by the workers of the previous run are no longer processed by anybody
+    manifestPath = getManifestPath(options)
+    if os.path.exists(manifestPath):
+        with open(manifestPath, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        manifest = WorkManifest(manifestPath, *struct.unpack(HEADER_FORMAT, header)[1:3])
+        manifest.resetLeases()
+        print("Resume from {}: (todo, leased, done) = {}".format(manifestPath, manifest.summary()))
+        manifest.close()
+
+    numGPUs = torch.cuda.device_count()
+    ctx = multiprocessing.get_context('spawn')
+    workers = []
+    for workerId in range(options.eft_numWorkers):
+        p = ctx.Process(target=eftShardWorker, args=(workerId, numGPUs, params))
+        p.start()
+        workers.append(p)
+
+    bFailed = False
+    for p in workers:
+        p.join()
+        bFailed = bFailed or p.exitcode != 0
+
+    if bFailed:
+        print("Some workers failed. Run again to process the remaining chunks")
+    return not bFailed
+
+
+if __name__ == '__main__':
+    if not runShardedEFT(sys.argv[1:]):
+        sys.exit(1)
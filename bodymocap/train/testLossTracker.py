@@ -0,0 +1,112 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Low-overhead test error tracking for bExemplar_analysis_testloss.
+
+Instead of running the full test() (data loading, GT SMPL, ...) after every exemplar,
+the preprocessed crops and GT 3D joints of a fixed subset of the test DB are computed once.
+After that, each evaluation only runs the network and the error computation, the same way as apps/eval.py.
+The errors are logged to a compact .npy file: (numEvals, 1 + 2*numTestDBs) float64
+    [sampleIdx, mpjpe_mm (db0), recon_error_mm (db0), mpjpe_mm (db1), ...]
+"""
+
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from bodymocap.core import config
+from bodymocap.core import constants
+from bodymocap.models import SMPL
+from bodymocap.utils.pose_utils import reconstruction_error
+
+
+class TestLossTracker(object):
+    """Cached evaluation subset of a test DB
+        maxSamples: number of test samples, evenly spaced over the DB. <=0 to use all
+    """
+
+    def __init__(self, dataset, datasetName, device, maxSamples=500, batch_size=64, num_workers=4):
+        self.datasetName = datasetName
+        self.device = device
+        self.batch_size = batch_size
+
+        if maxSamples>0 and maxSamples < len(dataset):
+            dataset = Subset(dataset, np.linspace(0, len(dataset)-1, maxSamples).astype(np.int64).tolist())
+
+        self.smpl_neutral = SMPL(config.SMPL_MODEL_DIR, create_transl=False).to(device)
+        self.J_regressor = torch.from_numpy(np.load(config.JOINT_REGRESSOR_H36M)).float().to(device)
+        self.joint_mapper_h36m = constants.H36M_TO_J14
+
+        #Load the images and compute the GT joints once
+        smpl_male, smpl_female = None, None
+        images, gt_keypoints_3d = [], []
+        for batch in DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers):
+            images.append(batch['img'].to(device))
+            if 'h36m' in datasetName:
+                gt_keypoints_3d.append(batch['pose_3d'][:, constants.J24_TO_J14, :-1].to(device))
+            else:     #For 3DPW get the 14 common joints from the rendered shape
+                if smpl_male is None:
+                    smpl_male = SMPL(config.SMPL_MODEL_DIR, gender='male', create_transl=False).to(device)
+                    smpl_female = SMPL(config.SMPL_MODEL_DIR, gender='female', create_transl=False).to(device)
+                gt_pose = batch['pose'].to(device)
+                gt_betas = batch['betas'].to(device)
+                gender = batch['gender'].to(device)
+                with torch.no_grad():
+                    gt_vertices = smpl_male(global_orient=gt_pose[:,:3], body_pose=gt_pose[:,3:], betas=gt_betas).vertices
+                    gt_vertices_female = smpl_female(global_orient=gt_pose[:,:3], body_pose=gt_pose[:,3:], betas=gt_betas).vertices
+                gt_vertices[gender==1, :, :] = gt_vertices_female[gender==1, :, :]
+                gt_keypoints_3d.append(self.verticesToJoints(gt_vertices))
+
+        self.images = torch.cat(images)
+        self.gt_keypoints_3d = torch.cat(gt_keypoints_3d)
+        print(">> TestLossTracker: cached {} samples of {}".format(len(self.images), datasetName))
+
+    def verticesToJoints(self, vertices):
+        """14 joints from the mesh, relative to the pelvis"""
+        keypoints_3d = torch.matmul(self.J_regressor[None], vertices)
+        pelvis = keypoints_3d[:, [0],:].clone()
+        return keypoints_3d[:, self.joint_mapper_h36m, :] - pelvis
+
+    def evaluate(self, model):
+        """output: (mpjpe_mm, recon_error_mm) averaged over the subset"""
+        bWasTraining = model.training
+        model.eval()
+
+        error, r_error = [], []
+        with torch.no_grad():
+            for start in range(0, len(self.images), self.batch_size):
+                pred_rotmat, pred_betas, pred_camera = model(self.images[start:start+self.batch_size])
+                pred_vertices = self.smpl_neutral(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False).vertices
+                pred_keypoints_3d = self.verticesToJoints(pred_vertices)
+                gt_keypoints_3d = self.gt_keypoints_3d[start:start+self.batch_size]
+
+                error.append(torch.sqrt(((pred_keypoints_3d - gt_keypoints_3d) ** 2).sum(dim=-1)).mean(dim=-1).cpu().numpy())
+                r_error.append(reconstruction_error(pred_keypoints_3d.cpu().numpy(), gt_keypoints_3d.cpu().numpy(), reduction=None))
+
+        model.train(bWasTraining)
+        return np.hstack(error).mean()*1000, np.hstack(r_error).mean()*1000
+
+
+class TestLossLog(object):
+    """Test error curve over exemplars, saved as a .npy file (see above)"""
+
+    def __init__(self, logPath, datasetNames):
+        self.logPath = logPath
+        self.datasetNames = datasetNames
+        self.rows = []
+
+    def append(self, sampleIdx, errors):
+        """errors: list of (mpjpe_mm, recon_error_mm), in the order of datasetNames"""
+        row = [sampleIdx]
+        for mpjpe_mm, recon_error_mm in errors:
+            row += [mpjpe_mm, recon_error_mm]
+        self.rows.append(row)
+
+    def save(self):
+        if len(self.rows)==0:
+            return
+        tempPath = self.logPath + '.tmp.npy'
+        np.save(tempPath, np.array(self.rows, dtype=np.float64))
+        os.replace(tempPath, self.logPath)
@@ -55,7 +55,7 @@ class Trainer(BaseTrainer):
     def init_fn(self):
         self.train_ds = MixedDataset(self.options, ignore_3d=self.options.ignore_3d, is_train=True)
 
-        self.model = hmr(config.SMPL_MEAN_PARAMS, pretrained=True).to(self.device)
+        self.model = hmr(config.SMPL_MEAN_PARAMS, pretrained=True, backbone=self.options.backbone).to(self.device)
 
         if self.options.bExemplarMode:
             lr = 5e-5 * 0.2
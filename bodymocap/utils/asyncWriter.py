@@ -0,0 +1,84 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Background thread to write output files, so that fitting and disk I/O overlap.
+The queue is bounded: if the disk is slower than the fitter, submit() blocks instead of piling up outputs in memory.
+Pending writes are flushed at exit and on SIGTERM.
+"""
+
+import os
+import atexit
+import pickle
+import queue
+import signal
+import threading
+
+
+def writePickle(outputPath, data):
+    """Write to a temp file, then rename it, so that a crash never leaves a truncated pkl file (which would be skipped as done at resume)"""
+    tempPath = '{}.{}.tmp'.format(outputPath, os.getpid())
+    try:
+        with open(tempPath,'wb') as f:
+            pickle.dump(data,f)
+    except:
+        os.remove(tempPath)
+        raise
+    os.replace(tempPath, outputPath)
+
+
+class AsyncWriter(object):
+
+    def __init__(self, maxQueueSize=32):
+        self.queue = queue.Queue(maxsize=maxQueueSize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread():
+            self.prevSigtermHandler = signal.signal(signal.SIGTERM, self._onSigterm)
+        else:
+            self.prevSigtermHandler = None
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                func, args = job
+                func(*args)
+            except Exception as e:
+                print("AsyncWriter: failed to write: {}".format(e))
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _checkError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, func, *args):
+        """Run func(*args) in the writer thread. The arguments should not be modified afterwards"""
+        self._checkError()
+        self.queue.put((func, args))
+
+    def flush(self):
+        """Wait until all submitted writes are done"""
+        self.queue.join()
+        self._checkError()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _onSigterm(self, signum, frame):
+        print("AsyncWriter: SIGTERM. Flushing {} pending writes".format(self.queue.qsize()))
+        self.close()
+        if callable(self.prevSigtermHandler):
+            self.prevSigtermHandler(signum, frame)
+        else:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.raise_signal(signal.SIGTERM)
@@ -0,0 +1,142 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Persistent index of the samples whose EFT outputs (pkl files) are already saved, for skip-existing in eftAllInDB.
+It is loaded once at start, instead of checking os.path.exists for each sample, which is slow on networked filesystems.
+
+The index is a bitmap keyed by sampleIdx (with bExemplar_dataLoaderStart), one file per run config (see getConfigKey):
+    (outputDir)/completed_(configHash).bin
+    header: magic(8s), configHash(32s)
+    bitmap: bit (sampleIdx % 8) of byte (sampleIdx // 8) is set if the sample is done
+Bits are set under an exclusive flock, after the output file is written, so multiple processes can update the same index.
+
+To build the index from an existing output folder (one time):
+    python -m bodymocap.utils.completionIndex --eft_outputDir (outputDir) (other TrainOptions of the run)
+This is never done automatically, since the files in the folder may be from another config.
+Without the index, eftAllInDB checks the existence of each output file.
+"""
+
+import os
+import sys
+import glob
+import fcntl
+import struct
+import pickle
+import hashlib
+import threading
+
+from bodymocap.utils.asyncWriter import writePickle
+from bodymocap.utils.streamWriter import iterStreamRecords, getStreamChunkPaths
+
+HEADER_FORMAT = '<8s32s'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+INDEX_MAGIC = b'EFTDONE1'
+
+#Options which change the outputs. Outputs made with different values are not counted as done
+CONFIG_KEYS = ['db_set', 'pretrained_checkpoint', 'lr_eft', 'maxExemplarIter', 'eft_stopPolicy', 'eft_thresh_keyptErr_2d',
+               'eft_withHip2D', 'bUseSMPLX', 'bUseHand3D', 'bExemplarWith3DSkel', 'eft_optimizer', 'lr_lbfgs', 'eft_lbfgsHistory']
+
+
+def getConfigKey(options):
+    return ';'.join(['{}={}'.format(k, getattr(options, k, None)) for k in CONFIG_KEYS])
+
+
+def getIndexPath(outputDir, configKey):
+    configHash = hashlib.md5(configKey.encode('utf-8')).hexdigest()
+    return os.path.join(outputDir, 'completed_{}.bin'.format(configHash[:12])), configHash
+
+
+class CompletionIndex(object):
+
+    def __init__(self, outputDir, configKey):
+        self.outputDir = outputDir
+        self.indexPath, configHash = getIndexPath(outputDir, configKey)
+        self.threadLock = threading.Lock()      #flock does not exclude threads sharing the fd (e.g., AsyncWriter)
+        self.fd = os.open(self.indexPath, os.O_RDWR | os.O_CREAT, 0o644)
+
+        with self._lock():
+            if os.fstat(self.fd).st_size==0:        #New index
+                os.pwrite(self.fd, struct.pack(HEADER_FORMAT, INDEX_MAGIC, configHash.encode('ascii')), 0)
+            magic, fileHash = struct.unpack(HEADER_FORMAT, os.pread(self.fd, HEADER_SIZE, 0))
+            if magic != INDEX_MAGIC or fileHash.decode('ascii') != configHash:
+                raise ValueError("Not a completion index of this run config: {}".format(self.indexPath))
+            self.bitmap = bytearray(os.pread(self.fd, os.fstat(self.fd).st_size - HEADER_SIZE, HEADER_SIZE))
+
+    def close(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def _lock(self):
+        index = self
+
+        class _Flock(object):
+            def __enter__(self):
+                index.threadLock.acquire()
+                fcntl.flock(index.fd, fcntl.LOCK_EX)
+
+            def __exit__(self, *args):
+                fcntl.flock(index.fd, fcntl.LOCK_UN)
+                index.threadLock.release()
+
+        return _Flock()
+
+    def __len__(self):
+        return sum(bin(b).count('1') for b in self.bitmap)
+
+    def isDone(self, sampleIdx):
+        byteIdx = sampleIdx // 8
+        return byteIdx < len(self.bitmap) and (self.bitmap[byteIdx] >> (sampleIdx % 8)) & 1 == 1
+
+    def markDone(self, sampleIndices):
+        """sampleIndices: list of sampleIdx whose outputs have been written"""
+        masks = {}      #byteIdx -> bits
+        for sampleIdx in sampleIndices:
+            sampleIdx = int(sampleIdx)      #May be a tensor (e.g., keys of the panoptic outputList)
+            masks[sampleIdx // 8] = masks.get(sampleIdx // 8, 0) | (1 << (sampleIdx % 8))
+
+        with self._lock():
+            for byteIdx, mask in masks.items():     #Read again, since other processes may have set other bits of the byte
+                data = os.pread(self.fd, 1, HEADER_SIZE + byteIdx)
+                value = (data[0] if len(data)==1 else 0) | mask
+                os.pwrite(self.fd, bytes([value]), HEADER_SIZE + byteIdx)
+
+                if byteIdx >= len(self.bitmap):
+                    self.bitmap.extend(bytes(byteIdx + 1 - len(self.bitmap)))
+                self.bitmap[byteIdx] |= value
+
+
+def writePickleAndMark(outputPath, data, completionIndex, sampleIndices):
+    """Write a pkl file (atomically, see writePickle), then mark the samples in it as done"""
+    writePickle(outputPath, data)
+    completionIndex.markDone(sampleIndices)
+
+
+def rebuildCompletionIndex(outputDir, configKey, bPanoptic=False):
+    """Mark all samples saved in an existing output folder
+        Files are named (imgName)_(sampleIdx).pkl, or (sampleIdx).pkl with a dict of outputs per sampleIdx for Panoptic
+        Records of stream files (see streamWriter.py) are also counted
+    """
+    completionIndex = CompletionIndex(outputDir, configKey)
+    sampleIndices = []
+    for pklPath in glob.glob(os.path.join(outputDir, '*.pkl')):
+        if bPanoptic:
+            with open(pklPath,'rb') as f:
+                sampleIndices += [int(k) for k in pickle.load(f).keys()]
+        else:
+            sampleIndices.append(int(os.path.basename(pklPath)[:-4].rsplit('_', 1)[-1]))
+    for chunkPath in getStreamChunkPaths(outputDir):
+        sampleIndices += [sampleIdx for sampleIdx, _ in iterStreamRecords(chunkPath, bLoadPayload=False)]
+    completionIndex.markDone(sampleIndices)
+    print("Completion index: {} ({} samples)".format(completionIndex.indexPath, len(completionIndex)))
+    return completionIndex
+
+
+if __name__ == '__main__':
+    from bodymocap.utils import TrainOptions
+
+    options = TrainOptions().parse_args(sys.argv[1:])
+    assert options.eft_outputDir is not None, "Set --eft_outputDir"
+    bPanoptic = options.db_set =='panoptic' or "haggling" in options.db_set
+    rebuildCompletionIndex(options.eft_outputDir, getConfigKey(options), bPanoptic).close()
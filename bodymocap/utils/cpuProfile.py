@@ -0,0 +1,59 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+CPU execution profile for EFT on CPU-only nodes (--eft_cpuProfile).
+    - bf16 autocast for the network. Parameters and Adam states stay in fp32, as the master copy of the weights
+    - channels_last memory format for the ResNet tensors
+    - explicit intra-/inter-op threads per process (--eft_cpuThreads, --eft_cpuInteropThreads),
+      and pinning of sharded workers to separate cores
+"""
+
+import os
+import contextlib
+
+import torch
+
+g_numThreads = None     #Set by setupCPUThreads
+
+
+def setupCPUThreads(numThreads, numInteropThreads=1, workerId=None, numWorkers=1):
+    """Set the number of threads of this process. Only the first call takes effect
+        numThreads: 0 to use (available cores) / numWorkers
+        workerId: if given, pin this process to its own numThreads cores
+        output: number of intra-op threads
+    """
+    global g_numThreads
+    if g_numThreads is not None:
+        return g_numThreads
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    if numThreads<=0:
+        numThreads = max(len(cores) // numWorkers, 1)
+
+    if workerId is not None and hasattr(os, 'sched_setaffinity'):
+        start = (workerId * numThreads) % len(cores)
+        workerCores = [cores[(start + i) % len(cores)] for i in range(min(numThreads, len(cores)))]
+        os.sched_setaffinity(0, workerCores)
+        print(">> Worker {}: pinned to cores {}".format(workerId, workerCores))
+
+    torch.set_num_threads(numThreads)
+    try:
+        torch.set_num_interop_threads(numInteropThreads)
+    except RuntimeError:        #Should be called before any inter-op parallel work
+        print("Warning: could not set the number of inter-op threads (already used)")
+
+    g_numThreads = numThreads
+    return numThreads
+
+
+def autocastContext(bEnabled):
+    """bf16 autocast on CPU if bEnabled"""
+    if bEnabled:
+        return torch.autocast(device_type='cpu', dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def toChannelsLast(x):
+    if x.dim()==4:
+        return x.contiguous(memory_format=torch.channels_last)
+    return x
@@ -0,0 +1,107 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Content-addressed cache of EFT fits (--eft_fitCacheDir), shared by runs over overlapping DBs
+(e.g., COCO 2014 and its all-annot variant, LSPet and LSPet-test) with the same initial checkpoint.
+
+The key of a sample is a hash of
+    - the input crop (batch['img'], which depends on the image and the bbox), or the image file name (--eft_fitCacheKey imageName)
+    - bbox center, scale and 2D keypoints
+    - the contents of pretrained_checkpoint and the options which change the fit (getFitOptionKeys)
+The db name is not part of the key, so the same sample in another DB is a hit.
+Each fit is a pkl file of the output dict of eftAllInDB:
+    (cacheDir)/(key[:2])/(key).pkl
+"""
+
+import os
+import pickle
+import hashlib
+
+import numpy as np
+
+#Options which change the fit: all EFT options (FIT_OPTION_PREFIXES) and FIT_OPTION_KEYS, except NON_FIT_OPTION_KEYS.
+#New EFT options are part of the key by default. pretrained_checkpoint is replaced by the hash of its contents
+FIT_OPTION_PREFIXES = ['eft_', 'ablation_']
+FIT_OPTION_KEYS = ['lr_eft', 'lr_lbfgs', 'maxExemplarIter', 'backbone', 'img_res', 'bUseSMPLX', 'bUseHand3D', 'bExemplarWith3DSkel',
+                   'keypoint_loss_weight', 'beta_loss_weight', 'openpose_train_weight', 'gt_train_weight']
+#Paths, output formats, and speed settings, which give the same fit
+NON_FIT_OPTION_KEYS = ['eft_outputDir', 'eft_outputFormat', 'eft_storeChunkSize', 'eft_storeFlushSec', 'eft_asyncWriterQueue', 'eft_completionIndex',
+                       'eft_fitCacheDir', 'eft_fitCacheKey', 'eft_noStageTiming', 'eft_stageTimingSync', 'eft_panopticPklDict',
+                       'eft_streamChunkMB', 'eft_streamSyncEvery', 'eft_cpuThreads', 'eft_cpuInteropThreads', 'eft_numWorkers',
+                       'eft_chunkSize', 'eft_manifest', 'eft_leaseTime', 'eft_batch_size', 'eft_noPrefixCache']
+
+
+def getFitOptionKeys(options):
+    return sorted(k for k in vars(options)
+                  if (k in FIT_OPTION_KEYS or any(k.startswith(p) for p in FIT_OPTION_PREFIXES)) and k not in NON_FIT_OPTION_KEYS)
+
+#Output fields which belong to the sample in the current DB, not to the fit. SPIN fits (opt_pose, opt_beta) are from the fits_dict of the DB
+SAMPLE_KEYS = ['sampleIdx', 'imageName', 'annotId', 'subjectId', 'opt_pose', 'opt_beta']
+
+
+def hashFile(filePath, chunkSize=1<<24):
+    h = hashlib.sha1()
+    with open(filePath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunkSize), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FitCache(object):
+
+    def __init__(self, cacheDir, options):
+        self.cacheDir = cacheDir
+        self.bKeyByImage = options.eft_fitCacheKey=='image'
+        os.makedirs(cacheDir, exist_ok=True)
+
+        checkpointHash = hashFile(options.pretrained_checkpoint) if options.pretrained_checkpoint is not None else 'None'
+        configKey = ';'.join(['{}={}'.format(k, getattr(options, k)) for k in getFitOptionKeys(options)])
+        self.runKey = '{};{}'.format(checkpointHash, configKey)
+        self.numHits, self.numMisses = 0, 0
+
+    def getKey(self, batch):
+        """batch: input batch of a single sample, before moving it to the GPU"""
+        h = hashlib.sha1(self.runKey.encode('utf-8'))
+        if self.bKeyByImage:
+            h.update(np.ascontiguousarray(batch['img'][0].numpy(), dtype=np.float32).tobytes())
+        else:
+            h.update(os.path.basename(batch['imgname'][0]).encode('utf-8'))
+        for k in ['center', 'scale', 'keypoints']:
+            h.update(np.ascontiguousarray(batch[k][0].numpy(), dtype=np.float32).tobytes())
+        return h.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.cacheDir, key[:2], key + '.pkl')
+
+    def get(self, key, batch, spinFits):
+        """spinFits: (opt_pose, opt_beta) of the sample in the current DB, as numpy arrays
+            output: the cached output with the sample fields of the current batch, or None
+        """
+        cachePath = self.getPath(key)
+        if os.path.exists(cachePath)==False:
+            self.numMisses +=1
+            return None
+
+        with open(cachePath,'rb') as f:
+            output = pickle.load(f)
+        self.numHits +=1
+
+        for k in SAMPLE_KEYS:
+            output.pop(k, None)
+        output['sampleIdx'] = batch['sample_index'].numpy()
+        output['opt_pose'], output['opt_beta'] = spinFits
+        output['imageName'] = batch['imgname']
+        if 'annotId' in batch.keys():
+            output['annotId'] = batch['annotId'].numpy()
+        if 'subjectId' in batch.keys() and batch['subjectId'][0]!="":
+            output['subjectId'] = batch['subjectId'][0].item()
+        output['fitCacheHit'] = True
+        return output
+
+    def put(self, key, output):
+        cachePath = self.getPath(key)
+        os.makedirs(os.path.dirname(cachePath), exist_ok=True)
+        tempPath = '{}.{}.tmp'.format(cachePath, os.getpid())      #Other processes may write the same key
+        with open(tempPath,'wb') as f:
+            pickle.dump(output, f)
+        os.replace(tempPath, cachePath)
@@ -85,7 +85,7 @@ def rot6d_to_rotmat(x):
     a2 = x[:, :, 1]
     b1 = F.normalize(a1)
     b2 = F.normalize(a2 - torch.einsum('bi,bi->b', b1, a2).unsqueeze(-1) * b1)
-    b3 = torch.cross(b1, b2)
+    b3 = torch.cross(b1, b2, dim=1)
     return torch.stack((b1, b2, b3), dim=-1)
 
 
@@ -0,0 +1,75 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Per-iteration metrics of EFT, one row per (sample, iteration), for convergence analysis.
+
+Each run (or shard) writes its own preallocated .npy file with a structured dtype (ITER_LOG_DTYPE).
+Rows are written in place through a memory map, so the file can be loaded with np.load(mmap_mode='r')
+while it is being written. Rows not written yet have sampleIdx==-1.
+    (outputDir)/iterlog_(writerTag).npy
+"""
+
+import os
+import glob
+import socket
+import time
+
+import numpy as np
+
+ITER_LOG_DTYPE = np.dtype([('sampleIdx', '<i8'), ('iter', '<i4'),
+                           ('loss_keypoints', '<f4'),     #2D keypoint loss
+                           ('mpjpe', '<f4'),              #mm
+                           ('r_error', '<f4'),            #PA-MPJPE, mm
+                           ('time', '<f4')])              #Seconds of the iteration
+
+ITER_LOG_PREFIX = 'iterlog_'
+
+
+class IterLogWriter(object):
+    """maxRows: upper bound of the number of rows, e.g., (number of samples) x maxExemplarIter"""
+
+    def __init__(self, outputDir, maxRows, flushEvery=1000):
+        writerTag = '{}_{}_{}'.format(socket.gethostname(), os.getpid(), int(time.time()*1000))
+        self.logPath = os.path.join(outputDir, '{}{}.npy'.format(ITER_LOG_PREFIX, writerTag))
+        self.log = np.lib.format.open_memmap(self.logPath, mode='w+', dtype=ITER_LOG_DTYPE, shape=(maxRows,))
+        self.log['sampleIdx'] = -1
+        self.numRows = 0
+        self.flushEvery = flushEvery
+
+    def append(self, sampleIdx, it, loss_keypoints, mpjpe, r_error, elapsed):
+        if self.numRows >= len(self.log):
+            raise IndexError("IterLogWriter: more than {} rows".format(len(self.log)))
+        self.log[self.numRows] = (sampleIdx, it, loss_keypoints, mpjpe, r_error, elapsed)
+        self.numRows += 1
+        if self.numRows % self.flushEvery == 0:
+            self.log.flush()
+
+    def close(self):
+        if self.log is not None:
+            self.log.flush()
+            self.log = None
+
+
+def loadIterLogs(logDir):
+    """Load all iteration logs in a folder (e.g., written by multiple shards)
+        output: structured array (ITER_LOG_DTYPE) of the written rows, sorted by (sampleIdx, iter)
+    """
+    logs = []
+    for logPath in sorted(glob.glob(os.path.join(logDir, ITER_LOG_PREFIX + '*.npy'))):
+        log = np.load(logPath, mmap_mode='r')
+        logs.append(log[log['sampleIdx']>=0])
+    if len(logs)==0:
+        return np.zeros((0,), dtype=ITER_LOG_DTYPE)
+    log = np.concatenate(logs)
+    return log[np.lexsort((log['iter'], log['sampleIdx']))]
+
+
+def iterLogToMatrix(log, field):
+    """output: (numIters, numSamples) array of a field, NaN if the sample stopped earlier
+        and the sampleIdx of each column
+    """
+    sampleIndices, col = np.unique(log['sampleIdx'], return_inverse=True)
+    numIters = log['iter'].max()+1 if len(log)>0 else 0
+    matrix = np.full((numIters, len(sampleIndices)), np.nan, dtype=np.float32)
+    matrix[log['iter'], col] = log[field]
+    return matrix, sampleIndices
@@ -94,4 +94,18 @@ def reconstruction_error_fromMesh(J_regressor_batch, joint_mapper_h36m, S1_verti
     # Reconstuction_error
     r_error = reconstruction_error(pred_keypoints_3d.detach().cpu().numpy(), gt_keypoints_3d.detach().cpu().numpy(), reduction=None)
 
-    return r_error
\ No newline at end of file
+    return r_error
+
+
+def mpjpe_fromMesh(J_regressor_batch, joint_mapper_h36m, S1_vertices, S2_vertices):
+    """MPJPE of the 14 joints of the meshes, after aligning the pelvis"""
+    pred_keypoints_3d = torch.matmul(J_regressor_batch, S1_vertices)
+    pred_pelvis = pred_keypoints_3d[:, [0],:].clone()
+    pred_keypoints_3d = pred_keypoints_3d[:, joint_mapper_h36m, :] - pred_pelvis
+
+    gt_keypoints_3d = torch.matmul(J_regressor_batch, S2_vertices)
+    gt_pelvis = gt_keypoints_3d[:, [0],:].clone()
+    gt_keypoints_3d = gt_keypoints_3d[:, joint_mapper_h36m, :] - gt_pelvis
+
+    error = torch.sqrt(((pred_keypoints_3d - gt_keypoints_3d) ** 2).sum(dim=-1)).mean(dim=-1)
+    return error.detach().cpu().numpy()
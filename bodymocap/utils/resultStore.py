@@ -0,0 +1,185 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Chunked columnar store for EFT outputs, instead of one pkl file per sample.
+
+A store is a folder with chunk folders. Each chunk has one .npy file per field, with the samples along the first axis.
+    (storeDir)/chunk_(writerTag)_(seq)/pred_pose_rotmat.npy     #(N,24,3,3) float32
+                                      /imageName.npy            #(N,) unicode
+                                      ...
+Fields not in the schema below (e.g., test_error_*, warmStart, fitCacheHit) are kept in a pkl file per chunk:
+                                      /extra.pkl                #list of dicts, one per sample
+A chunk is written to a temporary folder and renamed when complete, so readers never see partial chunks
+and multiple writers (e.g., sharded workers) can append to the same store without locking.
+A chunk is written every chunkSize samples or flushInterval seconds, so that a crash loses only a few outputs.
+"""
+
+import os
+import glob
+import pickle
+import socket
+import time
+
+import numpy as np
+
+#Per-sample arrays. Saved as (N, ...) float32
+FLOAT_FIELDS = ['pred_pose_rotmat', 'pred_shape', 'pred_camera',
+                'pred_pose_rotmat_init', 'pred_shape_init', 'pred_camera_init',
+                'scale', 'center', 'keypoint2d', 'keypoint2d_cropped']
+#Scalars. Saved as (N,)
+SCALAR_FIELDS = {'loss': np.float32, 'loss_keypoints_2d': np.float32, 'loss_init': np.float32, 'loss_keypoints_2d_init': np.float32,
+                 'time_reset': np.float32, 'numOfIteration': np.int32}
+#Ids. Saved as (N,) int64. -1 if not available
+ID_FIELDS = ['sampleIdx', 'annotId', 'subjectId']
+#Strings. Saved as (N,) unicode
+STRING_FIELDS = ['imageName', 'smpltype', 'stopPolicy', 'stopReason']
+
+CHUNK_PREFIX = 'chunk_'
+TEMP_PREFIX = '.tmp_'
+EXTRA_FILE = 'extra.pkl'
+
+
+def _firstItem(value):
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return value[0]
+    return value
+
+
+class ResultStoreWriter(object):
+    """Buffer outputs of eftAllInDB and write them as a chunk every chunkSize samples or flushInterval seconds (and at flush)"""
+
+    def __init__(self, storeDir, chunkSize=50, flushInterval=60):
+        self.storeDir = storeDir
+        self.chunkSize = chunkSize
+        self.flushInterval = flushInterval
+        self.bufferStartTime = None
+        os.makedirs(storeDir, exist_ok=True)
+        #Unique among concurrent writers
+        self.writerTag = '{}_{}_{}'.format(socket.gethostname(), os.getpid(), int(time.time()*1000))
+        self.chunkCnt = 0
+        self.buffer = []
+
+    def append(self, output):
+        """output: output dict of a sample, in the same format as the pkl files"""
+        if len(self.buffer)==0:
+            self.bufferStartTime = time.time()
+        self.buffer.append(output)
+        if len(self.buffer) >= self.chunkSize or time.time() - self.bufferStartTime >= self.flushInterval:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer)==0:
+            return None
+
+        chunkName = '{}{}_{:06d}'.format(CHUNK_PREFIX, self.writerTag, self.chunkCnt)
+        tempDir = os.path.join(self.storeDir, TEMP_PREFIX + chunkName)
+        os.makedirs(tempDir)
+
+        storedKeys = set(ID_FIELDS + STRING_FIELDS)
+        for key in FLOAT_FIELDS:
+            if all(key in o for o in self.buffer):
+                np.save(os.path.join(tempDir, key + '.npy'), np.concatenate([np.asarray(o[key], dtype=np.float32).reshape((1,) + np.shape(o[key])[1:]) for o in self.buffer]))
+                storedKeys.add(key)
+        for key, dtype in SCALAR_FIELDS.items():
+            if all(key in o for o in self.buffer):
+                np.save(os.path.join(tempDir, key + '.npy'), np.array([_firstItem(np.asarray(o[key]).reshape(-1)) for o in self.buffer], dtype=dtype))
+                storedKeys.add(key)
+        for key in ID_FIELDS:
+            np.save(os.path.join(tempDir, key + '.npy'), np.array([int(np.asarray(o[key]).reshape(-1)[0]) if key in o else -1 for o in self.buffer], dtype=np.int64))
+        for key in STRING_FIELDS:
+            np.save(os.path.join(tempDir, key + '.npy'), np.array([str(_firstItem(o[key])) if key in o else '' for o in self.buffer]))
+
+        #Fields not in the schema, or not in all samples of the chunk
+        extras = [{k: v for k, v in o.items() if k not in storedKeys} for o in self.buffer]
+        if any(len(e)>0 for e in extras):
+            with open(os.path.join(tempDir, EXTRA_FILE), 'wb') as f:
+                pickle.dump(extras, f)
+
+        os.rename(tempDir, os.path.join(self.storeDir, chunkName))      #Atomic
+        print("Saved: {} ({} samples)".format(chunkName, len(self.buffer)))
+        self.chunkCnt += 1
+        self.buffer = []
+        return chunkName
+
+
+class ResultStoreReader(object):
+    """Random access to the samples in a store by sampleIdx, imageName, or annotId"""
+
+    def __init__(self, storeDir):
+        self.storeDir = storeDir
+        self.chunks = []            #List of dicts: field name -> array (memory mapped)
+        self.sampleIdxLookup = {}   #sampleIdx -> (chunkIdx, row)
+        self.imageNameLookup = {}   #imageName -> list of (chunkIdx, row)
+        self.annotIdLookup = {}     #annotId -> list of (chunkIdx, row)
+        self.reload()
+
+    def reload(self):
+        """Load chunks added after the last reload"""
+        loaded = set(c['_name'] for c in self.chunks)
+        for chunkDir in sorted(glob.glob(os.path.join(self.storeDir, CHUNK_PREFIX + '*'))):
+            chunkName = os.path.basename(chunkDir)
+            if chunkName in loaded:
+                continue
+            chunk = {'_name': chunkName}
+            for fileName in os.listdir(chunkDir):
+                if fileName.endswith('.npy'):
+                    chunk[fileName[:-4]] = np.load(os.path.join(chunkDir, fileName), mmap_mode='r')
+            if os.path.exists(os.path.join(chunkDir, EXTRA_FILE)):
+                with open(os.path.join(chunkDir, EXTRA_FILE), 'rb') as f:
+                    chunk['_extra'] = pickle.load(f)
+            chunkIdx = len(self.chunks)
+            self.chunks.append(chunk)
+
+            for row, (sampleIdx, imageName, annotId) in enumerate(zip(chunk['sampleIdx'], chunk['imageName'], chunk['annotId'])):
+                self.sampleIdxLookup[int(sampleIdx)] = (chunkIdx, row)     #The latest one if duplicated
+                self.imageNameLookup.setdefault(str(imageName), []).append((chunkIdx, row))
+                if annotId >= 0:
+                    self.annotIdLookup.setdefault(int(annotId), []).append((chunkIdx, row))
+
+    def __len__(self):
+        return len(self.sampleIdxLookup)
+
+    def __contains__(self, sampleIdx):
+        return int(sampleIdx) in self.sampleIdxLookup
+
+    def sampleIndices(self):
+        return sorted(self.sampleIdxLookup.keys())
+
+    def _getRow(self, chunkIdx, row):
+        """output: dict in the same format as the pkl files (arrays with the batch dimension)"""
+        chunk = self.chunks[chunkIdx]
+        output = {}
+        for key, values in chunk.items():
+            if key in ['_name', '_extra']:
+                continue
+            if key in FLOAT_FIELDS:
+                output[key] = np.array(values[row:row+1])
+            elif key in SCALAR_FIELDS:
+                output[key] = values[row].item()
+            elif key in ID_FIELDS:
+                if values[row] >= 0:
+                    output[key] = np.array(values[row:row+1])
+            elif key == 'imageName':
+                output[key] = [str(values[row])]
+            elif len(values[row]) > 0:
+                output[key] = str(values[row])
+        if '_extra' in chunk:
+            output.update(chunk['_extra'][row])
+        return output
+
+    def getBySampleIdx(self, sampleIdx):
+        return self._getRow(*self.sampleIdxLookup[int(sampleIdx)])
+
+    def getByImageName(self, imageName):
+        return [self._getRow(*loc) for loc in self.imageNameLookup.get(imageName, [])]
+
+    def getByAnnotId(self, annotId):
+        return [self._getRow(*loc) for loc in self.annotIdLookup.get(int(annotId), [])]
+
+    def __iter__(self):
+        for sampleIdx in self.sampleIndices():
+            yield self.getBySampleIdx(sampleIdx)
+
+
+def isResultStore(dirPath):
+    return len(glob.glob(os.path.join(dirPath, CHUNK_PREFIX + '*'))) > 0
@@ -0,0 +1,92 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Per-stage wall time of eftAllInDB, accumulated per sample.
+    data: data loading (and skip checks), reload: reloadModel, forward: HMR, smpl: SMPL and projection,
+    loss, backward: backward and optimizer step, output: packing outputs to numpy and 3D errors,
+    loop: bookkeeping of the EFT loop (stopping, test error tracking), export: saving outputs
+
+Time is attributed by laps: lap(name) adds the time since the previous lap to the stage, so every second
+between two samples belongs to exactly one stage. A lap costs one perf_counter call, so it is on by default
+(--eft_noStageTiming to disable).
+On GPU, kernels run asynchronously and their time shows up in the next stage that waits for them (e.g., output).
+--eft_stageTimingSync adds a cuda synchronize to each lap for exact numbers, with some slowdown.
+
+A summary table is printed at the end of eftAllInDB, and a report is saved per process (shard):
+    (outputDir)/reports/stagetiming_(host)_(pid).json
+The reports are in a subfolder, so that tools reading the output folder only see the outputs.
+"""
+
+import os
+import json
+import time
+import socket
+
+import numpy as np
+import torch
+
+STAGES = ['data', 'reload', 'forward', 'smpl', 'loss', 'backward', 'output', 'loop', 'export']
+REPORT_DIR = 'reports'
+
+
+class StageTimer(object):
+
+    def __init__(self, bEnabled=True, bSync=False):
+        self.bEnabled = bEnabled
+        self.bSync = bSync and torch.cuda.is_available()
+        self.current = dict.fromkeys(STAGES, 0.0)
+        self.sampleIndices = []
+        self.rows = []      #Seconds of each stage, per sample
+        self.lastTime = time.perf_counter()
+
+    def mark(self):
+        """Start timing from now, dropping the time since the last lap"""
+        self.lastTime = time.perf_counter()
+
+    def lap(self, name):
+        if self.bEnabled==False:
+            return
+        if self.bSync:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.current[name] += now - self.lastTime
+        self.lastTime = now
+
+    def endSample(self, sampleIdx):
+        if self.bEnabled==False:
+            return
+        self.sampleIndices.append(int(sampleIdx))
+        self.rows.append([self.current[name] for name in STAGES])
+        self.current = dict.fromkeys(STAGES, 0.0)
+
+    def summaryTable(self):
+        if len(self.rows)==0:
+            return "Stage timing: no samples"
+        stageTotal = np.array(self.rows).sum(axis=0)
+        total = stageTotal.sum()
+        lines = ["Stage timing: {} samples, {:.1f} sec".format(len(self.rows), total),
+                 "{:<10s} {:>10s} {:>12s} {:>7s}".format('stage', 'total(s)', 'ms/sample', '%')]
+        for name, seconds in zip(STAGES, stageTotal):
+            lines.append("{:<10s} {:>10.2f} {:>12.2f} {:>7.1f}".format(name, seconds, seconds / len(self.rows) * 1000, seconds / max(total, 1e-9) * 100))
+        return '\n'.join(lines)
+
+    def saveReport(self, outputDir):
+        """output: path of the saved json report, or None if nothing was timed"""
+        if self.bEnabled==False or len(self.rows)==0:
+            return None
+        rows = np.array(self.rows)
+        report = {'host': socket.gethostname(), 'pid': os.getpid(), 'bSync': self.bSync,
+                  'numSamples': len(rows), 'total': float(rows.sum()),
+                  'stages': {name: {'total': float(rows[:,i].sum()), 'mean': float(rows[:,i].mean()),
+                                    'p50': float(np.percentile(rows[:,i], 50)), 'p90': float(np.percentile(rows[:,i], 90))}
+                             for i, name in enumerate(STAGES)},
+                  'perSample': dict({'sampleIdx': self.sampleIndices}, **{name: rows[:,i].tolist() for i, name in enumerate(STAGES)})}
+
+        reportDir = os.path.join(outputDir, REPORT_DIR)
+        os.makedirs(reportDir, exist_ok=True)
+        reportPath = os.path.join(reportDir, 'stagetiming_{}_{}.json'.format(socket.gethostname(), os.getpid()))
+        tempPath = reportPath + '.tmp'
+        with open(tempPath, 'w') as f:
+            json.dump(report, f)
+        os.replace(tempPath, reportPath)
+        return reportPath
@@ -0,0 +1,115 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+"""
+Streaming writer of EFT outputs for Panoptic, instead of accumulating 100 samples in a dict before saving them.
+
+Each output is appended to the current chunk file as soon as it is fitted, so memory does not grow with the data.
+The file is synced every syncEvery records, and a new chunk is started when it is larger than maxChunkBytes.
+    (outputDir)/stream_(writerTag)_(seq).rec
+    record: sampleIdx(q), payloadSize(I), payload (pickled output dict)
+A crash loses at most the records after the last sync. A truncated record at the end of a chunk is ignored by the reader.
+Each writer (e.g., sharded worker) has its own chunk files, so no locking is needed.
+
+StreamReader(outputDir).loadAsDict() gives {sampleIdx: output}, the same as the old Panoptic pkl files.
+"""
+
+import os
+import glob
+import struct
+import pickle
+import socket
+import time
+
+RECORD_HEADER_FORMAT = '<qI'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER_FORMAT)
+STREAM_PREFIX = 'stream_'
+STREAM_EXT = '.rec'
+
+
+class StreamWriter(object):
+    """completionIndex: if given, samples are marked as done after they are synced (see completionIndex.py)"""
+
+    def __init__(self, outputDir, maxChunkBytes=256<<20, syncEvery=10, completionIndex=None):
+        self.outputDir = outputDir
+        self.maxChunkBytes = maxChunkBytes
+        self.syncEvery = syncEvery
+        self.completionIndex = completionIndex
+        os.makedirs(outputDir, exist_ok=True)
+        self.writerTag = '{}_{}_{}'.format(socket.gethostname(), os.getpid(), int(time.time()*1000))
+        self.chunkCnt = 0
+        self.f = None
+        self.unsynced = []      #sampleIdx of the records written after the last sync
+
+    def _openChunk(self):
+        chunkPath = os.path.join(self.outputDir, '{}{}_{:05d}{}'.format(STREAM_PREFIX, self.writerTag, self.chunkCnt, STREAM_EXT))
+        self.chunkCnt +=1
+        self.f = open(chunkPath, 'ab')
+        print("Saving to: {}".format(chunkPath))
+
+    def append(self, sampleIdx, output):
+        if self.f is None:
+            self._openChunk()
+        payload = pickle.dumps(output, protocol=pickle.HIGHEST_PROTOCOL)
+        self.f.write(struct.pack(RECORD_HEADER_FORMAT, sampleIdx, len(payload)))
+        self.f.write(payload)
+        self.unsynced.append(sampleIdx)
+
+        if len(self.unsynced) >= self.syncEvery:
+            self.sync()
+        if self.f.tell() >= self.maxChunkBytes:        #Rollover
+            self.close()
+
+    def sync(self):
+        if self.f is None or len(self.unsynced)==0:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        if self.completionIndex is not None:
+            self.completionIndex.markDone(self.unsynced)
+        self.unsynced = []
+
+    def close(self):
+        if self.f is not None:
+            self.sync()
+            self.f.close()
+            self.f = None
+
+
+def iterStreamRecords(chunkPath, bLoadPayload=True):
+    """Yield (sampleIdx, output) of a chunk file. output is None if not bLoadPayload. Stops at a truncated record"""
+    fileSize = os.path.getsize(chunkPath)
+    with open(chunkPath, 'rb') as f:
+        offset = 0
+        while offset + RECORD_HEADER_SIZE <= fileSize:
+            sampleIdx, payloadSize = struct.unpack(RECORD_HEADER_FORMAT, f.read(RECORD_HEADER_SIZE))
+            offset += RECORD_HEADER_SIZE + payloadSize
+            if offset > fileSize:
+                break
+            if bLoadPayload:
+                yield sampleIdx, pickle.loads(f.read(payloadSize))
+            else:
+                f.seek(payloadSize, os.SEEK_CUR)
+                yield sampleIdx, None
+
+
+def getStreamChunkPaths(outputDir):
+    return sorted(glob.glob(os.path.join(outputDir, STREAM_PREFIX + '*' + STREAM_EXT)))
+
+
+class StreamReader(object):
+
+    def __init__(self, outputDir):
+        self.outputDir = outputDir
+        self.chunkPaths = getStreamChunkPaths(outputDir)
+
+    def sampleIndices(self):
+        """Set of the saved sampleIdx. Only reads the record headers"""
+        return set(sampleIdx for chunkPath in self.chunkPaths for sampleIdx, _ in iterStreamRecords(chunkPath, bLoadPayload=False))
+
+    def __iter__(self):
+        for chunkPath in self.chunkPaths:
+            for sampleIdx, output in iterStreamRecords(chunkPath):
+                yield sampleIdx, output
+
+    def loadAsDict(self):
+        return {sampleIdx: output for sampleIdx, output in self}
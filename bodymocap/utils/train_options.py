@@ -33,6 +33,7 @@ class TrainOptions():
         train = self.parser.add_argument_group('Training Options')
         train.add_argument('--num_epochs', type=int, default=500, help='Total number of training epochs')
         train.add_argument("--lr", type=float, default=5e-5, help="Learning rate")
+        train.add_argument('--backbone', default='resnet50', choices=['resnet50', 'resnet18', 'resnet34', 'mobilenet_v3_large', 'mobilenet_v3_small', 'efficientnet_b0'], help='Backbone of HMR (see BACKBONES in bodymocap/models/hmr.py). Checkpoints should be loaded with the same backbone')
         train.add_argument('--batch_size', type=int, default=256, help='Batch size')
         train.add_argument('--summary_steps', type=int, default=100, help='Summary saving frequency')
         # train.add_argument('--test_steps', type=int, default=1000, help='Testing frequency during training')
@@ -53,6 +54,9 @@ class TrainOptions():
         train.add_argument('--run_smplify', default=False, action='store_true', help='Run SMPLify during training') 
         train.add_argument('--smplify_threshold', type=float, default=100., help='Threshold for ignoring SMPLify fits during training') 
         train.add_argument('--num_smplify_iters', default=100, type=int, help='Number of SMPLify iterations') 
+        train.add_argument('--smplify_batch_size', type=int, default=1, help='If >1, smplifyAllInDB fits this number of samples at once') 
+        train.add_argument('--smplify_numSegments', type=int, default=1, help='Batched SMPLify: split the iterations into this number of segments, and drop converged samples after each segment. The remaining samples are fitted again from the initial estimate, so outputs match the single-sample SMPLify') 
+        train.add_argument('--smplify_minRelImprovement', type=float, default=0.01, help='Batched SMPLify: a sample is converged if the relative reprojection loss improvement of a segment is less than this') 
 
         #My DB
         train.add_argument('--db_set', default='coco', type=str, help='used DB for training') 
@@ -96,6 +100,8 @@ class TrainOptions():
 
         train.add_argument('--bExemplar_analysis_testloss', dest='bExemplar_analysis_testloss', default=False,  action='store_true', help='If True, run test after each exemplar tuning')
         train.add_argument('--bExemplar_badsample_finder', dest='bExemplar_badsample_finder', default=False,  action='store_true', help='If True, run test after each exemplar tuning')
+        train.add_argument('--eft_testLossSubset', type=int, default=-1, help='With bExemplar_analysis_testloss, if >0, evaluate on this number of test samples cached once, instead of the full test DBs') 
+        train.add_argument('--eft_testLossEvery', type=int, default=1, help='With eft_testLossSubset, evaluate every this number of exemplars. Errors are saved in (outputDir)/testloss.npy') 
 
 
         #SMPLX model is used 
@@ -134,9 +140,45 @@ class TrainOptions():
         
         #EFT Option
         train.add_argument('--lr_eft', type=float, default=5e-6, help='Learning rate for EFT') 
+        train.add_argument('--eft_optimizer', default='adam', choices=['adam', 'lbfgs'], help='Optimizer of EFT. lbfgs is for the ablation modes with few trainable parameters (e.g., ablation_layerteset_decOnly)') 
+        train.add_argument('--lr_lbfgs', type=float, default=1.0, help='Learning rate for EFT with eft_optimizer lbfgs (with strong Wolfe line search)') 
+        train.add_argument('--eft_lbfgsHistory', type=int, default=10, help='History size of L-BFGS') 
         train.add_argument('--eft_thresh_keyptErr_2d', type=float, default=1e-4, help='2D keypoint error threshold to stop EFT in DB geneneration') 
+        train.add_argument('--eft_stopPolicy', type=str, default='threshold', help='Comma separated stopping policies of EFT iterations: threshold, plateau, relImprove, timeBudget') 
+        train.add_argument('--eft_plateauWindow', type=int, default=10, help='Number of iterations to check improvement for plateau and relImprove policies') 
+        train.add_argument('--eft_plateauMinDelta', type=float, default=1e-5, help='plateau policy: stop if the best 2D keypoint loss improved less than this within the window') 
+        train.add_argument('--eft_minRelImprovement', type=float, default=0.01, help='relImprove policy: stop if the relative 2D keypoint loss improvement within the window is less than this') 
+        train.add_argument('--eft_timeBudget', type=float, default=-1, help='timeBudget policy: total seconds for all samples of an eftAllInDB call (a chunk in shardRunner)') 
         train.add_argument('--eft_thresh_keyptErr_2d_testtime', type=float, default=2e-4, help='2D keypoint error threshold to stop EFT in testing time') 
         train.add_argument('--eft_withHip2D', default=False, action="store_true", help='If set, use hip 2d keypoint for EFT. Default False') 
+        train.add_argument('--eft_batch_size', type=int, default=1, help='If >1, run EFT for this number of samples at once, each with its own copy of the network weights') 
+        train.add_argument('--eft_noPrefixCache', default=False, action='store_true', help='Run the whole network every EFT iteration, even if the early layers are frozen') 
+        train.add_argument('--eft_outputFormat', default='pkl', choices=['pkl', 'store'], help='pkl: a pkl file per sample. store: chunked columnar store (bodymocap/utils/resultStore.py)') 
+        train.add_argument('--eft_storeChunkSize', type=int, default=50, help='Number of samples per chunk of the result store. Outputs in the buffer are lost if the process crashes') 
+        train.add_argument('--eft_storeFlushSec', type=float, default=60, help='Write a chunk of the result store at least every this many seconds') 
+        train.add_argument('--eft_asyncWriterQueue', type=int, default=0, help='If >0, write pkl files in a background thread with at most this number of pending writes (e.g., 32). 0: write synchronously') 
+        train.add_argument('--eft_sequenceWarmStart', default=False, action='store_true', help='For video DBs (e.g., 3DPW, Panoptic), start EFT of a frame from the fine-tuned weights of the previous frame of the same sequence') 
+        train.add_argument('--eft_warmStartLossRatio', type=float, default=3.0, help='Reset the weights if the initial 2D keypoint loss of a warm-started frame is larger than this times the final loss of the previous frame') 
+        train.add_argument('--eft_completionIndex', default=False, action='store_true', help='Skip existing outputs by an index of saved samples in the output folder (bodymocap/utils/completionIndex.py), instead of checking each file') 
+        train.add_argument('--eft_fitCacheDir', default=None, type=str, help='If set, reuse the EFT fits of previous runs with the same input, checkpoint and EFT options (bodymocap/utils/fitCache.py)') 
+        train.add_argument('--eft_fitCacheKey', default='image', choices=['image', 'imageName'], help='image: key the fit cache by the input crop. imageName: by the image file name (faster, but assumes the same name means the same image)') 
+        train.add_argument('--eft_noStageTiming', default=False, action='store_true', help='Disable the per-stage timing of eftAllInDB (bodymocap/utils/stageTimer.py)') 
+        train.add_argument('--eft_stageTimingSync', default=False, action='store_true', help='Synchronize CUDA at each stage boundary for exact per-stage GPU times (slower)') 
+        train.add_argument('--eft_panopticPklDict', default=False, action='store_true', help='For Panoptic, save a pkl file with a dict of outputs per 100 samples (old format), instead of the stream writer (bodymocap/utils/streamWriter.py)') 
+        train.add_argument('--eft_streamChunkMB', type=int, default=256, help='Start a new stream file when the current one is larger than this (MB)') 
+        train.add_argument('--eft_streamSyncEvery', type=int, default=10, help='Sync the stream file to disk every this number of outputs') 
+        train.add_argument('--eft_outputDir', default=None, type=str, help='Output folder of EFT. If None, a new folder is created in config.EXEMPLAR_OUTPUT_ROOT') 
+
+        #CPU execution (bodymocap/utils/cpuProfile.py)
+        train.add_argument('--eft_cpuProfile', default=False, action='store_true', help='On CPU, run the network with bf16 autocast (fp32 weights) and channels_last tensors') 
+        train.add_argument('--eft_cpuThreads', type=int, default=-1, help='Number of intra-op threads per process. 0: all available cores (split among the workers of shardRunner). -1: PyTorch default') 
+        train.add_argument('--eft_cpuInteropThreads', type=int, default=1, help='Number of inter-op threads per process, if eft_cpuThreads>=0') 
+
+        #Sharded EFT runner (bodymocap.train.shardRunner)
+        train.add_argument('--eft_numWorkers', type=int, default=4, help='Number of EFT worker processes') 
+        train.add_argument('--eft_chunkSize', type=int, default=100, help='Number of samples claimed by a worker at once') 
+        train.add_argument('--eft_manifest', default=None, type=str, help='Path of the shared work manifest. If None, (eft_outputDir)/manifest.bin') 
+        train.add_argument('--eft_leaseTime', type=float, default=3600, help='Seconds until a claimed chunk can be taken by another worker') 
 
         #EFT Debug options
         train.add_argument('--bDebug_visEFT', default=False, action='store_true', help='If true, show EFT process visualization') 
@@ -28,7 +28,7 @@ from datetime import datetime
 g_timer = Timer()
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--checkpoint', required=False, default=default_checkpoint, help='Path to pretrained checkpoint')
+parser.add_argument('--checkpoint', required=False, default=default_checkpoint, help='Path to pretrained checkpoint, or an int8 checkpoint made by bodymocap/apps/quantizeHMR.py (CPU)')
 parser.add_argument('--vPath', type=str, default=None, help="""Path of video or first image in a folder
                     (example: (path)/out%%1d.jpg - %%1d will be automatically replaced by the number of the image)
                     . Can also be used to load a single image (example: (path)/out1.jpg).""")
@@ -47,6 +47,11 @@ parser.add_argument('--endFrame', type=int, default=-1, help='given a sequence o
 parser.add_argument('--noVideoOut', action='store_true', help='Do not generate output video (ffmpeg)')
 parser.add_argument('--single', action='store_true', help='Reconstruct only one person in the scene with the biggest bbox')
 parser.add_argument('--skip', action='store_true', help='Skip there exist already processed outputs')
+parser.add_argument('--compileMode', type=str, default=None, choices=['trace', 'compile'], help='Run HMR and SMPL as one compiled graph (faster on CPU)')
+parser.add_argument('--compileCacheDir', type=str, default=None, help='Folder to keep the compiled graph for the next runs')
+parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'], help='onnx: run the regressor by onnxruntime on CPU. --checkpoint should be an onnx file (bodymocap/apps/exportONNX.py)')
+parser.add_argument('--backbone', type=str, default='resnet50', choices=['resnet50', 'resnet18', 'resnet34', 'mobilenet_v3_large', 'mobilenet_v3_small', 'efficientnet_b0'], help='Backbone of HMR the checkpoint was trained with (--backbone of TrainOptions)')
+parser.add_argument('--ortThreads', type=int, default=0, help='Number of onnxruntime threads. 0: onnxruntime default')
 
 def get_video_path(args):
     if args.webcam:
@@ -425,6 +430,6 @@ if __name__ == '__main__':
     else:
         visualizer = Visualizer('gui')
     bboxdetector =  BodyBboxDetector('2dpose', device = device)      #"yolo" or "2dpose"
-    bodymocap = BodyMocap(args.checkpoint, config.SMPL_MODEL_DIR, device = device)
+    bodymocap = BodyMocap(args.checkpoint, config.SMPL_MODEL_DIR, device = device, compileMode=args.compileMode, compileCacheDir=args.compileCacheDir, backend=args.backend, ortThreads=args.ortThreads, backbone=args.backbone)
 
     RunMonomocap(args, video_path, visualizer, bboxdetector, bodymocap, device, renderOutRoot)
@@ -59,7 +59,7 @@ if __name__ == '__main__':
     # imgDir = '/private/home/hjoo/data/coco/train2014'
 
     smpl = SMPL(smplModelDir, batch_size=1, create_transl=False)
-    fileList  = listdir(inputDir)       #Check all fitting files
+    fileList  = [f for f in listdir(inputDir) if f.endswith('.pkl')]       #Check all fitting files. Other files (e.g., reports, indices) are ignored
 
     render = denseposeRenderer.denseposeRenderer()
     render.offscreenMode(True)
@@ -11,6 +11,7 @@ import pickle
 
 from eft.utils.imutils import crop, crop_bboxInfo
 from eft.models import SMPL
+from bodymocap.utils.streamWriter import getStreamChunkPaths, iterStreamRecords, STREAM_EXT
 # from eft.models import SMPLX
 # from smplx import SMPL
 
@@ -52,7 +53,8 @@ def visEFT_singleSubject(inputDir, imDir, smplModelDir, bUseSMPLX):
         smpl = SMPLX(smplModelDir, batch_size=1, create_transl=False)
     else:
         smpl = SMPL(smplModelDir, batch_size=1, create_transl=False)
-    fileList  = listdir(inputDir)       #Check all fitting files
+    fileList  = [f for f in listdir(inputDir) if f.endswith('.pkl')]       #Check all fitting files. Other files (e.g., reports, indices) are ignored
+    fileList += [os.path.basename(p) for p in getStreamChunkPaths(inputDir)]       #Panoptic outputs saved as stream files (bodymocap/utils/streamWriter.py)
 
     print(">> Found {} files in the fitting folder {}".format(len(fileList), inputDir))
     totalCnt =0
@@ -62,8 +64,11 @@ def visEFT_singleSubject(inputDir, imDir, smplModelDir, bUseSMPLX):
         
         #Load
         fileFullPath = join(inputDir, f)
-        with open(fileFullPath,'rb') as f:
-            dataDict = pickle.load(f)
+        if f.endswith(STREAM_EXT):      #{sampleIdx: output}, the same as a panoptic pkl file
+            dataDict = dict(iterStreamRecords(fileFullPath))
+        else:
+            with open(fileFullPath,'rb') as f:
+                dataDict = pickle.load(f)
         print(f"Loaded :{fileFullPath}")
         if 'imageName' in dataDict.keys():  #If this pkl has only one instance. Made this to hand panoptic output where pkl has multi instances
             dataDict = {0:dataDict}
@@ -218,7 +223,7 @@ def visEFT_multiSubjects(inputDir, imDir, smplModelDir, bUseSMPLX = False):
     else:
         smpl = SMPL(smplModelDir, batch_size=1, create_transl=False)
 
-    fileList  = listdir(inputDir)       #Check all fitting files
+    fileList  = [f for f in listdir(inputDir) if f.endswith('.pkl')]       #Check all fitting files. Other files (e.g., reports, indices) are ignored
 
     print(">> Found {} files in the fitting folder {}".format(len(fileList), inputDir))
     totalCnt =0
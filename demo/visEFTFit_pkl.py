@@ -81,7 +81,7 @@ def visEFT_singleSubject(renderer):
     # outputFolder = os.path.basename(inputDir) + '_dpOut'
     # outputFolder =os.path.join('/run/media/hjoo/disk/data/eftout/',outputFolder)
     
-    eft_fileList  = listdir(inputDir)       #Check all fitting files
+    eft_fileList  = [f for f in listdir(inputDir) if f.endswith('.pkl')]       #Check all fitting files. Other files (e.g., reports, indices) are ignored
     print(">> Found {} files in the fitting folder {}".format(len(eft_fileList), inputDir))
     totalCnt =0
     erroneousCnt =0
@@ -211,7 +211,7 @@ def visEFT_multiSubjects(renderer):
     smplModelDir = args.smpl_dir
     smpl = SMPL(smplModelDir, batch_size=1, create_transl=False)
     
-    eft_fileList  = listdir(inputDir)       #Check all fitting files
+    eft_fileList  = [f for f in listdir(inputDir) if f.endswith('.pkl')]       #Check all fitting files. Other files (e.g., reports, indices) are ignored
     print(">> Found {} files in the fitting folder {}".format(len(eft_fileList), inputDir))
 
     #Aggregate all efl per image
@@ -11,20 +11,41 @@ from tqdm import tqdm
 
 import eft.cores.jointorders as jointorders
 
+#Load EFT outputs from a folder of pkl files, a result store (bodymocap/utils/resultStore.py),
+#or stream files of Panoptic outputs (bodymocap/utils/streamWriter.py)
+def loadEFTOutputs(pklDir):
+    from bodymocap.utils.resultStore import ResultStoreReader, isResultStore
+    from bodymocap.utils.streamWriter import StreamReader, getStreamChunkPaths
+    if isResultStore(pklDir):
+        store = ResultStoreReader(pklDir)
+        print(">> Found {} samples in the result store {}".format(len(store), pklDir))
+        return len(store), iter(store)
+
+    if len(getStreamChunkPaths(pklDir))>0:
+        stream = StreamReader(pklDir)
+        numSamples = len(stream.sampleIndices())
+        print(">> Found {} samples in the stream files of {}".format(numSamples, pklDir))
+        return numSamples, (output for _, output in stream)
+
+    eft_fileList  = [f for f in os.listdir(pklDir) if f.endswith('.pkl')]       #Check all fitting files
+    print(">> Found {} files in the fitting folder {}".format(len(eft_fileList), pklDir))
+
+    def pklIterator():
+        for f in sorted(eft_fileList):
+            fileFullPath = os.path.join(pklDir, f)
+            with open(fileFullPath,'rb') as f:
+                yield pickle.load(f)
+    return len(eft_fileList), pklIterator()
+
+
 def pklToJson(pklDir, outputPath, metainfo):
 
-    eft_fileList  = os.listdir(pklDir)       #Check all fitting files
-    print(">> Found {} files in the fitting folder {}".format(len(eft_fileList), pklDir))
+    numSamples, eftOutputs = loadEFTOutputs(pklDir)
     totalCnt =0
     erroneousCnt =0
 
     essentialdata  = []
-    for f in tqdm(sorted(eft_fileList)):
-        
-        #Load EFT data
-        fileFullPath = os.path.join(pklDir, f)
-        with open(fileFullPath,'rb') as f:
-            eft_data = pickle.load(f)
+    for eft_data in tqdm(eftOutputs, total=numSamples):
 
         ########################
         if True:
@@ -84,7 +105,7 @@ def pklToJson(pklDir, outputPath, metainfo):
         # if len(essentialdata)==50:
         #     break
 
-    print(">>> Rejection Summary: {}/{}. Valid:{}".format( erroneousCnt, len(eft_fileList)  ,  len(essentialdata)) )
+    print(">>> Rejection Summary: {}/{}. Valid:{}".format( erroneousCnt, numSamples  ,  len(essentialdata)) )
 
 
     with open(outputPath,'w') as f:
@@ -0,0 +1,55 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+import os
+import pickle
+
+import pytest
+
+from bodymocap.utils.asyncWriter import AsyncWriter, writePickle
+from bodymocap.utils.completionIndex import CompletionIndex, getConfigKey, writePickleAndMark
+from bodymocap.utils import TrainOptions
+
+
+class Unpicklable(object):
+    def __reduce__(self):
+        raise RuntimeError("Failed in the middle of the write")
+
+
+def test_writePickle_never_leaves_partial_file(tmp_path):
+    outputPath = str(tmp_path / 'img_00000001.pkl')
+    writePickle(outputPath, {'pred_shape': [1, 2, 3]})
+
+    with pytest.raises(RuntimeError):
+        writePickle(outputPath, {'pred_shape': [4, 5, 6], 'bad': Unpicklable()})
+    with open(outputPath, 'rb') as f:       #The previous file is untouched
+        assert pickle.load(f) == {'pred_shape': [1, 2, 3]}
+
+    with pytest.raises(RuntimeError):
+        writePickle(str(tmp_path / 'img_00000002.pkl'), {'bad': Unpicklable()})
+    assert os.path.exists(str(tmp_path / 'img_00000002.pkl'))==False
+
+
+def test_sample_is_marked_after_its_file_is_written(tmp_path):
+    configKey = getConfigKey(TrainOptions().parser.parse_args(['--name', 'test']))
+    index = CompletionIndex(str(tmp_path), configKey)
+
+    writePickleAndMark(str(tmp_path / 'img_00000003.pkl'), {'sampleIdx': 3}, index, [3])
+    with pytest.raises(RuntimeError):
+        writePickleAndMark(str(tmp_path / 'img_00000004.pkl'), {'bad': Unpicklable()}, index, [4])
+    assert index.isDone(3) and index.isDone(4)==False
+
+    #Same through the background writer. The error is raised at flush
+    writer = AsyncWriter(4)
+    writer.submit(writePickleAndMark, str(tmp_path / 'img_00000005.pkl'), {'bad': Unpicklable()}, index, [5])
+    writer.submit(writePickleAndMark, str(tmp_path / 'img_00000012.pkl'), {'sampleIdx': 12}, index, [12])
+    with pytest.raises(RuntimeError):
+        writer.flush()
+    writer.close()
+    assert index.isDone(5)==False and index.isDone(12)
+    index.close()
+
+    #Loaded again from the file
+    index = CompletionIndex(str(tmp_path), configKey)
+    assert len(index) == 2 and index.isDone(3) and index.isDone(12)
+    index.close()
+    assert [f for f in sorted(os.listdir(str(tmp_path))) if f.startswith('img_')] == ['img_00000003.pkl', 'img_00000012.pkl']
@@ -0,0 +1,98 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn as nn
+
+EFTFitter = pytest.importorskip('bodymocap.train.eftFitter').EFTFitter
+
+
+class TinyRegressor(nn.Module):
+    """Stand-in for hmr: image -> (rotmat, betas, camera)"""
+    def __init__(self):
+        super(TinyRegressor, self).__init__()
+        self.fc = nn.Linear(8, 24*9 + 10 + 3)
+
+    def forward(self, x):
+        out = self.fc(x)
+        rotmat = torch.eye(3).expand(x.shape[0], 24, 3, 3) + 0.1*out[:, :24*9].view(-1, 24, 3, 3)
+        camera = torch.cat([0.9 + 0.1*torch.tanh(out[:, -3:-2]), out[:, -2:]], dim=1)
+        return rotmat, out[:, 24*9:-3], camera
+
+
+class TinyBody(nn.Module):
+    """Stand-in for SMPL: 49 joints, linear in pose and shape"""
+    def __init__(self):
+        super(TinyBody, self).__init__()
+        self.joints = nn.Linear(24*9 + 10, 49*3)
+
+    def forward(self, betas, body_pose, global_orient, pose2rot=False):
+        pose = torch.cat([global_orient, body_pose], dim=1).view(betas.shape[0], -1)
+        return SimpleNamespace(joints=self.joints(torch.cat([pose, betas], dim=1)).view(-1, 49, 3))
+
+
+def makeFitter():
+    fitter = EFTFitter.__new__(EFTFitter)      #Only the attributes used by runModel, computeEFTLoss and eftClosure
+    fitter.options = SimpleNamespace(eft_withHip2D=False, openpose_train_weight=0., gt_train_weight=1., bExemplarWith3DSkel=False,
+                                    keypoint_loss_weight=5., beta_loss_weight=0.001)
+    fitter.device = torch.device('cpu')
+    fitter.criterion_keypoints = nn.MSELoss(reduction='none')
+    fitter.bCPUProfile = False
+    fitter.prefixStage = None
+    fitter.model = TinyRegressor()
+    fitter.smpl = TinyBody().requires_grad_(False)
+    return fitter
+
+
+def makeInputs():
+    images = torch.randn(2, 8)
+    gt_keypoints_2d = torch.rand(2, 49, 3)*2 - 1
+    gt_keypoints_2d[:, :, 2] = 1     #Includes the feet, so legOrientation_loss sees confidences which are disabled afterwards
+    gt_joints = torch.zeros(2, 24, 4)
+    has_pose_3d = torch.zeros(2, dtype=torch.bool)
+    return images, gt_keypoints_2d, gt_joints, has_pose_3d
+
+
+def eftLoss(fitter, images, gt_keypoints_2d, gt_joints, has_pose_3d):
+    """Objective of run_eft_step, which Adam minimizes"""
+    pred_rotmat, pred_betas, pred_camera = fitter.runModel(images)
+    pred_joints_3d = fitter.smpl(betas=pred_betas, body_pose=pred_rotmat[:,1:], global_orient=pred_rotmat[:,0].unsqueeze(1), pose2rot=False).joints
+    pred_keypoints_2d = pred_camera[:,0].view(-1,1,1) * pred_joints_3d[:,:,:2] + pred_camera[:,1:].view(-1,1,2)
+    return fitter.computeEFTLoss(pred_keypoints_2d, gt_keypoints_2d, pred_joints_3d, gt_joints, has_pose_3d, pred_betas, pred_camera)[0].sum()
+
+
+def test_computeEFTLoss_keeps_gt_keypoints():
+    torch.manual_seed(0)
+    fitter = makeFitter()
+    images, gt_keypoints_2d, gt_joints, has_pose_3d = makeInputs()
+    gt_original = gt_keypoints_2d.clone()
+
+    loss_0 = eftLoss(fitter, images, gt_keypoints_2d, gt_joints, has_pose_3d)
+    loss_1 = eftLoss(fitter, images, gt_keypoints_2d, gt_joints, has_pose_3d)
+    assert torch.equal(gt_keypoints_2d, gt_original)
+    assert torch.equal(loss_0, loss_1)
+
+
+def test_lbfgs_minimizes_the_adam_objective():
+    torch.manual_seed(0)
+    fitter = makeFitter()
+    images, gt_keypoints_2d, gt_joints, has_pose_3d = makeInputs()
+    gt_original = gt_keypoints_2d.clone()
+    fitter.optimizer = torch.optim.LBFGS(fitter.model.parameters(), lr=1, max_iter=1, history_size=10, line_search_fn='strong_wolfe')
+
+    #The closure evaluated from scratch gives the loss run_eft_step passes as lossAtStart
+    lossAtStart = eftLoss(fitter, images, gt_keypoints_2d, gt_joints, has_pose_3d)
+    assert torch.allclose(fitter.eftClosure(images, gt_keypoints_2d, gt_joints, has_pose_3d, []), lossAtStart)
+
+    #Same as run_eft_step with eft_optimizer=='lbfgs'
+    losses = [lossAtStart.item()]
+    for _ in range(5):
+        lossAtStart = [eftLoss(fitter, images, gt_keypoints_2d, gt_joints, has_pose_3d)]
+        fitter.optimizer.step(lambda: fitter.eftClosure(images, gt_keypoints_2d, gt_joints, has_pose_3d, lossAtStart))
+        losses.append(eftLoss(fitter, images, gt_original, gt_joints, has_pose_3d).item())
+
+    assert torch.equal(gt_keypoints_2d, gt_original)
+    assert all(b <= a for a, b in zip(losses[:-1], losses[1:]))
+    assert losses[-1] < losses[0]
@@ -0,0 +1,60 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+from types import SimpleNamespace
+
+import pytest
+
+from bodymocap.utils import TrainOptions
+
+eftStopping = pytest.importorskip('bodymocap.train.eftStopping')
+
+
+def parseOptions(params=[]):
+    return TrainOptions().parser.parse_args(['--name', 'test'] + params)
+
+
+def test_threshold_plateau_relImprove():
+    assert eftStopping.ThresholdStop(1e-4).check([1e-3, 5e-5])
+    assert eftStopping.ThresholdStop(1e-4).check([1e-3, 5e-4])==False
+
+    plateau = eftStopping.PlateauStop(window=3, minDelta=1e-3)
+    assert plateau.check([1.0, 0.5, 0.5])==False        #Not enough iterations yet
+    assert plateau.check([1.0, 0.5, 0.3, 0.2])==False
+    assert plateau.check([1.0, 0.5, 0.5, 0.6, 0.5])        #No better than the best before the window
+
+    relImprove = eftStopping.RelImprovementStop(window=2, minRelImprovement=0.1)
+    assert relImprove.check([1.0, 0.95])==False
+    assert relImprove.check([1.0, 0.95, 0.8])==False
+    assert relImprove.check([1.0, 0.95, 0.95])
+    assert relImprove.check([0.0, 0.0, 0.0])
+
+
+def test_time_budget(monkeypatch):
+    clock = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(eftStopping, 'time', SimpleNamespace(time=lambda: clock.now))
+
+    stop = eftStopping.TimeBudgetStop(10.0)
+    stop.startSample(numRemaining=5)        #2 seconds per sample
+    clock.now += 1.5
+    assert stop.check([1.0])==False
+    clock.now += 1.0
+    assert stop.check([1.0])
+
+    stop.startSample(numRemaining=1)        #The last sample gets the rest of the budget
+    clock.now += 7.0
+    assert stop.check([1.0])==False
+
+
+def test_buildStopper():
+    stopper = eftStopping.buildStopper(parseOptions())
+    assert stopper.description == 'threshold'
+    assert stopper.check([1e-3]) is None and stopper.check([1e-5]) == 'threshold'
+
+    stopper = eftStopping.buildStopper(parseOptions(['--eft_stopPolicy', 'threshold, relImprove', '--eft_plateauWindow', '1']))
+    assert stopper.description == 'threshold,relImprove'
+    assert stopper.check([1.0, 0.999]) == 'relImprove'
+
+    with pytest.raises(ValueError):
+        eftStopping.buildStopper(parseOptions(['--eft_stopPolicy', 'unknown']))
+    with pytest.raises(AssertionError):
+        eftStopping.buildStopper(parseOptions(['--eft_stopPolicy', 'timeBudget']))
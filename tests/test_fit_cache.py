@@ -0,0 +1,54 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+import numpy as np
+import torch
+
+from bodymocap.utils import TrainOptions
+from bodymocap.utils.fitCache import FitCache, getFitOptionKeys
+
+
+def parseOptions(params=[]):
+    return TrainOptions().parser.parse_args(['--name', 'test'] + params)
+
+
+def makeBatch(sampleIdx, imgname='coco/000001.jpg'):
+    torch.manual_seed(0)
+    return {'img': torch.randn(1, 3, 8, 8), 'imgname': [imgname], 'center': torch.tensor([[100., 120.]]), 'scale': torch.tensor([1.2]),
+            'keypoints': torch.rand(1, 49, 3), 'sample_index': torch.tensor([sampleIdx])}
+
+
+def test_key_depends_only_on_fit_options(tmp_path):
+    options = parseOptions()
+    assert 'lr_eft' in getFitOptionKeys(options) and 'eft_thresh_keyptErr_2d' in getFitOptionKeys(options)
+    assert 'eft_outputDir' not in getFitOptionKeys(options) and 'name' not in getFitOptionKeys(options)
+
+    key = FitCache(str(tmp_path), options).getKey(makeBatch(0))
+    assert FitCache(str(tmp_path), parseOptions(['--eft_outputDir', 'other'])).getKey(makeBatch(0)) == key
+    assert FitCache(str(tmp_path), parseOptions(['--lr_eft', '1e-3'])).getKey(makeBatch(0)) != key
+    assert FitCache(str(tmp_path), options).getKey(makeBatch(7, 'coco-all/000001.jpg')) == key     #The same crop in another DB
+    otherCrop = makeBatch(0)
+    otherCrop['img'][0, 0, 0, 0] += 1
+    assert FitCache(str(tmp_path), options).getKey(otherCrop) != key
+
+    options = parseOptions(['--eft_fitCacheKey', 'imageName'])
+    key = FitCache(str(tmp_path), options).getKey(makeBatch(0))
+    assert FitCache(str(tmp_path), options).getKey(otherCrop) == key
+    assert FitCache(str(tmp_path), options).getKey(makeBatch(0, 'coco/000002.jpg')) != key
+
+
+def test_hit_takes_sample_fields_from_current_db(tmp_path):
+    fitCache = FitCache(str(tmp_path), parseOptions())
+    batch = makeBatch(3)
+    key = fitCache.getKey(batch)
+    assert fitCache.get(key, batch, (np.zeros((1, 72)), np.zeros((1, 10)))) is None
+
+    fitCache.put(key, {'pred_shape': np.ones((1, 10)), 'sampleIdx': np.array([3]), 'imageName': batch['imgname'],
+                       'opt_pose': np.zeros((1, 72)), 'opt_beta': np.zeros((1, 10)), 'subjectId': 5})
+
+    otherBatch = makeBatch(7)      #Same sample in another DB, with other SPIN fits
+    otherBatch['annotId'] = torch.tensor([11])
+    output = fitCache.get(key, otherBatch, (np.full((1, 72), 2.0), np.full((1, 10), 3.0)))
+    assert np.array_equal(output['pred_shape'], np.ones((1, 10)))
+    assert output['sampleIdx'][0] == 7 and output['annotId'][0] == 11 and 'subjectId' not in output
+    assert np.all(output['opt_pose'] == 2.0) and np.all(output['opt_beta'] == 3.0)
+    assert output['fitCacheHit'] and (fitCache.numHits, fitCache.numMisses) == (1, 1)
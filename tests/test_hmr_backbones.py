@@ -0,0 +1,39 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from bodymocap.models import hmr, eval_mode_modules
+
+
+def makeMeanParams(tmp_path):
+    path = str(tmp_path / 'smpl_mean_params.npz')
+    np.savez(path, pose=np.zeros(24*6, dtype=np.float32), shape=np.zeros(10, dtype=np.float32), cam=np.array([0.9, 0, 0], dtype=np.float32))
+    return path
+
+
+def test_efficientnet_eft_mode_is_deterministic(tmp_path):
+    #EFT runs the model in train mode, with eval_mode_modules in eval mode (see EFTFitter.exemplerTrainingMode)
+    torch.manual_seed(0)
+    model = hmr(makeMeanParams(tmp_path), pretrained=False, backbone='efficientnet_b0')
+    model.train()
+
+    #Calibrate BN running stats so the residual branches are not negligible (otherwise a random drop barely changes the output)
+    for module in model.modules():
+        if isinstance(module, nn.modules.batchnorm._BatchNorm):
+            module.momentum = None
+    with torch.no_grad():
+        for _ in range(3):
+            model.features(torch.randn(4, 3, 224, 224))
+
+    for module in eval_mode_modules(model):
+        module.eval()
+
+    x = torch.randn(8, 3, 224, 224)
+    with torch.no_grad():
+        torch.manual_seed(0)
+        features_0 = model.features(x)
+        torch.manual_seed(1)
+        features_1 = model.features(x)
+    assert torch.equal(features_0, features_1)
@@ -0,0 +1,80 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+import copy
+
+import numpy as np
+import pytest
+import torch
+
+from bodymocap.models import hmr, eval_mode_modules
+
+MultiExemplarModel = pytest.importorskip('bodymocap.train.multiExemplar').MultiExemplarModel
+
+
+def makeModel(tmp_path):
+    path = str(tmp_path / 'smpl_mean_params.npz')
+    np.savez(path, pose=np.zeros(24*6, dtype=np.float32), shape=np.zeros(10, dtype=np.float32), cam=np.array([0.9, 0, 0], dtype=np.float32))
+    model = hmr(path, pretrained=False, backbone='resnet18')
+
+    #EFT mode (see EFTFitter.init_fn and exemplerTrainingMode). Only the regressor is trained, to keep the test fast
+    model.train()
+    for module in eval_mode_modules(model):
+        module.eval()
+    for name, par in model.named_parameters():
+        par.requires_grad = name.split('.')[0] in ['fc1', 'fc2', 'decpose', 'decshape', 'deccam']
+    return model
+
+
+def exemplarLoss(pred_rotmat, pred_betas, pred_camera, target):
+    """Per-sample loss (N,)"""
+    return ((pred_betas - target[:, :10])**2).sum(dim=1) + ((pred_camera - target[:, 10:13])**2).sum(dim=1) + \
+            ((pred_rotmat - torch.eye(3))**2).sum(dim=(1,2,3))
+
+
+def test_batched_eft_matches_per_sample_adam(tmp_path):
+    torch.manual_seed(0)
+    model = makeModel(tmp_path)
+    batch_size, lr = 3, 1e-3
+    with torch.no_grad():
+        features = model.forward_prefix(torch.randn(batch_size, 3, 224, 224), 'xf')
+    target = torch.randn(batch_size, 13)
+    weightsBefore = {name: par.detach().clone() for name, par in model.named_parameters()}
+
+    #Reference: each sample fine-tunes its own copy of the model, as eftAllInDB does with a single sample
+    singleModels = [copy.deepcopy(model) for _ in range(batch_size)]
+    singleOptimizers = [torch.optim.Adam([par for par in m.parameters() if par.requires_grad], lr=lr) for m in singleModels]
+    def stepSingle(b):
+        singleOptimizers[b].zero_grad()
+        exemplarLoss(*singleModels[b](features[b:b+1], stage='xf'), target[b:b+1]).sum().backward()
+        singleOptimizers[b].step()
+
+    multiModel = MultiExemplarModel(model, batch_size, lr)
+    rows = list(range(batch_size))
+    def stepBatch():
+        multiModel.optimizer.zero_grad()
+        exemplarLoss(*multiModel(features[rows], stage='xf'), target[rows]).sum().backward()
+        multiModel.optimizer.step()
+
+    for _ in range(3):
+        stepBatch()
+        for b in rows:
+            stepSingle(b)
+
+    #Drop a converged exemplar. The others keep their weights and Adam states
+    multiModel.selectExemplars([0, 2])
+    rows = [0, 2]
+    for _ in range(3):
+        stepBatch()
+        for b in rows:
+            stepSingle(b)
+
+    with torch.no_grad():
+        batchOutputs = multiModel(features[rows], stage='xf')
+        for i, b in enumerate(rows):
+            for batchOut, singleOut in zip(batchOutputs, singleModels[b](features[b:b+1], stage='xf')):
+                assert torch.allclose(batchOut[i:i+1], singleOut, atol=1e-5)
+
+    #The weights of the original model are not changed
+    for name, par in model.named_parameters():
+        assert torch.equal(par, weightsBefore[name])
+    assert torch.equal(model.decshape.weight, singleModels[0].decshape.weight)==False
@@ -0,0 +1,92 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+import os
+
+import numpy as np
+
+from bodymocap.utils.resultStore import ResultStoreWriter, ResultStoreReader, isResultStore, TEMP_PREFIX
+from bodymocap.utils.streamWriter import StreamWriter, StreamReader, getStreamChunkPaths
+from bodymocap.utils.completionIndex import CompletionIndex
+
+
+def makeOutput(sampleIdx):
+    """Output dict of a sample, in the format of the pkl files of eftAllInDB"""
+    rng = np.random.RandomState(sampleIdx)
+    return {'pred_pose_rotmat': rng.rand(1, 24, 3, 3).astype(np.float32), 'pred_shape': rng.rand(1, 10).astype(np.float32),
+            'pred_camera': rng.rand(1, 3).astype(np.float32), 'scale': np.array([1.5], dtype=np.float32),
+            'center': np.array([[100., 50.]], dtype=np.float32), 'loss_keypoints_2d': 1e-4*sampleIdx, 'numOfIteration': sampleIdx % 7,
+            'sampleIdx': np.array([sampleIdx]), 'imageName': ['images/{:06d}.jpg'.format(sampleIdx)], 'smpltype': 'smpl'}
+
+
+def test_result_store_round_trip(tmp_path):
+    storeDir = str(tmp_path / 'store')
+    writer = ResultStoreWriter(storeDir, chunkSize=3)
+    outputs = [makeOutput(sampleIdx) for sampleIdx in range(7)]
+    outputs[1]['annotId'] = np.array([42])
+    outputs[2]['test_error_3dpw'] = 55.5          #Not in the schema
+    outputs[4]['pred_shape_warmStart'] = np.ones((1, 10))
+    del outputs[5]['pred_camera']       #Not in all samples of the chunk
+    for output in outputs:
+        writer.append(output)
+    assert len(os.listdir(storeDir)) == 2       #Every chunkSize samples
+    writer.flush()
+    assert isResultStore(storeDir)
+
+    reader = ResultStoreReader(storeDir)
+    assert len(reader) == 7 and reader.sampleIndices() == list(range(7)) and 3 in reader
+    for output in outputs:
+        loaded = reader.getBySampleIdx(output['sampleIdx'][0])
+        assert sorted(loaded.keys()) == sorted(output.keys())
+        for key, value in output.items():
+            if isinstance(value, np.ndarray):
+                assert np.allclose(loaded[key], value) and np.shape(loaded[key]) == np.shape(value)
+            else:
+                assert loaded[key] == value if not isinstance(value, float) else np.isclose(loaded[key], value)
+
+    assert reader.getByAnnotId(42)[0]['sampleIdx'][0] == 1
+    assert reader.getByImageName('images/000006.jpg')[0]['sampleIdx'][0] == 6
+    assert [o['sampleIdx'][0] for o in reader] == list(range(7))
+
+
+def test_result_store_flush_interval_and_reload(tmp_path):
+    storeDir = str(tmp_path / 'store')
+    writer = ResultStoreWriter(storeDir, chunkSize=100, flushInterval=0)      #A chunk per sample
+    writer.append(makeOutput(0))
+    reader = ResultStoreReader(storeDir)
+    assert len(reader) == 1
+
+    os.makedirs(os.path.join(storeDir, TEMP_PREFIX + 'chunk_partial'))     #A chunk being written by another writer
+    writer.append(makeOutput(1))
+    reader.reload()
+    assert reader.sampleIndices() == [0, 1]
+
+
+def test_stream_round_trip(tmp_path):
+    outputDir = str(tmp_path)
+    index = CompletionIndex(outputDir, 'test')
+    writer = StreamWriter(outputDir, maxChunkBytes=4000, syncEvery=2, completionIndex=index)
+    outputs = {sampleIdx: makeOutput(sampleIdx) for sampleIdx in range(10)}
+    for sampleIdx, output in outputs.items():
+        writer.append(sampleIdx, output)
+        if sampleIdx == 0:      #Marked done only after the records are synced
+            assert index.isDone(0)==False
+        elif sampleIdx == 1:
+            assert index.isDone(0) and index.isDone(1)
+    writer.close()
+    assert len(index) == 10
+    assert len(getStreamChunkPaths(outputDir)) > 1      #Rollover by maxChunkBytes
+
+    loaded = StreamReader(outputDir).loadAsDict()
+    assert sorted(loaded.keys()) == list(range(10))
+    for sampleIdx, output in outputs.items():
+        assert np.array_equal(loaded[sampleIdx]['pred_pose_rotmat'], output['pred_pose_rotmat'])
+        assert loaded[sampleIdx]['imageName'] == output['imageName']
+
+    #A truncated record at the end (e.g., crash while writing) is ignored
+    lastChunk = getStreamChunkPaths(outputDir)[-1]
+    reader = StreamReader(outputDir)
+    numRecords = len(reader.sampleIndices())
+    with open(lastChunk, 'r+b') as f:
+        f.truncate(os.path.getsize(lastChunk) - 10)
+    assert len(StreamReader(outputDir).sampleIndices()) == numRecords - 1
+    index.close()
@@ -0,0 +1,72 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+import time
+
+import pytest
+
+shardRunner = pytest.importorskip('bodymocap.train.shardRunner')
+WorkManifest, LeaseHeartbeat = shardRunner.WorkManifest, shardRunner.LeaseHeartbeat
+
+
+def test_manifest_claims_each_chunk_once(tmp_path):
+    manifest = WorkManifest(str(tmp_path / 'manifest.bin'), numSamples=250, chunkSize=100)
+    assert manifest.numChunks == 3
+    assert manifest.chunkRange(2) == (200, 250)
+
+    assert [manifest.claim(0, 60), manifest.claim(1, 60), manifest.claim(0, 60), manifest.claim(1, 60)] == [0, 1, 2, None]
+    assert manifest.summary() == (0, 3, 0)
+
+    assert manifest.complete(1, 1)
+    assert manifest.complete(0, 1)==False      #Leased by worker 0
+    assert manifest.summary() == (0, 2, 1)
+    manifest.close()
+
+
+def test_manifest_expired_lease_is_claimed_again(tmp_path):
+    manifest = WorkManifest(str(tmp_path / 'manifest.bin'), numSamples=100, chunkSize=100)
+    assert manifest.claim(0, 0.05) == 0
+    assert manifest.claim(1, 60) is None
+    time.sleep(0.1)
+    assert manifest.claim(1, 60) == 0
+
+    #Worker 0 can neither renew nor complete the chunk anymore
+    assert manifest.renew(0, 0, 60)==False
+    assert manifest.complete(0, 0)==False
+    assert manifest.renew(0, 1, 60)
+    assert manifest.complete(0, 1)
+    assert manifest.isAllDone()
+    manifest.close()
+
+
+def test_manifest_resume(tmp_path):
+    path = str(tmp_path / 'manifest.bin')
+    manifest = WorkManifest(path, numSamples=300, chunkSize=100)
+    manifest.claim(0, 60)
+    manifest.complete(manifest.claim(1, 60), 1)
+    manifest.close()
+
+    manifest = WorkManifest(path, numSamples=300, chunkSize=100)
+    manifest.resetLeases()      #Chunk 0 of the crashed worker
+    assert manifest.summary() == (2, 0, 1)
+    assert [manifest.claim(2, 60), manifest.claim(2, 60), manifest.claim(2, 60)] == [0, 2, None]
+    manifest.close()
+
+    with pytest.raises(ValueError):
+        WorkManifest(path, numSamples=300, chunkSize=50)
+
+
+def test_heartbeat_keeps_and_loses_lease(tmp_path):
+    manifest = WorkManifest(str(tmp_path / 'manifest.bin'), numSamples=200, chunkSize=100)
+    chunkIdx = manifest.claim(0, 0.2)
+    heartbeat = LeaseHeartbeat(manifest, chunkIdx, 0, 0.2)
+    time.sleep(0.5)     #Longer than the lease time
+    assert heartbeat.isLost()==False
+    assert manifest.claim(1, 60) == 1
+
+    manifest.resetLeases()      #Taken over by another worker
+    assert manifest.claim(1, 60) == 0
+    time.sleep(0.2)
+    assert heartbeat.isLost()
+    heartbeat.stop()
+    assert manifest.complete(chunkIdx, 0)==False
+    manifest.close()
@@ -0,0 +1,123 @@
+# Copyright (c) Facebook, Inc. and its affiliates.
+
+import os
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.nn as nn
+
+EFTFitter = pytest.importorskip('bodymocap.train.eftFitter').EFTFitter
+
+
+class PerSampleFitter(object):
+    """Stand-in for SMPLify.run_withWeakProj: Adam on a separate loss per sample, summed over samples, for num_iters iterations
+    Samples converge at different speeds, depending on their keypoint confidences
+    """
+    def __init__(self, num_iters):
+        self.num_iters = num_iters
+
+    def run_withWeakProj(self, init_pose, init_betas, init_cam, camera_center, keypoints_2d, bDebugVis=False, bboxInfo=None, imagevis=None,
+                        ablation_smplify_noCamOptFirst=False, ablation_smplify_noPrior=False):
+        pose, betas, cam = init_pose.clone().requires_grad_(), init_betas.clone().requires_grad_(), init_cam.clone().requires_grad_()
+        target = keypoints_2d[:, :24, :3].reshape(-1, 72)
+        speed = keypoints_2d[:, :1, 2]
+
+        def reprojection():
+            return speed * (pose - target)**2 + (betas.sum(dim=1, keepdim=True) - 1)**2 + (cam[:, :1] - 0.5)**2
+
+        optimizer = torch.optim.Adam([pose, betas, cam], lr=0.05)
+        for _ in range(self.num_iters):
+            optimizer.zero_grad()
+            reprojection().sum().backward()
+            optimizer.step()
+        with torch.no_grad():
+            return None, None, pose.detach(), betas.detach(), cam.detach(), reprojection()
+
+
+class TinyRegressor(nn.Module):
+    def forward(self, x):
+        batch_size = x.shape[0]
+        return torch.eye(3).expand(batch_size, 24, 3, 3), 0.1*x[:, :10], 0.9*torch.ones(batch_size, 3)
+
+
+class FitsDict(object):
+    def __getitem__(self, key):
+        batch_size = len(key[1])
+        return torch.zeros(batch_size, 72), torch.zeros(batch_size, 10), torch.ones(batch_size)
+
+
+def makeFitter(smplifyBatch, numSegments):
+    fitter = EFTFitter.__new__(EFTFitter)      #Only the attributes used by run_smplify_batch
+    fitter.options = SimpleNamespace(bExemplar_dataLoaderStart=-1, img_res=224, smplify_numSegments=numSegments, smplify_minRelImprovement=0.05,
+                                    ablation_smplify_noCamOptFirst=False, ablation_smplify_noPrior=False)
+    fitter.device = torch.device('cpu')
+    fitter.model = TinyRegressor()
+    fitter.fits_dict = FitsDict()
+    fitter.smplifyBatch = smplifyBatch
+    return fitter
+
+
+def makeBatch(batch_size):
+    keypoints = torch.rand(batch_size, 49, 3)*2 - 1
+    keypoints[:, :, 2] = torch.linspace(0.02, 2.0, batch_size).unsqueeze(1)
+    return {'img': torch.randn(batch_size, 3, 16, 16).view(batch_size, -1), 'keypoints': keypoints, 'keypoints_original': keypoints.clone(),
+            'sample_index': torch.arange(batch_size), 'is_flipped': torch.zeros(batch_size), 'rot_angle': torch.zeros(batch_size),
+            'dataset_name': ['test']*batch_size, 'imgname': ['{}.jpg'.format(b) for b in range(batch_size)],
+            'scale': torch.ones(batch_size), 'center': torch.zeros(batch_size, 2)}
+
+
+def singleSampleFit(fitter, batch, b, numIters):
+    """SMPLify of a single sample, as run_smplify does"""
+    rotmat, betas, camera = fitter.model(batch['img'][b:b+1])
+    pose = torch.zeros(1, 72)       #Axis-angle of the identity rotations
+    outputs = PerSampleFitter(numIters).run_withWeakProj(pose, betas, camera, 112*torch.ones(1, 2), batch['keypoints'][b:b+1])
+    return outputs[3].numpy(), outputs[4].numpy(), outputs[5].mean(dim=-1).numpy()
+
+
+@pytest.mark.parametrize('numSegments', [1, 4])
+def test_batched_smplify_matches_single_sample(numSegments):
+    torch.manual_seed(0)
+    batch = makeBatch(6)
+    fitter = makeFitter(PerSampleFitter(40), numSegments)
+    outputs = fitter.run_smplify_batch(batch)
+
+    numOfIteration = [output['numOfIteration'] for output in outputs]
+    if numSegments==1:
+        assert numOfIteration == [40]*6
+    else:       #Some samples stopped early, and others ran all iterations
+        assert min(numOfIteration) < 40 and max(numOfIteration) == 40
+
+    for b, output in enumerate(outputs):
+        betas, camera, loss = singleSampleFit(fitter, batch, b, output['numOfIteration'])
+        assert torch.allclose(torch.from_numpy(output['pred_shape']), torch.from_numpy(betas), atol=1e-6)
+        assert torch.allclose(torch.from_numpy(output['pred_camera']), torch.from_numpy(camera), atol=1e-6)
+        assert torch.allclose(torch.from_numpy(output['loss_keypoints_2d']), torch.from_numpy(loss), atol=1e-6)
+        assert output['sampleIdx'][0] == b
+
+
+def test_smplify_batch_matches_single_sample():
+    """SMPLify itself fits the samples of a batch independently. Needs bodymocap.smplify and the SMPL model files"""
+    SMPLify = pytest.importorskip('bodymocap.smplify').SMPLify
+    from bodymocap.core import config, constants
+    if os.path.isdir(config.SMPL_MODEL_DIR)==False:
+        pytest.skip("SMPL model files are not found: {}".format(config.SMPL_MODEL_DIR))
+
+    torch.manual_seed(0)
+    batch_size = 3
+    init_pose = 0.1*torch.randn(batch_size, 72)
+    init_betas = 0.1*torch.randn(batch_size, 10)
+    init_cam = torch.tensor([[0.9, 0, 0]]).repeat(batch_size, 1)
+    camera_center = 112*torch.ones(batch_size, 2)
+    keypoints = torch.rand(batch_size, 49, 3)*2 - 1
+    keypoints[:, :, 2] = 1
+
+    def fit(smplify, rows):
+        return smplify.run_withWeakProj(init_pose[rows], init_betas[rows], init_cam[rows], camera_center[rows], keypoints[rows])
+
+    batched = fit(SMPLify(step_size=1e-2, batch_size=batch_size, num_iters=10, focal_length=constants.FOCAL_LENGTH), list(range(batch_size)))
+    smplify = SMPLify(step_size=1e-2, batch_size=1, num_iters=10, focal_length=constants.FOCAL_LENGTH)
+    for b in range(batch_size):
+        single = fit(smplify, [b])
+        for i in [2, 3, 4, 5]:      #pose, betas, camera, reprojection loss
+            assert torch.allclose(batched[i][b:b+1], single[i], atol=1e-4)